@@ -0,0 +1,152 @@
+# Processes the covers of every (AC, part) pdf in a directory on a pool of
+# worker processes, instead of starting covers_ac_script.sh by hand once per
+# core with its own --instance and AC range. Workers pull one file at a time
+# from a shared queue, so a slow AC never leaves the other cores idle, and
+# every worker renders pages into its own scratch directory.
+
+from result_cache import ResultCache
+from functools import partial
+import multiprocessing
+import process_covers
+import traceback
+import pypdf_ocr
+import argparse
+import tempfile
+import shutil
+import errno
+import sys
+import csv
+import os
+
+SCRATCH_ROOT = None # set in every worker by init_worker
+CACHE = None # this worker's ResultCache, if there is one
+
+
+# gives this worker its own scratch directory, single-threaded tesseract,
+# the parent's --roi dpis (roi_dpi is process_covers' (ROI_PAGE_DPI,
+# ROI_CROP_DPI)) and its own result cache, made once here so the
+# configuration (and --register template) is only hashed once per worker
+def init_worker(scratch, jobs, cache_dir=None, backend=None, roi=False, preprocess=None, register=None, layout=False, roi_dpi=None):
+    global SCRATCH_ROOT
+    global CACHE
+
+    if roi_dpi is not None:
+        process_covers.ROI_PAGE_DPI, process_covers.ROI_CROP_DPI = roi_dpi
+    SCRATCH_ROOT = tempfile.mkdtemp(prefix='worker{}-'.format(os.getpid()), dir=scratch)
+    pypdf_ocr.SCRATCH_DIR = SCRATCH_ROOT
+    pypdf_ocr.setTesseractThreads(jobs)
+    if cache_dir is not None:
+        CACHE = ResultCache(cache_dir, process_covers.pipeline_config(True, backend, roi, preprocess, register, layout))
+
+
+# finds every cover in directory, returns a list of (AC, part, path)
+def find_all_covers(naming, directory, ac_start=0, ac_end=process_covers.MAX_PARTS):
+    regex = process_covers.cover_regex(naming)
+    res = []
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            m = regex.match(f)
+            if m and process_covers.is_between(ac_start, int(m.group(1)), ac_end):
+                res.append((int(m.group(1)), int(m.group(2)), os.path.join(root, f)))
+    return res
+
+
+# runs in a worker: returns (AC, part, row, None) for one cover, or
+# (AC, part, None, error) if it failed, so one bad pdf doesn't stop the run
+def process_task(task, backend=None, roi=False, preprocess=None, registration=None, layout=False):
+    global CACHE
+
+    AC, part, path = task
+    try:
+        if CACHE is not None:
+            cached = CACHE.get(path)
+            if cached is not None:
+                return AC, part, process_covers.set_file_name(cached, path), None
+        if roi:
+            page1 = process_covers.process_cover_regions(path, backend, preprocess, registration)
+        else:
+            page1 = process_covers.process_cover_file(path, backend, preprocess, registration, layout)
+        if CACHE is not None:
+            CACHE.put(path, page1)
+        return AC, part, page1, None
+    except Exception:
+        return AC, part, None, traceback.format_exc()
+
+
+# writes rows to path, sorted by part
+def write_rows(path, rows):
+    rows = [row for part, row in sorted(rows, key=lambda x: x[0])]
+    with open(path, 'w+') as csv_out:
+        dict_writer = csv.DictWriter(csv_out, rows[0].keys())
+        dict_writer.writeheader()
+        dict_writer.writerows(rows)
+
+
+def main(naming, directory, jobs=0, ac_start=0, ac_end=process_covers.MAX_PARTS,
+         backend=None, cache_dir=None, scratch=None, output='output', roi=False, preprocess=None, register=None, layout=False):
+    if not os.path.exists(directory):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), directory)
+
+    jobs = os.cpu_count() if jobs <= 0 else jobs
+    tasks = find_all_covers(naming, directory, ac_start, ac_end)
+    # biggest files first so the long ones don't end up last on a single core
+    tasks.sort(key=lambda task: os.path.getsize(task[2]), reverse=True)
+    print('Processing {} covers with {} worker(s)'.format(len(tasks), jobs))
+
+    # built once here and handed to every worker
+    registration = process_covers.load_registration(register) if register is not None else None
+    scratch_dir = tempfile.mkdtemp(prefix='batch-', dir=os.getcwd() if scratch is None else scratch)
+    os.makedirs(output, exist_ok=True)
+    # every AC's CSV is written as soon as the last of its covers is done
+    remaining = {}
+    for AC, part, path in tasks:
+        remaining[AC] = remaining.get(AC, 0) + 1
+    by_ac = {}
+    failed = []
+    written = 0
+    try:
+        initargs = (scratch_dir, jobs, cache_dir, backend, roi, preprocess, register, layout,
+                    (process_covers.ROI_PAGE_DPI, process_covers.ROI_CROP_DPI))
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=initargs) as pool:
+            worker = partial(process_task, backend=backend, roi=roi, preprocess=preprocess,
+                             registration=registration, layout=layout)
+            for i, (AC, part, page1, error) in enumerate(pool.imap_unordered(worker, tasks, chunksize=1)):
+                if error is None:
+                    by_ac.setdefault(AC, []).append((part, page1))
+                else:
+                    failed.append((AC, part))
+                    print('\nAC {} part {} failed:\n{}'.format(AC, part, error), file=sys.stderr)
+                remaining[AC] -= 1
+                if remaining[AC] == 0 and len(by_ac.get(AC, [])) > 0:
+                    write_rows(os.path.join(output, 'output{}.csv'.format(AC)), by_ac[AC])
+                    written += 1
+                print('\r{}/{} covers done'.format(i + 1, len(tasks)), end='')
+        print()
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    all_rows = [(AC * 1000 + part, page1) for AC in by_ac for part, page1 in by_ac[AC]]
+    if len(all_rows) > 0:
+        write_rows(os.path.join(output, 'output_all.csv'), all_rows)
+    print('Wrote {} AC file(s) to {}/'.format(written, output))
+    if len(failed) > 0:
+        print('{} cover(s) failed: {}'.format(len(failed),
+            ', '.join(['AC {} part {}'.format(AC, part) for AC, part in sorted(failed)])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract data from every Bihar electoral roll cover sheet in a directory in parallel.')
+    parser.add_argument('--dir', type=str, metavar='dir', default='', help='The directory the files are stored in')
+    parser.add_argument('--filename', type=str, metavar='naming', required=True, help='The naming pattern of every cover sheet ([naming]No_xxxPartNo_xxx.pdf)')
+    parser.add_argument('--jobs', type=int, default=0, help='How many worker processes to run (defaults to one per core)')
+    parser.add_argument('--startac', type=int, default=0, help='Which AC number to start at')
+    parser.add_argument('--endac', type=int, default=process_covers.MAX_PARTS, help='Which AC number to end at')
+    parser.add_argument('--scratch', type=str, metavar='dir', help='Where workers render pages (defaults to the working directory)')
+    parser.add_argument('--output', type=str, metavar='dir', default='output', help='Where the per-AC CSVs go')
+    process_covers.add_pipeline_arguments(parser)
+
+    args = parser.parse_args()
+    preprocess = process_covers.apply_pipeline_arguments(parser, args)
+    real_dir = os.getcwd() if args.dir == '' else args.dir
+    main(args.filename, real_dir, args.jobs, args.startac, args.endac,
+         args.backend, args.cache, args.scratch, args.output, args.roi, preprocess, args.register, args.layout)
@@ -0,0 +1,421 @@
+# Rough timing harness for the pieces of the pipeline that get run
+# thousands of times. Every benchmark prints its timings to stdout so
+# runs can be compared by hand.
+
+from pdf2image import convert_from_path
+from contextlib import closing
+import pypdf_ocr
+import argparse
+import resource
+import random
+import tempfile
+import time
+import os
+
+
+# stands in for a real OCR'd cover when no saved covers are given
+SAMPLE_COVER_TEXT = """मतदाता सूची 2019
+विधान सभा क्षेत्र की संख्या , नाम व आरक्षण स्थिति : 182 - पटना - सामान्य
+लोक सभा क्षेत्र की संख्या , नाम व आरक्षण स्थिति : 30 - पटना - सामान्य
+भाग संख्या : 45
+(1) रामपुर टोला
+मुख्य ग्राम : रामपुर
+डाकघर : बिहटा
+थाना : बिहटा
+राजस्व हलका : 12
+पंचायत : रामपुर
+अंचल : बिहटा
+प्रखंड : बिहटा
+अनूमंडल : दानापुर
+जिला : पटना
+पिन कोड : 801103
+मतदान केन्द्र की संख्या व नाम : 12 प्राथमिक विद्यालय , रामपुर
+मतदान केन्द्र का भवन व पता प्राथमिक विद्यालय, रामपुर
+"""
+
+
+# times a function call, returns (seconds, result)
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return time.perf_counter() - start, res
+
+
+# the old getImagePages loop: one pdf2image call (and one pdftoppm
+# process, which re-parses the pdf) per OUTPUT_PAGE_LIMIT pages
+def chunked_rasterize(path, limit=0, start=0):
+    res = []
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as dir:
+        max_pages = pypdf_ocr.getPageCount(path) if limit <= 0 else limit
+        for page in range(start, max_pages, pypdf_ocr.OUTPUT_PAGE_LIMIT):
+            images = convert_from_path(path,
+                                       dpi=300,
+                                       first_page=page,
+                                       last_page=min(page + pypdf_ocr.OUTPUT_PAGE_LIMIT - 1, max_pages),
+                                       output_folder=dir)
+            res += [img.size for img in images]
+            for img in images:
+                img.close()
+    return res
+
+
+def single_pass_rasterize(path, limit=0, start=0):
+    res = []
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as dir:
+        max_pages = pypdf_ocr.getPageCount(path) if limit <= 0 else limit
+        for page_path in pypdf_ocr.rasterizePages(path, dir, first_page=start, last_page=max_pages):
+            with pypdf_ocr.Image.open(page_path) as img:
+                res.append(img.size)
+    return res
+
+
+def bench_rasterize(path, repeat):
+    print('Rasterizing {} ({} pages)'.format(path, pypdf_ocr.getPageCount(path)))
+    for name, func in [('chunked', chunked_rasterize), ('single pass', single_pass_rasterize)]:
+        times = []
+        for i in range(repeat):
+            t, pages = timed(func, path)
+            times.append(t)
+        print('  {:<12} best {:.2f}s, mean {:.2f}s, {} pages'.format(name, min(times), sum(times) / len(times), len(pages)))
+
+
+# peak resident memory of this process in MB (linux reports KB)
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# run once per process, since peak RSS never goes back down
+def bench_memory(path, mode):
+    start = peak_rss()
+    if mode == 'list':
+        t, pages = timed(pypdf_ocr.getImagePages, path)
+        for img in pages['images']:
+            img.load()
+        count = len(pages['images'])
+        pypdf_ocr.cleanupImageOutput(pages)
+    else:
+        start_time = time.perf_counter()
+        count = 0
+        with closing(pypdf_ocr.iterImagePages(path)) as pages:
+            for img in pages:
+                count += 1
+        t = time.perf_counter() - start_time
+    print('{} ({} pages, {}): {:.2f}s, peak RSS {:.0f} MB (started at {:.0f} MB)'.format(
+        path, count, mode, t, peak_rss(), start))
+
+
+# what OCR makes of the ':' after a cover label (see the SEARCH_* patterns)
+COVER_SEPARATORS = [' : ', ':', ' ४ ', ' ; ', ' . ', ' ', ' ! ']
+# words cover values and filler lines are made of
+COVER_WORDS = ['रामपुर', 'बिहटा', 'पटना', 'साहिब', 'दानापुर', 'मनेर', 'नौबतपुर', 'प्राथमिक', 'विद्यालय', 'मध्य',
+               'टोला', 'बाजार', 'नगर', 'पंचायत', 'भवन', 'उत्तरी', 'दक्षिणी', 'सूची', 'मतदाता', 'नामावली', 'वार्ड']
+
+
+# a made up corpus of OCR'd covers: the fields of SAMPLE_COVER_TEXT with
+# other values, label separators the way OCR garbles them, some fields
+# missing and a varying amount of other text in between (the instructions
+# and headers a real cover has), so the field searches get timed on texts
+# that aren't all the same
+def synthetic_covers(count, seed=0):
+    rng = random.Random(seed)
+
+    def words(low, high):
+        return ' '.join([rng.choice(COVER_WORDS) for i in range(rng.randint(low, high))])
+
+    def sep():
+        return rng.choice(COVER_SEPARATORS)
+
+    def reserved():
+        return rng.choice(['सामान्य', 'अनुसूचित'])
+
+    res = []
+    for i in range(count):
+        fields = [
+            'विधान सभा क्षेत्र की संख्या , नाम व आरक्षण स्थिति : {} - {} - {}'.format(rng.randint(1, 243), words(1, 1), reserved()),
+            'लोक सभा क्षेत्र की संख्या , नाम व आरक्षण स्थिति : {} - {} - {}'.format(rng.randint(1, 40), words(1, 1), reserved()),
+            'भाग संख्या : {}'.format(rng.randint(1, 400)),
+            '({}) {}'.format(rng.randint(1, 9), words(1, 3)),
+            'मुख्य ग्राम' + sep() + words(1, 2),
+            'डाकघर' + sep() + words(1, 2),
+            'थाना' + sep() + words(1, 2),
+            'राजस्व हलका' + sep() + str(rng.randint(1, 60)),
+            'पंचायत' + sep() + words(1, 2),
+            'अंचल' + sep() + words(1, 2),
+            'प्रखंड' + sep() + words(1, 2),
+            'अनूमंडल' + sep() + words(1, 2),
+            'जिला' + sep() + words(1, 1),
+            'पिन कोड' + sep() + str(rng.randint(800001, 855117)),
+            'मतदान केन्द्र की संख्या व नाम' + sep() + '{} {}'.format(rng.randint(1, 400), words(2, 4)),
+            'मतदान केन्द्र का भवन व पता ' + words(2, 4)
+        ]
+        lines = ['मतदाता सूची {}'.format(rng.randint(2015, 2020))]
+        for field in fields:
+            if rng.random() < 0.1:
+                continue
+            lines += [words(3, 12) for j in range(rng.randint(0, 3))]
+            lines.append(field)
+        lines += [words(3, 12) for j in range(rng.randint(0, 20))]
+        res.append('\n'.join(lines) + '\n')
+    return res
+
+
+# every .txt file in directory (like the plaintext/hin-covers*.txt dumps of
+# process_covers), or the sample cover and count - 1 synthetic ones if
+# there's no directory
+def load_cover_texts(directory, count=2000):
+    if directory is None or not os.path.isdir(directory):
+        return [SAMPLE_COVER_TEXT] + synthetic_covers(count - 1)
+    res = []
+    for f in sorted(os.listdir(directory)):
+        if f.endswith('.txt'):
+            with open(os.path.join(directory, f), encoding='utf-8') as text_file:
+                res.append(text_file.read())
+    return res
+
+
+# building a new FieldExtractor per page is what extractPage1 used to do on
+# every call (rebuild the pattern strings and compile them), extractPage1 is
+# one re.search per field and scanPage1 is the single scan (see
+# pypdf_ocr.PAGE1_SINGLE_SCAN). Checks that the last two agree on every text
+def bench_fields(texts, repeat):
+    pages = texts * max(1, 2000 // len(texts))
+    shared = pypdf_ocr.FieldExtractor()
+    mismatches = len([text for text in texts if shared.extractPage1(text) != shared.scanPage1(text)])
+    print('Extracting fields from {} cover text(s) ({:.0f} characters on average), {} differ between single scan and search'.format(
+        len(texts), sum([len(text) for text in texts]) / len(texts), mismatches))
+    for name, func in [('per call', lambda text: pypdf_ocr.FieldExtractor().extractPage1(text)),
+                       ('precompiled', shared.extractPage1),
+                       ('single scan', shared.scanPage1)]:
+        times = []
+        for i in range(repeat):
+            t, res = timed(lambda: [func(text) for text in pages])
+            times.append(t)
+        print('  {:<12} best {:.3f}s for {} pages ({:.0f} pages/s)'.format(name, min(times), len(pages), len(pages) / min(times)))
+
+
+# a made up district: rows of (age, head of household, father) with latin
+# names, so nothing needs transliterating
+def synthetic_district(rows, seed=0):
+    rng = random.Random(seed)
+    parts = ['RAM', 'SHYAM', 'KUMAR', 'LAL', 'DEV', 'PRASAD', 'SINGH', 'DAS', 'MANJHI',
+             'PASWAN', 'RAVI', 'CHAND', 'NATH', 'MOHAN', 'BHOLA', 'SUNIL', 'RAJ']
+    def name():
+        return ' '.join([rng.choice(parts) for i in range(rng.randint(2, 3))])
+    return [(rng.randint(13, 90), name(), name()) for i in range(rows)]
+
+
+# typos in a few characters, so some queries still match
+def misspell(name, rng):
+    name = list(name)
+    for i in range(rng.randint(0, 2)):
+        name[rng.randrange(len(name))] = rng.choice('AEIOU')
+    return ''.join(name)
+
+
+def bench_similarity(rows, queries):
+    # match_dataframes needs libindic, which the other benchmarks don't
+    import match_dataframes
+    import pandas as pd
+
+    rng = random.Random(1)
+    district = synthetic_district(rows)
+    df = pd.DataFrame(district, columns=['age', 'head_of_hh', 'fathers_and_mothers_name'])
+    lookups = [(age, misspell(head, rng)) for age, head, father in rng.sample(district, queries)]
+    print('District of {} rows, {} lookups'.format(rows, queries))
+
+    # the old loop: every row of that age against are_similar
+    def pairwise(age, name):
+        for head, father in zip(df['head_of_hh'][df['age'] == age], df['fathers_and_mothers_name'][df['age'] == age]):
+            if match_dataframes.are_similar(head, name):
+                return father
+        return None
+
+    t_build, index = timed(match_dataframes.CandidateIndex, df)
+    print('  index built in {:.2f}s'.format(t_build))
+    for name, func in [('pairwise', pairwise), ('vectorized', index.find)]:
+        t, res = timed(lambda: [func(age, query) for age, query in lookups])
+        found = len([r for r in res if r is not None])
+        print('  {:<12} {:.2f}s ({:.0f} lookups/s), {} matches'.format(name, t, queries / t, found))
+
+
+# stands in for tesseract so a benchmark only times what's around the OCR,
+# counting the engine calls it would have cost
+class NullBackend:
+    name = 'null'
+
+    def __init__(self):
+        self.calls = 0
+
+    def recognize(self, image, language='eng', psm=3, clist=''):
+        self.calls += 1
+        return ''
+
+    def recognizeRegions(self, image, boxes, language='eng', psm=3, clist=''):
+        self.calls += 1
+        return [''] * len(boxes)
+
+    def data(self, image, language='eng', psm=3, clist=''):
+        self.calls += 1
+        return dict([(key, []) for key in pypdf_ocr.LAYOUT_KEYS])
+
+    def close(self):
+        pass
+
+
+# a cover the way process_covers.py reads it by default (one 300 dpi page)
+# vs with --roi (the low dpi page plus bands of nearby crops, or the scan
+# taken out of the pdf once): wall time, pdftoppm calls and pixels rendered
+# per cover. Without the OCR itself unless backend names one ('tesserocr' or
+# 'pytesseract'), since most of what --roi saves is OCR on fewer pixels
+def bench_roi(path, repeat, backend=None):
+    import process_covers
+
+    renders = [0, 0]
+    render_region = pypdf_ocr.renderRegion
+    rasterize_pages = pypdf_ocr.rasterizePages
+
+    def counted_region(*args, **kwargs):
+        img = render_region(*args, **kwargs)
+        renders[0] += 1
+        renders[1] += img.size[0] * img.size[1]
+        return img
+
+    def counted_pages(*args, **kwargs):
+        renders[0] += 1
+        for page in rasterize_pages(*args, **kwargs):
+            with pypdf_ocr.Image.open(page) as img:
+                renders[1] += img.size[0] * img.size[1]
+            yield page
+
+    pypdf_ocr.renderRegion = counted_region
+    pypdf_ocr.rasterizePages = counted_pages
+    scan = pypdf_ocr.getEmbeddedPage(path) is not None
+    print('Reading the cover of {} ({}, {})'.format(path, 'a single scan' if scan else 'rendered',
+        'OCR with ' + backend if backend is not None else 'no OCR'))
+    try:
+        for name, func in [('full page', process_covers.process_cover_file), ('roi', process_covers.process_cover_regions)]:
+            times = []
+            for i in range(repeat):
+                engine = NullBackend() if backend is None else pypdf_ocr.getOCRBackend(backend)
+                renders[0], renders[1] = 0, 0
+                t, res = timed(func, path, engine)
+                times.append(t)
+            print('  {:<12} best {:.3f}s, {} pdftoppm call(s), {:.1f} MP rendered'.format(
+                name, min(times), renders[0], renders[1] / 1e6) +
+                (', {} OCR call(s)'.format(engine.calls) if backend is None else ''))
+    finally:
+        pypdf_ocr.renderRegion = render_region
+        pypdf_ocr.rasterizePages = rasterize_pages
+
+
+# pages taken straight out of the pdf vs rendered by pdftoppm, and how far
+# apart the two are (mean absolute difference of the grayscale pixels)
+def bench_embedded(paths, repeat):
+    import numpy as np
+
+    def read(path, embedded):
+        pypdf_ocr.EMBEDDED_IMAGES = embedded
+        try:
+            with closing(pypdf_ocr.iterImagePages(path)) as pages:
+                return [img.convert('L') for img in pages]
+        finally:
+            pypdf_ocr.EMBEDDED_IMAGES = True
+
+    for path in paths:
+        with open(path, 'rb') as pdf_file:
+            reader = pypdf_ocr.PdfFileReader(pdf_file)
+            scanned = [i + 1 for i in range(reader.getNumPages()) if pypdf_ocr.findEmbeddedImage(reader.getPage(i)) is not None]
+        print('{}: {} of {} page(s) are a single scan'.format(path, len(scanned), pypdf_ocr.getPageCount(path)))
+        if len(scanned) == 0:
+            continue
+        results = {}
+        for name, embedded in [('rendered', False), ('embedded', True)]:
+            times = []
+            for i in range(repeat):
+                t, results[name] = timed(read, path, embedded)
+                times.append(t)
+            print('  {:<12} best {:.2f}s'.format(name, min(times)))
+        for page in scanned:
+            rendered, embedded = results['rendered'][page - 1], results['embedded'][page - 1]
+            if rendered.size != embedded.size:
+                print('  page {}: rendered {} vs embedded {}'.format(page, rendered.size, embedded.size))
+                embedded = embedded.resize(rendered.size)
+            diff = np.abs(np.asarray(rendered, dtype=np.int16) - np.asarray(embedded, dtype=np.int16))
+            print('  page {}: mean difference {:.2f}, {:.2%} of pixels off by more than 32'.format(page, diff.mean(), (diff > 32).mean()))
+
+
+# OCR time and accuracy of the first pages of a pdf with every preprocessing
+# setting. Accuracy is the share of words that match the pdf's own text
+# layer, in any order since the two read a table's columns in different
+# orders, when it has a readable (latin) one like english.pdf, and otherwise
+# only agreement with the unprocessed OCR (hindi.pdf's fonts aren't unicode).
+# skew turns every page by that many degrees first, like a crooked scan
+def bench_preprocess(path, language, pages, repeat, skew=0.0):
+    from collections import Counter
+
+    with open(path, 'rb') as pdf_file:
+        reader = pypdf_ocr.PdfFileReader(pdf_file)
+        truth = [reader.getPage(i).extractText() for i in range(min(pages, reader.getNumPages()))]
+    readable = all([len(text) > 0 and sum([c.isascii() for c in text]) / len(text) > 0.9 for text in truth])
+    with closing(pypdf_ocr.iterImagePages(path, pages)) as rendered:
+        images = list(rendered)
+    if skew != 0:
+        images = [image.rotate(skew, resample=pypdf_ocr.Image.BILINEAR, fillcolor='white') for image in images]
+
+    def similarity(a, b):
+        a, b = Counter(a.split()), Counter(b.split())
+        total = sum(a.values()) + sum(b.values())
+        return 2 * sum((a & b).values()) / total if total > 0 else 1.0
+
+    settings = [('none', None),
+                ('gray', pypdf_ocr.Preprocessor('gray')),
+                ('binary', pypdf_ocr.Preprocessor('binary')),
+                ('binary+deskew', pypdf_ocr.Preprocessor('binary', deskew=True))]
+    print('OCRing {} page(s) of {} ({}, turned {} degrees), compared to {}'.format(len(images), path, language, skew,
+        'the text layer' if readable else 'the unprocessed OCR'))
+    reference = truth if readable else None
+    for name, preprocess in settings:
+        times = []
+        for i in range(repeat):
+            t, texts = timed(pypdf_ocr.extractTextFromImages, images, language=language, preprocess=preprocess)
+            times.append(t)
+        if reference is None:
+            reference = texts
+        prep = 0
+        if preprocess is not None:
+            prep, processed = timed(lambda: [preprocess(img) for img in images])
+        scores = [similarity(a, b) for a, b in zip(reference, texts)]
+        print('  {:<14} best {:.2f}s/page ({:.2f}s preprocessing), accuracy {:.3f}'.format(
+            name, min(times) / len(images), prep / len(images), sum(scores) / len(scores)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for pyPDF-OCR.')
+    parser.add_argument('benchmark', choices=['rasterize', 'memory', 'fields', 'similarity', 'roi', 'embedded', 'preprocess'], help='Which benchmark to run')
+    parser.add_argument('--path', type=str, default='test_files/hindi.pdf', help='Input file (or directory of saved cover texts for fields)')
+    parser.add_argument('--mode', choices=['list', 'stream'], default='stream', help='getImagePages or iterImagePages (memory)')
+    parser.add_argument('--covers', type=int, default=2000, help='Synthetic covers when --path isn\'t a directory of cover texts (fields)')
+    parser.add_argument('--rows', type=int, default=50000, help='Rows in the synthetic district (similarity)')
+    parser.add_argument('--queries', type=int, default=200, help='Lookups into the synthetic district (similarity)')
+    parser.add_argument('--language', type=str, default='hin', help='Tesseract language (preprocess)')
+    parser.add_argument('--pages', type=int, default=3, help='How many pages to OCR (preprocess)')
+    parser.add_argument('--skew', type=float, default=0.0, help='Degrees to turn every page by before OCR (preprocess)')
+    parser.add_argument('--backend', choices=['tesserocr', 'pytesseract'], help='OCR the cover too (roi)')
+    parser.add_argument('--repeat', type=int, default=3, help='How many times to repeat each measurement')
+    args = parser.parse_args()
+
+    if args.benchmark == 'rasterize':
+        bench_rasterize(args.path, args.repeat)
+    elif args.benchmark == 'memory':
+        bench_memory(args.path, args.mode)
+    elif args.benchmark == 'fields':
+        bench_fields(load_cover_texts(args.path, args.covers), args.repeat)
+    elif args.benchmark == 'similarity':
+        bench_similarity(args.rows, args.queries)
+    elif args.benchmark == 'roi':
+        bench_roi(args.path, args.repeat, args.backend)
+    elif args.benchmark == 'embedded':
+        test_files = [os.path.join('test_files', f) for f in sorted(os.listdir('test_files')) if f.endswith('.pdf')]
+        bench_embedded(test_files if args.path == parser.get_default('path') else [args.path], args.repeat)
+    elif args.benchmark == 'preprocess':
+        bench_preprocess(args.path, args.language, args.pages, args.repeat, args.skew)
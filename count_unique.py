@@ -1,7 +1,10 @@
-from os.path import isfile, join
+from os.path import isfile, join, splitext, basename
 from os import listdir
+import multiprocessing
 import pandas as pd
+import numpy as np
 import argparse
+import json
 import re
 
 KEEP_COLUMNS = ['block', 'panchayat_nagar', 'vill_ward']
@@ -31,8 +34,90 @@ def main(mahadalit_folder):
     print('Total village: {}'.format(village_total))
 
 
+# reads only KEEP_COLUMNS of one district file and returns its name, row
+# count, the count of distinct values in each column (what main counts), the
+# count of distinct places at each level and the 64 bit hashes of every
+# column's distinct values. A place is a column along with everything above
+# it (block, panchayat_nagar, vill_ward), so villages with the same name in
+# different panchayats are different places. Hashes are a lot cheaper to
+# send back to the parent (and to merge) than strings
+def hash_district(path):
+    global KEEP_COLUMNS
+
+    name = splitext(basename(path))[0]
+    mdf = pd.read_csv(path,
+            usecols=KEEP_COLUMNS,
+            dtype=str,
+            error_bad_lines=False,
+            encoding='utf-8',
+            na_values=['na'])
+    counts = {}
+    places = {}
+    hashes = {}
+    for i, column in enumerate(KEEP_COLUMNS):
+        hashes[column] = np.unique(pd.util.hash_array(mdf[column].to_numpy(dtype=object)))
+        counts[column] = len(hashes[column])
+        places[column] = len(np.unique(pd.util.hash_pandas_object(mdf[KEEP_COLUMNS[0:i + 1]], index=False).to_numpy()))
+    return name, len(mdf), counts, places, hashes
+
+
+# same counts as main, but every file is read once (only KEEP_COLUMNS) on
+# jobs worker processes. Reports the count of each district, their sum (what
+# main prints), the number of distinct places (see hash_district; no two
+# districts share one) and the number of distinct names in each column
+# across all districts. Writes them to output as JSON, or CSV if output ends
+# with .csv
+def main_fast(mahadalit_folder, jobs=0, output=None):
+    global KEEP_COLUMNS
+
+    paths = [join(mahadalit_folder, f) for f in sorted(listdir(mahadalit_folder))
+        if isfile(join(mahadalit_folder, f)) and 'lock' not in f]
+    print('Total districts: {}'.format(len(paths)))
+
+    districts = []
+    places = {'district': 'places', 'rows': None}
+    merged = dict([(column, []) for column in KEEP_COLUMNS])
+    for column in KEEP_COLUMNS:
+        places[column] = 0
+    jobs = multiprocessing.cpu_count() if jobs <= 0 else jobs
+    with multiprocessing.Pool(min(jobs, max(1, len(paths)))) as pool:
+        for name, rows, counts, district_places, hashes in pool.imap_unordered(hash_district, paths, chunksize=1):
+            district = {'district': name, 'rows': rows}
+            for column in KEEP_COLUMNS:
+                district[column] = counts[column]
+                places[column] += district_places[column]
+                merged[column].append(hashes[column])
+            districts.append(district)
+    districts.sort(key=lambda district: district['district'])
+
+    total = {'district': 'total', 'rows': sum([district['rows'] for district in districts])}
+    # distinct names aren't a number of rows
+    unique = {'district': 'unique', 'rows': None}
+    for column in KEEP_COLUMNS:
+        total[column] = sum([district[column] for district in districts])
+        unique[column] = len(np.unique(np.concatenate(merged[column]))) if len(merged[column]) > 0 else 0
+
+    print('Total blocks: {} ({} places, {} distinct names)'.format(total['block'], places['block'], unique['block']))
+    print('Total panchayat: {} ({} places, {} distinct names)'.format(total['panchayat_nagar'], places['panchayat_nagar'], unique['panchayat_nagar']))
+    print('Total village: {} ({} places, {} distinct names)'.format(total['vill_ward'], places['vill_ward'], unique['vill_ward']))
+
+    if output is None:
+        return
+    if output.endswith('.csv'):
+        pd.DataFrame(districts + [total, places, unique], columns=['district', 'rows'] + KEEP_COLUMNS).astype({'rows': 'Int64'}).to_csv(output, index=False)
+    else:
+        with open(output, 'w', encoding='utf-8') as outfile:
+            json.dump({'districts': districts, 'total': total, 'places': places, 'unique': unique}, outfile, indent=2, ensure_ascii=False)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Match SECC data to Mahadalit Census.')
     parser.add_argument('--mahadalit_folder', help='Path to census data.', required=True)
+    parser.add_argument('--fast', action='store_true', help='Read the files in parallel and count distinct places and names across districts too.')
+    parser.add_argument('--jobs', type=int, default=0, help='Worker processes for --fast (defaults to one per core).')
+    parser.add_argument('--output', help='Where --fast writes its counts (.json or .csv).')
     args = parser.parse_args()
-    main(args.mahadalit_folder)
+    if args.fast:
+        main_fast(args.mahadalit_folder, args.jobs, args.output)
+    else:
+        main(args.mahadalit_folder)
@@ -8,7 +8,7 @@
 
 for i in $(seq $1 $2)
 do
-    python3 process_covers.py --AC $i --filename $4 --dir $3 --instance $5
+    python3 process_covers.py --AC $i --filename $4 --dir $3 --instance $5 --cache cache/
     rm -rf images$5/ plaintext$5/
     echo "Finished $i"
 done
@@ -0,0 +1,22 @@
+from match_dataframes import load_secc, write_secc_store
+import argparse
+
+# Parses and filters the state-wide SECC csv once and saves it as a store
+# of per-district feather files, so match_dataframes.py --secc_store only
+# has to read the one district it works on.
+def main(secc_path, store_path, chunksize):
+    print('Reading {}...'.format(secc_path))
+    df = load_secc(secc_path, chunksize=chunksize)
+    meta = write_secc_store(df, store_path, source=secc_path)
+    for district, entry in meta['districts'].items():
+        print('{}: {} rows'.format(district, entry['rows']))
+    print('Wrote {} districts to {}'.format(len(meta['districts']), store_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the SECC csv into a per-district columnar store.')
+    parser.add_argument('--secc_path', help='Path to secc csv.', required=True)
+    parser.add_argument('--store', help='Directory to write the store to.', required=True)
+    parser.add_argument('--chunksize', type=int, default=500000, help='Rows to read at a time.')
+    args = parser.parse_args()
+    main(args.secc_path, args.store, args.chunksize)
@@ -1,22 +1,40 @@
 from libindic.transliteration import getInstance # better transliteration liberary
 from pypdf_ocr import getHindiAlphabet
 from difflib import SequenceMatcher
+from functools import lru_cache
 import pandas as pd
 import numpy as np
+import multiprocessing
 import argparse
 import string
+import json
+import os
 import re
 
+# Optional: per-district SECC partitions (see ingest_secc.py)
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
 USEFUL_COLUMNS = ['age', 'gender', 'social_cat', 'village', 'district', 'panchayat', 'fathers_and_mothers_name', 'tehsil', 'head_of_hh']
 USEFUL_COLUMNS.sort()
 LATIN_ALPHABET = string.ascii_letters
 HINDI_ALPHABET = getHindiAlphabet()
 TRANSLIT_INSTANCE = getInstance()
 THRESHOLD = 0.9 # 90%
+TRANSLIT_CACHE_SIZE = 1 << 16 # names kept in memory by transliterate
+# name -> transliteration, only kept once load_translit_cache is called
+# (everything transliterated after that gets saved by save_translit_cache)
+TRANSLIT_STORE = None
 
 USEFUL_COLUMNS2 = ['district', 'block', 'panchayat_nagar', 'vill_ward', 'name_hoh', 'age']
 USEFUL_COLUMNS2.sort()
 
+# reading the SECC csv (see load_secc)
+SECC_CHUNK_SIZE = 500000 # rows per chunk
+SECC_CATEGORIES = ['district', 'gender', 'social_cat'] # few distinct values, stored as categoricals
+
 def int_(val):
     try:
         return int(val)
@@ -29,6 +47,43 @@ def int_(val):
     return 0
 
 
+# transliterates a hindi name to upper case english, every name only ever
+# gets transliterated once per run (or at all, with a TRANSLIT_STORE)
+@lru_cache(maxsize=TRANSLIT_CACHE_SIZE)
+def transliterate(name):
+    global TRANSLIT_STORE
+
+    if TRANSLIT_STORE is None:
+        return TRANSLIT_INSTANCE.transliterate(name, "en_US").upper()
+    if name not in TRANSLIT_STORE:
+        TRANSLIT_STORE[name] = TRANSLIT_INSTANCE.transliterate(name, "en_US").upper()
+    return TRANSLIT_STORE[name]
+
+
+# loads the on-disk transliteration cache at path (if there is one) so names
+# transliterated by earlier runs don't get transliterated again
+def load_translit_cache(path):
+    global TRANSLIT_STORE
+
+    TRANSLIT_STORE = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as infile:
+            TRANSLIT_STORE = json.load(infile)
+    return TRANSLIT_STORE
+
+
+# saves every name transliterated so far to path
+def save_translit_cache(path):
+    global TRANSLIT_STORE
+
+    if TRANSLIT_STORE is None:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as outfile:
+        json.dump(TRANSLIT_STORE, outfile, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
 # expects a single name returns transliterated name
 def translit_and_format_name(name):
     global LATIN_ALPHABET
@@ -44,11 +99,19 @@ def translit_and_format_name(name):
     try:
         if name[0] in LATIN_ALPHABET:
             return name.upper()
-        return TRANSLIT_INSTANCE.transliterate(name, "en_US").upper()
+        return transliterate(name)
     except:
         return name
 
 
+# transliterates a whole column, every distinct name only once. Anything
+# that isn't a string (missing values) is left as is
+def transliterate_column(column):
+    names = [name for name in column.unique() if isinstance(name, str)]
+    translits = dict(zip(names, [translit_and_format_name(name) for name in names]))
+    return column.map(lambda name: translits.get(name, name) if isinstance(name, str) else name)
+
+
 # returns true if similar and false if not
 def are_similar(str1, str2):
     global THRESHOLD
@@ -56,60 +119,256 @@ def are_similar(str1, str2):
     return SequenceMatcher(None, str1, str2).ratio() >= THRESHOLD
 
 
-# returns how similar two lists are
-def get_similarity(l1, l2):
-    return SequenceMatcher(None, l1, l2).ratio()
+# scores one name against a whole array of candidate names at once. The
+# character counts of every candidate are kept in a numpy matrix, which
+# gives SequenceMatcher's quick_ratio bound (2 * shared characters /
+# total length) for all candidates in one vectorized step. Only the
+# candidates whose bound reaches the threshold get the real (slow) ratio,
+# so the answers are exactly the same as are_similar's.
+class SimilarityEngine:
+    ALPHABET_SIZE = 128 # ascii gets its own column, everything else shares the last one
+
+    def __init__(self, names, threshold=THRESHOLD):
+        self.threshold = threshold
+        self.names = list(names)
+        self.lengths = np.array([len(name) for name in self.names], dtype=np.int32)
+        dtype = np.uint8 if len(self.names) == 0 or self.lengths.max() < 256 else np.uint16
+        # count every (row, character) pair of all the names in one go
+        rows = np.repeat(np.arange(len(self.names)), self.lengths)
+        cells = rows * self.ALPHABET_SIZE + self.encode(''.join(self.names))
+        self.counts = np.bincount(cells, minlength=len(self.names) * self.ALPHABET_SIZE) \
+            .reshape(len(self.names), self.ALPHABET_SIZE).astype(dtype)
+
+    # column of every character of name
+    def encode(self, name):
+        return np.minimum(np.frombuffer(name.encode('utf-32-le'), dtype=np.uint32), self.ALPHABET_SIZE - 1)
+
+    # upper bound of the ratio between name and every candidate
+    def bounds(self, name):
+        query = np.bincount(self.encode(name), minlength=self.ALPHABET_SIZE).astype(self.counts.dtype)
+        shared = np.minimum(self.counts, query).sum(axis=1)
+        total = self.lengths + len(name)
+        return np.where(total > 0, 2.0 * shared / np.maximum(total, 1), 1.0)
+
+    # indices of the candidates that might be similar to name, in order
+    def plausible(self, name):
+        return np.flatnonzero(self.bounds(name) >= self.threshold)
+
+    # boolean array, True for every candidate that's similar to name
+    def similar(self, name):
+        res = np.zeros(len(self.names), dtype=bool)
+        matcher = SequenceMatcher(None)
+        matcher.set_seq2(name)
+        for i in self.plausible(name):
+            matcher.set_seq1(self.names[i])
+            res[i] = matcher.ratio() >= self.threshold
+        return res
+
+    # index of the first candidate that's similar to name, or -1
+    def first_similar(self, name):
+        matcher = SequenceMatcher(None)
+        matcher.set_seq2(name)
+        for i in self.plausible(name):
+            matcher.set_seq1(self.names[i])
+            if matcher.ratio() >= self.threshold:
+                return i
+        return -1
 
 
-def main(secc_path, mahadalit_path):
+# an index over the SECC rows of one district, built once so every lookup
+# only compares plausible pairs. Head of household names get transliterated
+# once per distinct name (not once per comparison) and rows are grouped by
+# age, each age with its own SimilarityEngine. Lookups give the same answer
+# as checking every row of that age with are_similar, in order.
+class CandidateIndex:
+    def __init__(self, df_district, threshold=THRESHOLD):
+        self.threshold = threshold
+        self.blocks = {}
+        ages = df_district['age'].tolist()
+        heads = transliterate_column(df_district['head_of_hh']).tolist()
+        fathers = df_district['fathers_and_mothers_name'].tolist()
+        rows = {}
+        for order in range(len(ages)):
+            if isinstance(heads[order], str):
+                rows.setdefault(ages[order], []).append(order)
+        for age in rows:
+            engine = SimilarityEngine([heads[order] for order in rows[age]], threshold)
+            self.blocks[age] = (engine, [fathers[order] for order in rows[age]])
+
+    # returns the (transliterated) head of household and father name of the
+    # first row with this age whose head of household is similar to name, or None
+    def find(self, age, name):
+        block = self.blocks.get(age)
+        if block is None:
+            return None
+        engine, fathers = block
+        i = engine.first_similar(name)
+        if i < 0:
+            return None
+        return engine.names[i], fathers[i]
+
+
+# keeps only the rows we match against: men over the age of 13 in the SC social category
+def filter_secc(df):
+    df = df.copy()
+    df['age'] = pd.to_numeric(df['age'], errors='coerce')
+    df = df[(df['gender']=='M') & (df['age']>=13) & (df['social_cat']=='SC')]
+    df['age'] = df['age'].astype(np.int16)
+    return df
+
+
+# concatenates dataframes whose categorical columns have different categories
+# without falling back to (much bigger) object columns
+def concat_categorical(frames, columns):
+    if len(frames) == 0:
+        return pd.DataFrame()
+    for column in columns:
+        categories = pd.api.types.union_categoricals([frame[column] for frame in frames]).categories
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+# reads the SECC csv at path a chunk at a time, keeping only USEFUL_COLUMNS
+# and the rows filter_secc wants, so memory scales with the filtered result
+# instead of the whole file. Low cardinality columns are categoricals and age
+# is a small int. If by_district is True, returns a dict of upper case
+# district name -> dataframe instead
+def load_secc(path, chunksize=SECC_CHUNK_SIZE, by_district=False):
     global USEFUL_COLUMNS
-    global USEFUL_COLUMNS2
+    global SECC_CATEGORIES
 
-    df0 = pd.read_csv(secc_path, 
+    dtypes = dict([(column, 'category') for column in SECC_CATEGORIES])
+    dtypes['age'] = str
+    chunks = pd.read_csv(path,
         error_bad_lines=False,
         encoding='utf-8',
-        na_values=['na'])
-    print(df0.head())
-    print(df0.columns)
+        na_values=['na'],
+        usecols=USEFUL_COLUMNS,
+        dtype=dtypes,
+        chunksize=chunksize)
+    df = concat_categorical([filter_secc(chunk) for chunk in chunks], SECC_CATEGORIES)
+    df = df[USEFUL_COLUMNS]
+    return partition_by_district(df) if by_district else df
 
-    # filter columns and rows
-    df = df0[USEFUL_COLUMNS]
-    df['age'] = pd.to_numeric(df['age'], errors='coerce')
-    df.dropna()
-    # we want only men over the age of 13 in the SC social category
-    df = df[(df['gender']=='M') & (df['age']>=13) & (df['social_cat']=='SC')]
-    df.reindex()
-    print(df.head())
 
-    # remove from memory, since it takes up a lot of RAM
-    del df0
-    # save the clean version to disk for safe keeping
-    # with open('output/trimmed_secc.csv', 'w+') as outfile:
-    #     outfile.write(df.to_csv(index=False))
-    
-    # now we're ready for some matching
-    print('Beginning matching between {} and {}...'.format(secc_path, mahadalit_path))
+# splits df into a dict of upper case district name -> dataframe
+def partition_by_district(df):
+    keys = df['district'].astype(str).str.upper()
+    return dict([(district, frame.reset_index(drop=True)) for district, frame in df.groupby(keys)])
 
-    # get district from file name
+
+# the file name a district's partition gets in the SECC store
+def partition_file(district):
+    return re.sub(r'[^A-Z0-9_\-]', '_', district.upper()) + '.feather'
+
+
+# writes the output of load_secc to directory as one uncompressed feather
+# file per district (so one district is read without the others), plus
+# store.json with the district list and the state-wide unique tehsil and
+# panchayat values the base comparison uses
+def write_secc_store(df, directory, source=''):
+    if feather is None:
+        raise ImportError('pyarrow is needed for the SECC store')
+    os.makedirs(directory, exist_ok=True)
+    meta = {
+        'source': source,
+        'districts': {},
+        'tehsil': list(df.tehsil.unique()),
+        'panchayat': list(df.panchayat.unique())
+    }
+    parts = partition_by_district(df)
+    for district in sorted(parts):
+        frame = parts[district]
+        feather.write_feather(frame, os.path.join(directory, partition_file(district)), compression='uncompressed')
+        meta['districts'][district] = {'file': partition_file(district), 'rows': len(frame)}
+    with open(os.path.join(directory, 'store.json'), 'w', encoding='utf-8') as outfile:
+        json.dump(meta, outfile, ensure_ascii=False, default=str)
+    return meta
+
+
+# returns the store.json of the SECC store in directory
+def load_secc_meta(directory):
+    with open(os.path.join(directory, 'store.json'), 'r', encoding='utf-8') as infile:
+        return json.load(infile)
+
+
+# reads the partition of one district out of the SECC store in directory.
+# The file is memory-mapped, but to_pandas still copies it, so this costs
+# the district's size in memory (not the state's). Returns an empty
+# dataframe if the district isn't in the store
+def load_secc_partition(directory, district, meta=None):
+    global USEFUL_COLUMNS
+
+    if feather is None:
+        raise ImportError('pyarrow is needed for the SECC store')
+    meta = load_secc_meta(directory) if meta is None else meta
+    entry = meta['districts'].get(district.upper())
+    if entry is None:
+        return pd.DataFrame(columns=USEFUL_COLUMNS)
+    return feather.read_table(os.path.join(directory, entry['file']), memory_map=True).to_pandas()
+
+
+# returns how similar two lists are
+def get_similarity(l1, l2):
+    return SequenceMatcher(None, l1, l2).ratio()
+
+
+# figures out the district from the name of a mahadalit census file
+def district_from_path(mahadalit_path):
     match_full_path = re.compile(r'\/(.+\/)*(.+)\.(.+)$') # if the full path was passed
     match_file_name = re.compile(r'([a-zA-Z0-9_\'"\-+$%#@()!]+)\.csv') # if it's a local file
 
     m = re.search(match_full_path, mahadalit_path)
-    district_name = ''
     if m:
-        district_name = m.group(2)
+        return m.group(2)
+    m = re.match(match_file_name, mahadalit_path)
+    if m:
+        return m.group(1)
+    raise Exception('Mahdalit cenus path invalid!')
+
+
+def main(secc_path, mahadalit_path, sample_size=100, translit_cache=None, secc_store=None):
+    if translit_cache is not None:
+        load_translit_cache(translit_cache)
+
+    # get district from file name
+    district_name = district_from_path(mahadalit_path)
+
+    if secc_store is not None:
+        # only this district's partition gets loaded
+        meta = load_secc_meta(secc_store)
+        df_district = load_secc_partition(secc_store, district_name, meta)
+        secc_tehsils = np.array(meta['tehsil'], dtype=object)
+        secc_panchayats = np.array(meta['panchayat'], dtype=object)
+        print(df_district.head())
     else:
-        m = re.match(match_file_name, mahadalit_path)
-        if m:
-            district_name = m.group(1)
-        else:
-            raise Exception('Mahdalit cenus path invalid!')
+        # only the columns and rows we need ever make it into memory
+        df = load_secc(secc_path)
+        print(df.head())
+        # get all the entries of this district
+        df_district = df[df['district'].str.upper() == district_name.upper()]
+        secc_tehsils = df.tehsil.unique()
+        secc_panchayats = df.panchayat.unique()
+
+    # save the clean version to disk for safe keeping
+    # with open('output/trimmed_secc.csv', 'w+') as outfile:
+    #     outfile.write(df.to_csv(index=False))
     
-    print('Working with district {}!'.format(district_name))
+    # now we're ready for some matching
+    print('Beginning matching between {} and {}...'.format(secc_path if secc_store is None else secc_store, mahadalit_path))
+    match_district(df_district, secc_tehsils, secc_panchayats, mahadalit_path, district_name, sample_size)
 
+    if translit_cache is not None:
+        save_translit_cache(translit_cache)
 
-    # get all the entries of this district
-    df_district = df[df['district'].str.upper() == district_name.upper()]
+
+# compares one district of the mahadalit census with its SECC rows and
+# writes output/base_comparison_[district].csv and
+# output/sample_match_[district].csv. Returns a summary dictionary
+def match_district(df_district, secc_tehsils, secc_panchayats, mahadalit_path, district_name, sample_size=100):
+    global USEFUL_COLUMNS2
+
+    print('Working with district {}!'.format(district_name))
 
     mdf0 = pd.read_csv(mahadalit_path,
         error_bad_lines=False,
@@ -121,16 +380,18 @@ def main(secc_path, mahadalit_path):
     mdf0.dropna()
 
     print('Comparing blocks...')
+    block_similarity = get_similarity(secc_tehsils, mdf0.block.unique())
     block_cmp = 'block,{},{},{}'.format( 
-        df.tehsil.unique(),
+        secc_tehsils,
         mdf0.block.unique(),
-        get_similarity(df.tehsil.unique(), mdf0.block.unique()))
+        block_similarity)
     block_cmp = block_cmp.replace('\n', '')
     print('Comparing panchayat...')
+    panchayat_similarity = get_similarity(secc_panchayats, mdf0.panchayat_nagar.unique())
     panchayat_cmp = 'panchayat,{},{},{}'.format(
-        df.panchayat.unique(),
+        secc_panchayats,
         mdf0.panchayat_nagar.unique(),
-        get_similarity(df.panchayat.unique(), mdf0.panchayat_nagar.unique()))
+        panchayat_similarity)
     panchayat_cmp = panchayat_cmp.replace('\n', '')
     print('Returning comparison...')
 
@@ -143,33 +404,134 @@ def main(secc_path, mahadalit_path):
     del mdf0
 
     # get a sample from the secc data and try to find them in the census
-    mdf_sample = mdf.sample(n=100)
+    # (or the whole file if sample_size isn't positive)
+    mdf_sample = mdf.sample(n=sample_size) if 0 < sample_size < len(mdf) else mdf
+
+    print('Indexing {} SECC rows...'.format(len(df_district)))
+    index = CandidateIndex(df_district)
 
     # if district, age, and head of household match, we'll call it a match
+    matches = 0
     with open('output/sample_match_{}.csv'.format(district_name), 'w') as outfile:
         outfile.write('sample#,match_found,father_name,\n')
         i = 0
-        for row in mdf_sample.iterrows():
-            # find age matches
-            age_matches = df_district[df_district['age'] == row[1]['age']]
-            potential_match = False
-            secc_name = ''
-            # find a head of household that matches
-            for arow in age_matches.iterrows():
-                if are_similar(translit_and_format_name(arow[1]['head_of_hh']), translit_and_format_name(row[1]['name_hoh'])):
-                    potential_match = True
-                    secc_name = translit_and_format_name(arow[1]['fathers_and_mothers_name'])
-                    break      
-            if potential_match:
-                outfile.write('{},1,{},\n'.format(i, secc_name))
+        for age, name_hoh in zip(mdf_sample['age'].tolist(), mdf_sample['name_hoh'].tolist()):
+            match = index.find(age, translit_and_format_name(name_hoh))
+            if match is not None:
+                outfile.write('{},1,{},\n'.format(i, translit_and_format_name(match[1])))
+                matches += 1
             else:
-                outfile.write('{},0,{},\n'.format(i, secc_name))
+                outfile.write('{},0,,\n'.format(i))
             i += 1
 
+    return {
+        'district': district_name,
+        'secc_rows': len(df_district),
+        'census_rows': len(mdf),
+        'matched_rows': len(mdf_sample),
+        'matches': matches,
+        'match_ratio': matches / len(mdf_sample) if len(mdf_sample) > 0 else 0,
+        'block_similarity': block_similarity,
+        'panchayat_similarity': panchayat_similarity
+    }
+
+
+# what the batch workers share. Set in the parent before the pool forks,
+# so the SECC frame is inherited by every worker instead of copied to it
+_SHARED = {}
+
+
+# runs in a worker: matches one mahadalit census file
+def match_worker(mahadalit_path):
+    global _SHARED
+    global TRANSLIT_STORE
+
+    district_name = district_from_path(mahadalit_path)
+    if _SHARED['store'] is not None:
+        df_district = load_secc_partition(_SHARED['store'], district_name, _SHARED['meta'])
+    else:
+        df_district = _SHARED['parts'].get(district_name.upper())
+        if df_district is None:
+            df_district = pd.DataFrame(columns=USEFUL_COLUMNS)
+    summary = match_district(df_district, _SHARED['tehsils'], _SHARED['panchayats'],
+        mahadalit_path, district_name, _SHARED['sample_size'])
+    # new transliterations go back to the parent to be saved
+    new_names = []
+    if TRANSLIT_STORE is not None:
+        new_names = list(TRANSLIT_STORE.items())[_SHARED['translit_known']:]
+        _SHARED['translit_known'] = len(TRANSLIT_STORE)
+    return summary, new_names
+
+
+# matches every district file in mahadalit_folder on jobs worker processes
+# and writes output/match_summary.csv on top of the per district outputs
+def main_folder(secc_path, mahadalit_folder, sample_size=100, translit_cache=None, secc_store=None, jobs=0):
+    global _SHARED
+
+    if translit_cache is not None:
+        load_translit_cache(translit_cache)
+
+    paths = [os.path.join(mahadalit_folder, f) for f in sorted(os.listdir(mahadalit_folder))
+        if os.path.isfile(os.path.join(mahadalit_folder, f)) and f.endswith('.csv') and 'lock' not in f]
+
+    _SHARED = {
+        'store': secc_store,
+        'sample_size': sample_size,
+        'translit_known': len(TRANSLIT_STORE) if TRANSLIT_STORE is not None else 0
+    }
+    if secc_store is not None:
+        _SHARED['meta'] = load_secc_meta(secc_store)
+        _SHARED['tehsils'] = np.array(_SHARED['meta']['tehsil'], dtype=object)
+        _SHARED['panchayats'] = np.array(_SHARED['meta']['panchayat'], dtype=object)
+    else:
+        df = load_secc(secc_path)
+        _SHARED['tehsils'] = df.tehsil.unique()
+        _SHARED['panchayats'] = df.panchayat.unique()
+        _SHARED['parts'] = partition_by_district(df)
+        del df
+
+    jobs = os.cpu_count() if jobs <= 0 else jobs
+    print('Matching {} districts with {} worker(s)...'.format(len(paths), jobs))
+    # fork shares the parent's memory, other start methods would pickle _SHARED
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    summaries = []
+    with context.Pool(jobs, initializer=_init_worker, initargs=(_SHARED,)) as pool:
+        for summary, new_names in pool.imap_unordered(match_worker, paths, chunksize=1):
+            summaries.append(summary)
+            if TRANSLIT_STORE is not None:
+                TRANSLIT_STORE.update(new_names)
+            print('Finished {} ({} of {})'.format(summary['district'], len(summaries), len(paths)))
+
+    summaries.sort(key=lambda summary: summary['district'])
+    pd.DataFrame(summaries).to_csv('output/match_summary.csv', index=False)
+
+    if translit_cache is not None:
+        save_translit_cache(translit_cache)
+
+
+# with fork this is a no-op (the worker already has _SHARED), otherwise it
+# receives a pickled copy
+def _init_worker(shared):
+    global _SHARED
+    _SHARED = shared
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Match SECC data to Mahadalit Census.')
-    parser.add_argument('--secc_path', help='Path to secc csv.', required=True)
-    parser.add_argument('--mahadalit_path', help='Path to census data.', required=True)
+    parser.add_argument('--secc_path', help='Path to secc csv.')
+    parser.add_argument('--secc_store', help='Path to a SECC store made by ingest_secc.py (instead of --secc_path).')
+    parser.add_argument('--mahadalit_path', help='Path to census data.')
+    parser.add_argument('--mahadalit_folder', help='Folder of census data, one file per district (instead of --mahadalit_path).')
+    parser.add_argument('--jobs', type=int, default=0, help='Worker processes for --mahadalit_folder (defaults to one per core).')
+    parser.add_argument('--sample', type=int, default=100, help='How many census rows to match (0 for all of them).')
+    parser.add_argument('--translit_cache', help='JSON file to keep transliterated names in between runs.')
     args = parser.parse_args()
-    main(args.secc_path, args.mahadalit_path)
+    if args.secc_path is None and args.secc_store is None:
+        parser.error('one of --secc_path or --secc_store is required')
+    if args.mahadalit_folder is not None:
+        main_folder(args.secc_path, args.mahadalit_folder, args.sample, args.translit_cache, args.secc_store, args.jobs)
+    elif args.mahadalit_path is not None:
+        main(args.secc_path, args.mahadalit_path, args.sample, args.translit_cache, args.secc_store)
+    else:
+        parser.error('one of --mahadalit_path or --mahadalit_folder is required')
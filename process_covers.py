@@ -1,14 +1,39 @@
+from contextlib import closing
+from result_cache import ResultCache, hashFile
+from functools import partial
 import pypdf_ocr
 import argparse
 import shutil
 import errno
-import json
 import csv
 import sys
 import os
 import re
 
 MAX_PARTS = 999
+# bump whenever a change to the code (not the settings) changes the output,
+# so the result cache doesn't hand back rows from the old code
+PIPELINE_VERSION = 4
+
+# where the numbers/words we OCR separately live on a 300 dpi cover page
+# (see pypdf_ocr.COVER_CROP_BOXES), moved onto every cover with --register
+CROP_BOXES = pypdf_ocr.COVER_CROP_BOXES
+# (language, psm, clist) every crop of CROP_BOXES gets OCR'd with
+CROP_OCR = [('eng', 8, 'tessedit_char_whitelist=0123456789')] * 8 + \
+    [('hin', 8, 'tessedit_char_blacklist=॥._')] * 2
+# layout mode (see crops_from_layout): the label right before every crop
+# (None for the numbers at the bottom), how far (in pixels at 300 dpi) words
+# can stick out of a box, how far a label can be from where its crop is and
+# the widest gap between the words of one value
+CROP_LABELS = [None] * 6 + ['संख्या', 'कोड', 'डाकघर', 'जिला']
+LAYOUT_PADDING = 10
+LAYOUT_LABEL_DISTANCE = 150
+LAYOUT_LABEL_GAP = 120
+DEVANAGARI_DIGITS = str.maketrans('०१२३४५६७८९', '0123456789')
+# region of interest mode (see process_cover_regions): the dpi the full page
+# is rendered at for the hindi text, and the dpi every crop is rendered at
+ROI_PAGE_DPI = 200
+ROI_CROP_DPI = [400] * 8 + [300] * 2
 
 def is_between(start, x, end):
     return (x >= start) and (x <= end)
@@ -22,59 +47,309 @@ def foldImages(list_of_images):
     return res
 
 
+# matches [naming]No_xxxPartNo_xxx.pdf, group 1 is the AC and group 2 the part.
+# If AC is given only that AC's files match
+def cover_regex(naming, AC=None):
+    ac = r'(\d{3})' if AC is None else r'(' + str(AC).zfill(3) + r')'
+    return re.compile(naming + r'No_' + ac + r'PartNo_(\d{3}).pdf')
+
+
+# finds every cover pdf of an AC in directory, in the order os.walk finds them
+def find_covers(naming, directory, AC, part_start=0, part_end=MAX_PARTS):
+    regex = cover_regex(naming, AC)
+    res = []
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            m = regex.match(f)
+            if m and is_between(part_start, int(m.group(2)), part_end):
+                res.append(os.path.join(root, f))
+    return res
+
+
+# the (x, y, w, h, language, psm, clist) regions pypdf_ocr.extractRegionsText wants
+def crop_regions(boxes):
+    global CROP_OCR
+
+    res = []
+    for i in range(len(boxes['x'])):
+        res.append((boxes['x'][i], boxes['y'][i], boxes['w'][i], boxes['h'][i]) + CROP_OCR[i])
+    return res
+
+
+# turns the OCR'd text of one cover and its crops into a row of the output
+def build_cover_dict(cover_text, crops, path):
+    page1 = pypdf_ocr.extractPage1(cover_text)
+    page1['Sanity'] = crops[0:6]
+    page1['Part'] = crops[6]
+    page1['Zip Code'] = crops[7]
+    page1['Post Office'] = crops[8]
+    page1['District'] = crops[9]
+    return set_file_name(page1, path)
+
+
+# the file name wins over the OCR'd part number
+def set_file_name(page1, path):
+    page1['File Name'] = path
+    match = re.search(r'PartNo_(\d{3})', path)
+    if match:
+        if int(match.group(1)) != page1['Part']:
+            page1['Part'] = int(match.group(1))
+    return page1
+
+
+# everything that changes what a cover turns into, for the result cache
+def pipeline_config(in_memory=False, backend=None, roi=False, preprocess=None, register=None, layout=False):
+    global PIPELINE_VERSION
+    global CROP_BOXES
+    global CROP_OCR
+    global ROI_PAGE_DPI
+    global ROI_CROP_DPI
+
+    config = {
+        'version': PIPELINE_VERSION,
+        'in_memory': in_memory,
+        'backend': pypdf_ocr.getOCRBackend(backend).name,
+        'crop_boxes': CROP_BOXES,
+        'crop_ocr': CROP_OCR
+    }
+    if roi:
+        config['roi'] = {'page_dpi': ROI_PAGE_DPI, 'crop_dpi': ROI_CROP_DPI, 'embedded': pypdf_ocr.EMBEDDED_IMAGES}
+    if preprocess is not None:
+        config['preprocess'] = preprocess.config()
+    if register is not None:
+        config['register'] = hashFile(register)
+    if layout:
+        config['layout'] = {'labels': CROP_LABELS, 'padding': LAYOUT_PADDING,
+            'distance': LAYOUT_LABEL_DISTANCE, 'gap': LAYOUT_LABEL_GAP}
+    return config
+
+
+# the PageRegistration for the template cover at path (an image, or a pdf
+# whose first page gets rendered) that CROP_BOXES line up with
+def load_registration(path):
+    if path.lower().endswith('.pdf'):
+        with closing(pypdf_ocr.iterImagePages(path, 1)) as pages:
+            for template in pages:
+                return pypdf_ocr.PageRegistration(template)
+    with pypdf_ocr.Image.open(path) as template:
+        return pypdf_ocr.PageRegistration(template)
+
+
+# CROP_BOXES where they are on cover, see load_registration
+def cover_boxes(cover, registration=None):
+    global CROP_BOXES
+
+    return CROP_BOXES if registration is None else registration.boxes(cover, CROP_BOXES)
+
+
+# the crop value in text if it looks like one: only digits for the number
+# crops (CROP_OCR whitelists digits) and some hindi for the others
+def clean_crop(text, region):
+    global DEVANAGARI_DIGITS
+
+    text = text.translate(DEVANAGARI_DIGITS).strip(' :;.,-_|।॥')
+    if 'whitelist=0123456789' in region[6]:
+        return text if text.isdigit() and text.isascii() else None
+    return text if re.search(r'[\u0900-\u097F]', text) else None
+
+
+# reads every crop of regions off the layout of the full page (see
+# pypdf_ocr.extractLayout): the words inside the box, or if that isn't a
+# value, the words after the crop's label in CROP_LABELS closest to the box.
+# Crops that can't be found are None
+def crops_from_layout(layout, regions, scale=1.0):
+    global CROP_LABELS
+    global LAYOUT_PADDING
+    global LAYOUT_LABEL_DISTANCE
+    global LAYOUT_LABEL_GAP
+
+    res = []
+    for region, label in zip(regions, CROP_LABELS):
+        x, y, w, h = region[0:4]
+        text = clean_crop(pypdf_ocr.layoutWordsInBox(layout, (x, y, w, h), LAYOUT_PADDING * scale), region)
+        if text is None and label is not None:
+            text = clean_crop(pypdf_ocr.layoutWordsAfterLabel(layout, label, y + h / 2,
+                LAYOUT_LABEL_DISTANCE * scale, LAYOUT_LABEL_GAP * scale), region)
+        res.append(text)
+    return res
+
+
+# OCRs a cover page that's already in memory, no images or text get dumped.
+# With a pypdf_ocr.Preprocessor the page is preprocessed once for everything
+# and the crops are cut from the preprocessed page: registered on it, or
+# CROP_BOXES moved along with the deskew and scale (see Preprocessor.mapBox).
+# With layout the full page pass keeps every word's box and the crops are
+# read off it (see crops_from_layout), only the ones that can't be found
+# get OCR'd on their own
+def process_cover(cover, path, backend=None, preprocess=None, registration=None, layout=False):
+    scale = 1.0
+    if preprocess is not None:
+        cover = preprocess(cover)
+        scale = preprocess.scale
+    regions = crop_regions(cover_boxes(cover, registration))
+    if preprocess is not None and registration is None:
+        regions = [preprocess.mapBox(region[0:4], cover) + region[4:7] for region in regions]
+    if not layout:
+        crop_text = pypdf_ocr.extractRegionsText(cover, regions, backend)
+        cover_text = pypdf_ocr.extractTextFromImages([cover], language='hin', psm=4,
+            clist='tessedit_char_blacklist=॥', backend=backend)[0]
+        return build_cover_dict(cover_text, pypdf_ocr.parseCropped(crop_text), path)
+
+    words = pypdf_ocr.extractLayout(cover, language='hin', psm=4,
+        clist='tessedit_char_blacklist=॥', backend=backend)
+    crop_text = crops_from_layout(words, regions, scale)
+    missing = [i for i in range(len(crop_text)) if crop_text[i] is None]
+    if len(missing) > 0:
+        texts = pypdf_ocr.extractRegionsText(cover, [regions[i] for i in missing], backend)
+        for i, text in zip(missing, texts):
+            crop_text[i] = text
+    return build_cover_dict(pypdf_ocr.layoutText(words), pypdf_ocr.parseCropped(crop_text), path)
+
+
+# rasterizes the cover of the pdf at path and OCRs it in memory
+def process_cover_file(path, backend=None, preprocess=None, registration=None, layout=False):
+    with closing(pypdf_ocr.iterImagePages(path, 1)) as pages:
+        for cover in pages:
+            return process_cover(cover, path, backend, preprocess, registration, layout)
+
+
+# renders the cover of the pdf at path piece by piece instead of as one 300
+# dpi page: the full page at ROI_PAGE_DPI for the hindi text and only bands
+# of nearby CROP_BOXES at ROI_CROP_DPI for the crops (see
+# pypdf_ocr.planRegionBands). A scanned cover is taken out of the pdf once
+# instead (see pypdf_ocr.getEmbeddedPage), scaled down for the page and
+# every crop resized to its ROI_CROP_DPI. Only the page text is deskewed,
+# the crops are cut from the page as stored, so that's what gets registered
+def process_cover_regions(path, backend=None, preprocess=None, registration=None):
+    global ROI_PAGE_DPI
+    global ROI_CROP_DPI
+
+    scan = pypdf_ocr.getEmbeddedPage(path)
+    if scan is not None:
+        scale = ROI_PAGE_DPI / pypdf_ocr.RASTER_DPI
+        cover = scan.resize((round(scan.size[0] * scale), round(scan.size[1] * scale)), pypdf_ocr.Image.BOX)
+    else:
+        cover = pypdf_ocr.renderRegion(path, ROI_PAGE_DPI)
+    # registered on the low dpi page, the crops want 300 dpi boxes
+    boxes = cover_boxes(cover, registration)
+    scale = pypdf_ocr.RASTER_DPI / ROI_PAGE_DPI
+    if registration is not None:
+        boxes = dict([(key, [int(round(v * scale)) for v in values]) for key, values in boxes.items()])
+    if scan is not None:
+        crop_text = pypdf_ocr.extractRegionsTextAtDpi(scan, crop_regions(boxes), ROI_CROP_DPI,
+            backend=backend, preprocess=preprocess)
+        scan.close()
+    else:
+        crop_text = pypdf_ocr.extractRegionsTextFromPdf(path, crop_regions(boxes), ROI_CROP_DPI,
+            backend=backend, preprocess=preprocess, embedded=False)
+    cover_text = pypdf_ocr.extractTextFromImages([cover], language='hin', psm=4,
+        clist='tessedit_char_blacklist=॥', backend=backend, preprocess=preprocess)[0]
+    cover.close()
+    return build_cover_dict(cover_text, pypdf_ocr.parseCropped(crop_text), path)
+
+
 # processess all cover pages with the format
 # [naming]No_0ACPartNo_0xx.pdf
 # If max_part is 0, it will search for all
 # files that fit this format. Otherwise, it
 # will process at most X many 
-def main(naming, directory, AC, part_start=0, part_end=MAX_PARTS, instance=0):
+def main(naming, directory, AC, part_start=0, part_end=MAX_PARTS, instance=0, in_memory=False, workers=1, backend=None, cache_dir=None, roi=False, preprocess=None, register=None, layout=False):
     if not os.path.exists(directory):
         raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), directory)
 
+    directory = os.getcwd() if directory == '' else directory
+    covers = find_covers(naming, directory, AC, part_start, part_end)
+    # region of interest and layout mode never touch the disk either, and
+    # the cache key has to say so (batch_covers.py is always in memory)
+    in_memory = in_memory or roi or layout
+    # before the backend gets made by pipeline_config
+    pypdf_ocr.setTesseractThreads(workers)
+    cache = ResultCache(cache_dir, pipeline_config(in_memory, backend, roi, preprocess, register, layout)) if cache_dir is not None else None
+    registration = load_registration(register) if register is not None else None
+
+    with open('output/output{}.csv'.format(AC), 'w+') as csv_out:
+        dict_writer = None
+        # rows get written (and flushed) as soon as they're done
+        def write_row(page1):
+            nonlocal dict_writer
+            if dict_writer is None:
+                dict_writer = csv.DictWriter(csv_out, page1.keys())
+                dict_writer.writeheader()
+            dict_writer.writerow(page1)
+            csv_out.flush()
+
+        todo = []
+        for path in covers:
+            cached = cache.get(path) if cache is not None else None
+            if cached is not None:
+                write_row(set_file_name(cached, path))
+            else:
+                todo.append(path)
+        if cache is not None:
+            print('({}) {} of {} covers cached'.format(instance, len(covers) - len(todo), len(covers)))
+
+        if in_memory:
+            print('({}) Doing OCR in memory with {} worker(s)'.format(instance, workers), end='')
+            if roi:
+                process = partial(process_cover_regions, backend=backend, preprocess=preprocess, registration=registration)
+            else:
+                process = partial(process_cover_file, backend=backend, preprocess=preprocess, registration=registration, layout=layout)
+            results = pypdf_ocr.parallelMap(process, todo, workers)
+        else:
+            results = process_covers_on_disk(todo, instance, workers, backend, preprocess, registration) if len(todo) > 0 else []
+        for path, page1 in zip(todo, results):
+            if in_memory:
+                print('.', end='')
+            if cache is not None:
+                cache.put(path, page1)
+            write_row(page1)
+        if in_memory:
+            print('\nOCR done!')
+
+    print('Done!')
+
+
+# the original pipeline: every cover and crop is dumped to disk as a JPEG
+# and every OCR result as a text file before the regex pass. Covers go
+# through it workers at a time and the rows of every batch are yielded as
+# soon as it's done, so main writes and caches them before the next batch
+def process_covers_on_disk(covers, instance=0, workers=1, backend=None, preprocess=None, registration=None):
+    batch = max(workers, 1)
+    for i in range(0, len(covers), batch):
+        yield from process_cover_batch_on_disk(covers[i:i + batch], instance, workers, backend, preprocess, registration)
+
+
+# one batch of process_covers_on_disk, returns a row per cover
+def process_cover_batch_on_disk(covers, instance=0, workers=1, backend=None, preprocess=None, registration=None):
     images_dir = 'images' if instance == 0 else 'images{}'.format(instance)
     plaintext_dir = 'plaintext' if instance == 0 else 'plaintext{}'.format(instance)
 
-    regex = re.compile(naming + r'No_' + str(AC).zfill(3) + r'PartNo_(\d{3}).pdf')
-    directory = os.getcwd() if directory == '' else directory
-
     i = 0
-    f_array = []
     print('Dumping images', end='')
-    for root, dirs, files in os.walk(directory):
-        for f in files:
-            m = regex.match(f)
-            if m and is_between(part_start, int(m.group(1)), part_end):
-                print('.', end='')
-                img = pypdf_ocr.getImagePages(os.path.join(root, f), 1)
-                f_array.append(img['file'])
-                pypdf_ocr.dumpImagePages(img, naming='hin-covers', start=i, directory=images_dir)
-                pypdf_ocr.cleanupImageOutput(img)
-                i += 1
+    for path in covers:
+        print('.', end='')
+        with closing(pypdf_ocr.iterImagePages(path, 1)) as cover:
+            pypdf_ocr.dumpImagePages(cover, naming='hin-covers', start=i, directory=images_dir)
+        i += 1
 
     print('\nImages dumped!')
 
     imagesFolded = {
         'tempdir': None,
         'images': [],
-        'files': f_array
+        'files': covers
     }
 
     print('Reading images to array...')
     imagesFolded['images'] = pypdf_ocr.loadImagesToArray(naming='hin-covers', directory=images_dir)
     print('Images read!')
 
-    vals = {
-        'x': [246, 656, 1022, 1384, 1713, 2090, 2242, 1812, 1800, 1804],
-        'y': [3048, 3048, 3097, 3097, 3097, 3097, 238, 2158, 1602, 2092],
-        'w': [60, 104, 80, 80, 109, 109, 96, 186, 280, 330],
-        'h': [60, 48, 37, 37, 39, 39, 96, 78, 74, 72]
-    }
-    
     i = 0
     print('Cropping images', end='')
     for j in range(len(imagesFolded['images'])):
         print('.', end='')
         copy = imagesFolded['images'][j].copy()
+        vals = cover_boxes(copy, registration)
         for k in range(10):        
             pypdf_ocr.generateCropped(copy, i + k, 
                 vals['x'][k],
@@ -88,56 +363,70 @@ def main(naming, directory, AC, part_start=0, part_end=MAX_PARTS, instance=0):
     print('({}) Doing OCR...'.format(instance))
     # just extract all the cropped pages to english    
     cropped_text_pages = pypdf_ocr.extractPagesText(num_pages=len(imagesFolded['images']) * 10, naming='cropped', language='eng', psm=8,
-            clist='tessedit_char_whitelist=0123456789', directory=images_dir)
+            clist='tessedit_char_whitelist=0123456789', directory=images_dir, workers=workers, backend=backend, preprocess=preprocess)
     # loop to replace the right english attempts with hindi
     for a in range(len(imagesFolded['images'])):
         hi_crop = pypdf_ocr.extractPagesText(num_pages=2, naming='cropped', language='hin', start=10*a+8, psm=8,
-            clist='tessedit_char_blacklist=॥._', directory=images_dir)
+            clist='tessedit_char_blacklist=॥._', directory=images_dir, backend=backend, preprocess=preprocess)
         cropped_text_pages[10*a+8]   = hi_crop[0]
         cropped_text_pages[10*a+8+1] = hi_crop[1]
     
     covers_text_pages = pypdf_ocr.extractPagesText(num_pages=len(imagesFolded['images']), naming='hin-covers', language='hin', psm=4,
-        clist='tessedit_char_blacklist=॥', directory=images_dir)
+        clist='tessedit_char_blacklist=॥', directory=images_dir, workers=workers, backend=backend, preprocess=preprocess)
     
     pypdf_ocr.dumpTextPages(pages=covers_text_pages, naming='hin-covers', directory=plaintext_dir)
     pypdf_ocr.dumpTextPages(pages=cropped_text_pages, naming='cropped', directory=plaintext_dir)
     print('({}) All OCR dumped!'.format(instance))
 
-    part_from_file = re.compile(r'PartNo_(\d{3})')
-
-    pages = []
     dicts = []
     print('Doing regex', end='')
     for j in range(len(covers_text_pages)):
         print('.', end='')
-        page = covers_text_pages[j]
-        page1 = pypdf_ocr.extractPage1(page)
         # get it because it's a bunch of crops? lol
         farm = pypdf_ocr.retreiveCropped(10, start=10*j, directory=plaintext_dir)
-        page1['Sanity'] = farm[0:6]
-        page1['Part'] = farm[6]
-        page1['Zip Code'] = farm[7]
-        page1['Post Office'] = farm[8]
-        page1['District'] = farm[9]
-        page1['File Name'] = imagesFolded['files'][j]
-        match = re.search(part_from_file, page1['File Name'])
-        if match:
-            if int(match.group(1)) != page1['Part']:
-                page1['Part'] = int(match.group(1))
-        dicts.append(page1)
-        pages.append(json.dumps(page1, ensure_ascii=False))
+        dicts.append(build_cover_dict(covers_text_pages[j], farm, imagesFolded['files'][j]))
     print('\nRegex done!')
-    
-    keys = dicts[0].keys()
-    with open('output/output{}.csv'.format(AC), 'w+') as csv_out:
-        dict_writer = csv.DictWriter(csv_out, keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(dicts)
 
     # pypdf_ocr.dumpTextPages(pages, naming='hin-covers', directory='output', extension='json')
     shutil.rmtree(images_dir + '/')
     shutil.rmtree(plaintext_dir + '/')
-    print('Done!')
+    return dicts
+
+
+# adds the options that pick how a cover gets read, shared with
+# batch_covers.py so both drivers can run the same pipeline
+def add_pipeline_arguments(parser):
+    global ROI_PAGE_DPI
+
+    parser.add_argument('--backend', choices=['tesserocr', 'pytesseract'], help='OCR backend (defaults to tesserocr if installed)')
+    parser.add_argument('--cache', type=str, metavar='dir', help='Directory to cache finished covers in, so re-runs skip them')
+    parser.add_argument('--roi', action='store_true', help='Render the page at a low dpi and only the cropped regions at a high dpi (always OCRs in memory)')
+    parser.add_argument('--page-dpi', type=int, help='DPI of the full page in --roi mode (default {})'.format(ROI_PAGE_DPI))
+    parser.add_argument('--crop-dpi', type=int, help='DPI of every cropped region in --roi mode (default 400 for numbers, 300 for words)')
+    parser.add_argument('--preprocess', choices=['gray', 'binary'], help='Convert pages to grayscale or black and white before OCR')
+    parser.add_argument('--deskew', action='store_true', help='Straighten pages before OCR (with --preprocess)')
+    parser.add_argument('--contrast', type=float, default=1.0, help='Contrast factor applied before OCR (with --preprocess)')
+    parser.add_argument('--preprocess-cache', type=str, metavar='dir', help='Directory to keep preprocessed pages in')
+    parser.add_argument('--layout', action='store_true', help='Read the cropped values off the word boxes of the full page OCR, only OCR the crops that aren\'t found (always OCRs in memory)')
+    parser.add_argument('--register', type=str, metavar='template', help='Cover (image or pdf) the crop boxes line up with, every cover gets its boxes moved to match it')
+
+
+# checks and applies the options of add_pipeline_arguments, returns the
+# pypdf_ocr.Preprocessor they ask for (or None)
+def apply_pipeline_arguments(parser, args):
+    global ROI_PAGE_DPI
+    global ROI_CROP_DPI
+    global CROP_OCR
+
+    if args.layout and args.roi:
+        parser.error('--layout and --roi can\'t be used together')
+    if args.page_dpi is not None:
+        ROI_PAGE_DPI = args.page_dpi
+    if args.crop_dpi is not None:
+        ROI_CROP_DPI = [args.crop_dpi] * len(CROP_OCR)
+    if args.preprocess is None:
+        return None
+    return pypdf_ocr.Preprocessor(args.preprocess, contrast=args.contrast, deskew=args.deskew, cache_dir=args.preprocess_cache)
 
 
 if __name__ == '__main__':
@@ -148,10 +437,14 @@ if __name__ == '__main__':
     parser.add_argument('--startpart', type=int, help='Which part number to start at')
     parser.add_argument('--endpart', type=int, help='Which part number to end at (max of 999)')
     parser.add_argument('--instance', type=int, help='Instance for parallel processing')
+    parser.add_argument('--in-memory', action='store_true', help='OCR straight from memory instead of dumping images and text to disk')
+    parser.add_argument('--workers', type=int, default=1, help='How many tesseract processes to run at once')
+    add_pipeline_arguments(parser)
 
     args = parser.parse_args()
+    preprocess = apply_pipeline_arguments(parser, args)
     real_dir = '' if args.dir is None else args.dir
     real_start = 0 if args.startpart is None else args.startpart
     real_end = MAX_PARTS if args.endpart is None else args.endpart
     real_instance = 0 if args.instance is None else args.instance
-    main(args.filename, real_dir, args.AC, real_start, real_end, real_instance)
\ No newline at end of file
+    main(args.filename, real_dir, args.AC, real_start, real_end, real_instance, args.in_memory, args.workers, args.backend, args.cache, args.roi, preprocess, args.register, args.layout)
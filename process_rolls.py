@@ -0,0 +1,360 @@
+# Turns every page of every electoral roll pdf in a directory into voter
+# records. The work runs as a pipeline of stages joined by bounded queues:
+# rasterizer threads render pages (see pypdf_ocr.iterImagePages), OCR
+# threads read each page's table once (see pypdf_ocr.extractTable1Layout)
+# and the main thread writes the records of every roll out as soon as all
+# its pages are done. Rasterizing, OCR and writing overlap, and the bounded
+# queues keep only a few pages in memory however many rolls there are.
+# A roll that can't be rendered or read is reported and left out (and out of
+# the cache) rather than stopping the run, and a CSV output that is already
+# there gets carried on with, so re-running picks up where the last run
+# stopped and retries the rolls that failed.
+
+from result_cache import ResultCache
+from contextlib import closing
+import batch_covers
+import process_covers
+import pypdf_ocr
+import threading
+import argparse
+import queue
+import sys
+import traceback
+import errno
+import csv
+import os
+
+# Optional: only needed for --format parquet
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# bump whenever a change to the code (not the settings) changes the output,
+# so the result cache doesn't hand back records from the old code
+PIPELINE_VERSION = 1
+# page 1 is the cover and page 2 the map, the voter table starts on page 3
+FIRST_TABLE_PAGE = 3
+# pages waiting on OCR / results waiting on the writer, per OCR worker
+QUEUE_FACTOR = 2
+# how often a blocked stage checks whether the pipeline was stopped
+STOP_POLL_INTERVAL = 0.1
+# records per parquet row group
+PARQUET_ROW_GROUP = 50000
+# every record, the columns of pypdf_ocr.COLUMN_NAMES1 after where it's from
+RECORD_COLUMNS = ['File Name', 'AC', 'Part', 'Page', 'Slot'] + pypdf_ocr.COLUMN_NAMES1
+# the messages the stages send the writer: the records of a page, the page
+# count of a roll after its last page, and a roll or page that failed
+PAGE = 'page'
+ROLL_DONE = 'done'
+FAILED = 'failed'
+
+
+# the configuration records get cached under (see result_cache.ResultCache)
+def pipeline_config(backend=None, preprocess=None, first_page=FIRST_TABLE_PAGE):
+    global PIPELINE_VERSION
+
+    config = {
+        'version': PIPELINE_VERSION,
+        'backend': pypdf_ocr.getOCRBackend(backend).name,
+        'first_page': first_page,
+        'dpi': pypdf_ocr.RASTER_DPI,
+        'table': {'language': pypdf_ocr.TABLE_LANGUAGE, 'psm': pypdf_ocr.TABLE_PSM, 'clist': pypdf_ocr.TABLE_CLIST,
+            'anchor': pypdf_ocr.TABLE_ANCHOR, 'anchor_next': pypdf_ocr.TABLE_ANCHOR_NEXT, 'columns': pypdf_ocr.TABLE_COLUMNS, 'rows': pypdf_ocr.TABLE_ROWS}
+    }
+    if preprocess is not None:
+        config['preprocess'] = preprocess.config()
+    return config
+
+
+# puts item on q, gives up (returns False) once stop is set
+def put_until_stopped(q, item, stop):
+    global STOP_POLL_INTERVAL
+
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=STOP_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# takes the next item off q, returns None once stop is set
+def get_until_stopped(q, stop):
+    global STOP_POLL_INTERVAL
+
+    while not stop.is_set():
+        try:
+            return q.get(timeout=STOP_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return None
+
+
+# returns the records of one page of the voter table, without empty cells
+def read_page(roll, page, image, backend=None, preprocess=None):
+    AC, part, path = roll
+    layout = pypdf_ocr.extractLayout(image, language=pypdf_ocr.TABLE_LANGUAGE, clist=pypdf_ocr.TABLE_CLIST,
+        psm=pypdf_ocr.TABLE_PSM, backend=backend, preprocess=preprocess)
+    table = pypdf_ocr.extractTable1Layout([layout])[0]
+    records = []
+    for slot, entry in enumerate(table.to_dict('records')):
+        if all([value == '' for value in entry.values()]):
+            continue
+        record = {'File Name': os.path.basename(path), 'AC': AC, 'Part': part, 'Page': page, 'Slot': slot}
+        record.update(entry)
+        # plain ints, so the records can go into the result cache
+        record['Age'] = int(entry['Age']) if entry['Age'] != '' else ''
+        records.append(record)
+    return records
+
+
+# rasterizer stage: renders every roll it takes off rolls onto pages as
+# (roll index, page number, image), then tells the writer how many pages
+# the roll had. A roll that can't be rendered is reported as FAILED and the
+# stage moves on to the next one
+def rasterize_stage(rolls, pages, results, stop, first_page=FIRST_TABLE_PAGE):
+    while not stop.is_set():
+        try:
+            i, roll = rolls.get_nowait()
+        except queue.Empty:
+            return
+        count = 0
+        try:
+            with closing(pypdf_ocr.iterImagePages(roll[2], start=first_page)) as images:
+                for image in images:
+                    if not put_until_stopped(pages, (i, first_page + count, image), stop):
+                        return
+                    count += 1
+        except Exception:
+            if not put_until_stopped(results, (FAILED, i, (None, traceback.format_exc())), stop):
+                return
+        # pages already sent still come back from OCR, so the writer needs
+        # the count of a failed roll as well
+        if not put_until_stopped(results, (ROLL_DONE, i, count), stop):
+            return
+
+
+# OCR stage: reads pages until the pipeline is stopped, puts (PAGE, roll
+# index, (page number, records)) on results, or (FAILED, roll index,
+# (page number, traceback)) for a page it couldn't read
+def ocr_stage(rolls, pages, results, stop, backend=None, preprocess=None):
+    while True:
+        item = get_until_stopped(pages, stop)
+        if item is None:
+            return
+        i, page, image = item
+        try:
+            result = (PAGE, i, (page, read_page(rolls[i], page, image, backend, preprocess)))
+        except Exception:
+            result = (FAILED, i, (page, traceback.format_exc()))
+        finally:
+            image.close()
+        if not put_until_stopped(results, result, stop):
+            return
+
+
+# writes records to a CSV file as they come in. An existing file is carried
+# on from where the last run stopped: the rolls in it (by file name) are in
+# done, except its last roll, which may have been cut off and gets cut from
+# the file to be done again
+class CsvSink:
+    def __init__(self, path):
+        self.done = set()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.done = self.resume(path)
+            self.file = open(path, 'a', newline='', encoding='utf-8')
+            self.writer = csv.DictWriter(self.file, RECORD_COLUMNS)
+        else:
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.DictWriter(self.file, RECORD_COLUMNS)
+            self.writer.writeheader()
+            self.file.flush()
+
+    @staticmethod
+    def resume(path):
+        names = set()
+        with open(path, 'r+b') as f:
+            header = f.readline()
+            if next(csv.reader([header.decode('utf-8')])) != RECORD_COLUMNS:
+                raise ValueError('{} is not the output of this script, pick another --output'.format(path))
+            last = None
+            last_start = offset = len(header)
+            for line in f:
+                name = next(csv.reader([line.decode('utf-8')]))[0]
+                if name != last:
+                    names.add(name)
+                    last, last_start = name, offset
+                offset += len(line)
+            names.discard(last)
+            f.truncate(last_start)
+        return names
+
+    def write(self, records):
+        self.writer.writerows(records)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# writes records to a parquet file, PARQUET_ROW_GROUP records at a time
+class ParquetSink:
+    def __init__(self, path):
+        fields = [pyarrow.field(name, pyarrow.string()) for name in RECORD_COLUMNS]
+        for name in ['AC', 'Part', 'Page', 'Slot', 'Age']:
+            fields[RECORD_COLUMNS.index(name)] = pyarrow.field(name, pyarrow.int32())
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.pending = []
+        # parquet can't be appended to, every run writes all of the rolls
+        self.done = set()
+
+    def write(self, records):
+        global PARQUET_ROW_GROUP
+
+        self.pending += records
+        if len(self.pending) >= PARQUET_ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        columns = {name: [record[name] for record in self.pending] for name in RECORD_COLUMNS}
+        # a missing age is '' in the table, null here
+        columns['Age'] = [None if age == '' else age for age in columns['Age']]
+        self.writer.write_table(pyarrow.Table.from_pydict(columns, schema=self.schema))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def main(naming, directory, output, fmt='csv', jobs=0, rasterizers=1, ac_start=0, ac_end=process_covers.MAX_PARTS,
+         backend=None, cache_dir=None, preprocess=None, first_page=FIRST_TABLE_PAGE):
+    global QUEUE_FACTOR
+
+    if not os.path.exists(directory):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), directory)
+    if fmt == 'parquet' and pyarrow is None:
+        raise RuntimeError('--format parquet needs pyarrow')
+
+    jobs = os.cpu_count() if jobs <= 0 else jobs
+    rolls = sorted(batch_covers.find_all_covers(naming, directory, ac_start, ac_end))
+    # before the backend gets made by pipeline_config
+    pypdf_ocr.setTesseractThreads(jobs)
+    cache = ResultCache(cache_dir, pipeline_config(backend, preprocess, first_page)) if cache_dir is not None else None
+    engine = pypdf_ocr.getOCRBackend(backend)
+
+    sink = ParquetSink(output) if fmt == 'parquet' else CsvSink(output)
+    try:
+        todo = queue.Queue()
+        for i, roll in enumerate(rolls):
+            if os.path.basename(roll[2]) in sink.done:
+                continue
+            cached = cache.get(roll[2]) if cache is not None else None
+            if cached is not None:
+                # the same pdf may have been renamed since it was cached
+                for record in cached:
+                    record.update({'File Name': os.path.basename(roll[2]), 'AC': roll[0], 'Part': roll[1]})
+                sink.write(cached)
+            else:
+                todo.put((i, roll))
+        remaining = todo.qsize()
+        print('Processing {} of {} rolls with {} OCR worker(s)'.format(remaining, len(rolls), jobs))
+        if remaining == 0:
+            return
+
+        stop = threading.Event()
+        pages = queue.Queue(maxsize=QUEUE_FACTOR * jobs)
+        results = queue.Queue(maxsize=QUEUE_FACTOR * jobs)
+        rasterize_threads = [threading.Thread(target=rasterize_stage, args=(todo, pages, results, stop, first_page), daemon=True)
+            for j in range(min(rasterizers, remaining))]
+        ocr_threads = [threading.Thread(target=ocr_stage, args=(rolls, pages, results, stop, engine, preprocess), daemon=True)
+            for j in range(jobs)]
+        for thread in rasterize_threads + ocr_threads:
+            thread.start()
+
+        # roll index -> {page: records} until all of its pages are in
+        pending = {}
+        # roll index -> pages that came back, read or failed
+        received = {}
+        page_counts = {}
+        failed = {}
+        done_rolls = 0
+        done_pages = 0
+        try:
+            while done_rolls < remaining:
+                kind, i, value = results.get()
+                if kind == ROLL_DONE:
+                    page_counts[i] = value
+                elif kind == FAILED:
+                    # a rasterizer failure (page None) isn't one of the pages
+                    # the roll's count covers
+                    page, error = value
+                    if page is not None:
+                        received[i] = received.get(i, 0) + 1
+                    if i not in failed:
+                        where = rolls[i][2] if page is None else '{} page {}'.format(rolls[i][2], page)
+                        print('\nFailed on {}, skipping the roll:\n{}'.format(where, error), file=sys.stderr)
+                        failed[i] = where
+                else:
+                    page, records = value
+                    received[i] = received.get(i, 0) + 1
+                    if i not in failed:
+                        pending.setdefault(i, {})[page] = records
+                    done_pages += 1
+                    print('\r{} pages, {}/{} rolls done'.format(done_pages, done_rolls, remaining), end='')
+                if i in page_counts and received.get(i, 0) == page_counts[i]:
+                    pages_done = pending.pop(i, {})
+                    if i not in failed:
+                        roll_records = [record for page in sorted(pages_done) for record in pages_done[page]]
+                        sink.write(roll_records)
+                        if cache is not None:
+                            cache.put(rolls[i][2], roll_records)
+                    done_rolls += 1
+                    print('\r{} pages, {}/{} rolls done'.format(done_pages, done_rolls, remaining), end='')
+            print()
+        finally:
+            stop.set()
+            for thread in rasterize_threads:
+                thread.join()
+            for thread in ocr_threads:
+                thread.join()
+        if len(failed) > 0:
+            print('{} roll(s) failed and were left out (re-running retries them):'.format(len(failed)), file=sys.stderr)
+            for i in sorted(failed):
+                print('  ' + failed[i], file=sys.stderr)
+    finally:
+        sink.close()
+    print('Wrote {}'.format(output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the voter records from every page of every Bihar electoral roll in a directory.')
+    parser.add_argument('--dir', type=str, metavar='dir', default='', help='The directory the files are stored in')
+    parser.add_argument('--filename', type=str, metavar='naming', required=True, help='The naming pattern of every roll ([naming]No_xxxPartNo_xxx.pdf)')
+    parser.add_argument('--output', type=str, metavar='file', default='output/rolls.csv', help='Where the records go (a CSV that exists gets the missing rolls added)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='Format of the output (parquet needs pyarrow)')
+    parser.add_argument('--jobs', type=int, default=0, help='How many OCR threads to run (defaults to one per core)')
+    parser.add_argument('--rasterizers', type=int, default=1, help='How many rolls get rendered at once')
+    parser.add_argument('--startac', type=int, default=0, help='Which AC number to start at')
+    parser.add_argument('--endac', type=int, default=process_covers.MAX_PARTS, help='Which AC number to end at')
+    parser.add_argument('--first-page', type=int, default=FIRST_TABLE_PAGE, help='The first page of the voter table')
+    parser.add_argument('--backend', choices=['tesserocr', 'pytesseract'], help='OCR backend (defaults to tesserocr if installed)')
+    parser.add_argument('--cache', type=str, metavar='dir', help='Directory to cache finished rolls in, so re-runs skip them')
+    parser.add_argument('--preprocess', choices=['gray', 'binary'], help='Convert pages to grayscale or black and white before OCR')
+    parser.add_argument('--deskew', action='store_true', help='Straighten pages before OCR (with --preprocess)')
+
+    args = parser.parse_args()
+    real_dir = os.getcwd() if args.dir == '' else args.dir
+    preprocess = None
+    if args.preprocess is not None:
+        preprocess = pypdf_ocr.Preprocessor(args.preprocess, deskew=args.deskew)
+    if os.path.dirname(args.output) != '':
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    main(args.filename, real_dir, args.output, args.format, args.jobs, args.rasterizers, args.startac, args.endac,
+         args.backend, args.cache, preprocess, args.first_page)
@@ -3,23 +3,127 @@
 # a token and charts of numbers will be a token as well.
 
 # Imports
-from pdf2image import convert_from_path
-from PIL import Image, ImageEnhance
+from PIL import Image, ImageEnhance, PngImagePlugin
 from PyPDF2 import PdfFileReader
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import bisect
 from enum import Enum
 import pandas as pd
+import numpy as np
 import pytesseract
+import subprocess
+import threading
+import importlib.util
 import tempfile
+import weakref
+import hashlib
+import signal
 import json
+import io
 import math
+import time
 import sys
 import os
 import re
 
+# ContentStream lives in PyPDF2.pdf before PyPDF2 2.0
+try:
+    from PyPDF2.generic import ContentStream
+except ImportError:
+    from PyPDF2.pdf import ContentStream
+
+# Optional: keeps tesseract loaded in-process between calls (see TesserocrBackend).
+# Only imported when the first TesserocrBackend is made, since loading it
+# starts OpenMP, which reads OMP_THREAD_LIMIT once (see setTesseractThreads)
+TESSEROCR_INSTALLED = importlib.util.find_spec('tesserocr') is not None
+tesserocr = None
+
 # Globals
 
 # Memory management
 OUTPUT_PAGE_LIMIT = 5
+# where pages get rendered to, None for the current working directory
+SCRATCH_DIR = None
+
+# Rasterization
+RASTER_DPI = 300
+RASTER_POLL_INTERVAL = 0.05 # seconds between checks on a running pdftoppm
+# what one more pdftoppm call (starting it and parsing the pdf) costs, in
+# rendered pixels: regions closer than that are rendered as one band (see planRegionBands)
+RASTER_BAND_CALL_PIXELS = 1000000
+RASTER_FORMATS = {
+    'ppm': ([], 'ppm'),
+    'jpeg': (['-jpeg'], 'jpg'),
+    'png': (['-png'], 'png')
+}
+
+# Scanned pages (see getEmbeddedImage)
+EMBEDDED_IMAGES = True # take the scan straight out of the pdf when a page is just one image
+# content stream operators that can't put anything but the image on the page
+EMBEDDED_PAGE_OPERATORS = {b'q', b'Q', b'cm', b'Do', b'BT', b'ET', b'Td', b'TD', b'Tm', b'T*', b'Tf',
+                           b'Tc', b'Tw', b'Tz', b'TL', b'Tr', b'Ts'}
+EMBEDDED_FILTERS = {'/DCTDecode', '/JPXDecode', '/FlateDecode'}
+EMBEDDED_COLORSPACES = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}
+# scans within this much of the asked for dpi are resized with nearest
+# neighbour (a dropped or doubled row every 1/x rows), anything else with lanczos
+EMBEDDED_NEAREST_SCALE = 0.02
+
+# OCR concurrency
+OCR_WORKERS = 1
+OCR_QUEUE_FACTOR = 2 # at most OCR_QUEUE_FACTOR * workers items in flight
+
+# OCR backend: 'tesserocr', 'pytesseract' or None for the fastest one installed
+OCR_BACKEND = None
+
+# Preprocessing (see Preprocessor)
+PREPROCESS_MAX_SKEW = 5 # degrees either way deskew looks for
+PREPROCESS_SKEW_STEP = 0.1 # degrees between the angles deskew tries
+PREPROCESS_SKEW_WIDTH = 1000 # skew is estimated on a copy scaled down to this width
+PREPROCESS_SKEW_MIN_SIZE = 400 # images smaller than this (like crops) are never deskewed
+
+# Cover pages
+# where the numbers/words that get OCR'd separately live on a 300 dpi cover
+#     0-5: the values at the bottom of the page
+#     6: part
+#     7: zip code
+#     8: post office
+#     9: district
+COVER_CROP_BOXES = {
+    'x': [246, 656, 1022, 1384, 1713, 2090, 2242, 1812, 1800, 1804],
+    'y': [3048, 3048, 3097, 3097, 3097, 3097, 238, 2158, 1602, 2092],
+    'w': [60, 104, 80, 80, 109, 109, 96, 186, 280, 330],
+    'h': [60, 48, 37, 37, 39, 39, 96, 78, 74, 72]
+}
+
+# Registration (see PageRegistration)
+REGISTER_WIDTH = 500 # pages are compared scaled down to this width
+REGISTER_MAX_SHIFT = 0.05 # furthest a page can be shifted, as a fraction of its size
+REGISTER_SCALES = [0.97 + 0.005 * i for i in range(13)] # page scales that get tried
+REGISTER_MIN_SCORE = 0.3 # correlation below this leaves the boxes alone (unrelated pages score about 0.1-0.2)
+
+# Region batching (see extractRegionsText)
+COMPOSITE_PADDING = 20 # white pixels around every crop in a composite image
+COMPOSITE_PSM = 6 # a composite is one column of crops, i.e. a uniform block of text
+
+# Layout (see extractLayout), one list per key with an entry per word
+LAYOUT_KEYS = ['text', 'left', 'top', 'width', 'height', 'conf', 'block_num', 'par_num', 'line_num']
+
+# Voter table (see layoutTableCells and extractTable1Layout)
+TABLE_LANGUAGE = 'hin+eng' # one pass reads the hindi labels and the latin voter ids
+TABLE_PSM = 3
+TABLE_CLIST = 'tessedit_char_blacklist=॥'
+TABLE_ANCHOR = 'निर्वाचक' # first word of the elector name label, once per cell
+TABLE_ANCHOR_NEXT = 'का' # and the word after it, so headers like निर्वाचक नामावली aren't anchors
+TABLE_COLUMNS = 3
+TABLE_ROWS = 10
+TABLE_COLUMN_GAP = 3 # anchors more than this many anchor widths apart are in different columns
+TABLE_ROW_GAP = 2 # anchors more than this many anchor heights apart are in different rows
+TABLE_CELL_ABOVE = 2 # a cell starts this many anchor heights above its anchor (serial number and voter id)
+TABLE_CELL_LEFT = 0.5 # and this many anchor widths left of it
+
+# Page 1 fields
+PAGE1_SINGLE_SCAN = False # extractPage1 uses FieldExtractor.scanPage1 instead of one search per field
 
 # Regular Expressions
 
@@ -77,6 +181,264 @@ class Token:
     def getData(self):
         return self.getData
 
+"""Returns a string
+
+The directory temporary page images get rendered into.
+"""
+def getScratchDir():
+    global SCRATCH_DIR
+    return os.getcwd() if SCRATCH_DIR is None else SCRATCH_DIR
+
+
+"""Returns an integer
+
+The number of pages in the PDF at path.
+"""
+def getPageCount(path):
+    with open(path, 'rb') as pdf_file:
+        return PdfFileReader(pdf_file).getNumPages()
+
+
+"""Returns a dictionary of page number to file path
+
+Looks in directory for the pages pdftoppm has written so far under prefix.
+"""
+def _listRasterizedPages(directory, prefix, extension):
+    pattern = re.compile(re.escape(prefix) + r'-(\d+)\.' + extension + '$')
+    res = {}
+    for f in os.listdir(directory):
+        m = pattern.match(f)
+        if m:
+            res[int(m.group(1))] = os.path.join(directory, f)
+    return res
+
+
+"""Returns a generator of file paths
+
+Runs a single pdftoppm process over pages first_page through last_page
+(1 indexed, inclusive) of the pdf at path, so the document is only parsed
+once, and yields the path of every page in order as soon as pdftoppm has
+finished writing it. If last_page is None, every page to the end of the
+document is rendered.
+
+Pages are written to output_folder. To keep the same memory/disk bound that
+OUTPUT_PAGE_LIMIT used to enforce per conversion call, pdftoppm is paused
+whenever more than OUTPUT_PAGE_LIMIT pages are waiting on the consumer.
+"""
+def rasterizePages(path, output_folder, first_page=1, last_page=None, dpi=RASTER_DPI, fmt='ppm'):
+    global OUTPUT_PAGE_LIMIT
+    global RASTER_FORMATS
+    global RASTER_POLL_INTERVAL
+
+    flags, extension = RASTER_FORMATS[fmt]
+    prefix = 'page'
+    args = ['pdftoppm', '-r', str(dpi), '-f', str(max(first_page, 1))]
+    if last_page is not None:
+        args += ['-l', str(last_page)]
+    args += flags + [path, os.path.join(output_folder, prefix)]
+
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=errors)
+    paused = False
+    try:
+        next_page = max(first_page, 1)
+        while True:
+            done = proc.poll() is not None
+            pages = _listRasterizedPages(output_folder, prefix, extension)
+            # the newest file may still be getting written until the next one shows up
+            newest = max(pages) if len(pages) > 0 else 0
+            ready = [p for p in sorted(pages) if p >= next_page and (done or p < newest)]
+
+            # backpressure: don't let pdftoppm run too far ahead of us
+            waiting = len([p for p in pages if p >= next_page])
+            if not done and hasattr(signal, 'SIGSTOP'):
+                if waiting > OUTPUT_PAGE_LIMIT and not paused:
+                    proc.send_signal(signal.SIGSTOP)
+                    paused = True
+                elif waiting <= OUTPUT_PAGE_LIMIT and paused:
+                    proc.send_signal(signal.SIGCONT)
+                    paused = False
+
+            for page in ready:
+                next_page = page + 1
+                yield pages[page]
+
+            if done:
+                break
+            if len(ready) == 0:
+                time.sleep(RASTER_POLL_INTERVAL)
+
+        if proc.returncode != 0:
+            errors.seek(0)
+            raise RuntimeError('pdftoppm failed on {}: {}'.format(path,
+                errors.read().decode('utf-8', 'replace').strip()))
+    finally:
+        if proc.poll() is None:
+            if paused:
+                proc.send_signal(signal.SIGCONT)
+            proc.kill()
+            proc.wait()
+        errors.close()
+
+
+"""Returns a tuple of the image XObject and its (x, y, w, h) in points, or None
+
+Looks at the content stream of page and finds the single raster image it
+draws, if that image is all it draws: one Do of an image, no text shown, no
+paths painted, no rotation, skew, masks or decode arrays, and a format
+getEmbeddedImage can read. x and y are from the top left of the crop box,
+like pixels. Nothing gets decoded.
+"""
+def findEmbeddedImage(page):
+    global EMBEDDED_PAGE_OPERATORS
+    global EMBEDDED_FILTERS
+    global EMBEDDED_COLORSPACES
+
+    if page.get('/Rotate', 0) % 360 != 0:
+        return None
+    resources = page['/Resources'].getObject() if '/Resources' in page else {}
+    xobjects = resources['/XObject'].getObject() if '/XObject' in resources else {}
+    try:
+        operations = ContentStream(page.getContents(), page.pdf).operations
+    except Exception:
+        return None
+
+    ctm = [1, 0, 0, 1, 0, 0]
+    stack = []
+    found = None
+    for operands, operator in operations:
+        if operator not in EMBEDDED_PAGE_OPERATORS:
+            return None
+        if operator == b'q':
+            stack.append(ctm)
+        elif operator == b'Q':
+            ctm = stack.pop() if len(stack) > 0 else ctm
+        elif operator == b'cm':
+            a, b, c, d, e, f = [float(x) for x in operands]
+            ctm = [a * ctm[0] + b * ctm[2], a * ctm[1] + b * ctm[3],
+                   c * ctm[0] + d * ctm[2], c * ctm[1] + d * ctm[3],
+                   e * ctm[0] + f * ctm[2] + ctm[4], e * ctm[1] + f * ctm[3] + ctm[5]]
+        elif operator == b'Do':
+            if found is not None or operands[0] not in xobjects:
+                return None
+            found = (xobjects[operands[0]].getObject(), ctm)
+    if found is None:
+        return None
+
+    image, (a, b, c, d, e, f) = found
+    filters = image.get('/Filter', [])
+    filters = [filters] if not isinstance(filters, list) else filters
+    if image.get('/Subtype') != '/Image' or b != 0 or c != 0 or a <= 0 or d <= 0 \
+            or len(filters) != 1 or filters[0] not in EMBEDDED_FILTERS \
+            or image.get('/ColorSpace') not in EMBEDDED_COLORSPACES or image.get('/BitsPerComponent') != 8 \
+            or image.get('/ImageMask', False) or '/SMask' in image or '/Mask' in image or '/Decode' in image:
+        return None
+    box = page.cropBox
+    return image, (e - float(box.getLowerLeft_x()), float(box.getUpperRight_y()) - (f + d), a, d)
+
+
+"""Returns a PIL Image object or None
+
+The page the way pdftoppm would render it at dpi, but taken straight from
+the scan stored in the pdf (see findEmbeddedImage) instead of rendering it.
+JPEGs are handed to PIL as they are stored. The scan is only resized when
+its resolution isn't dpi already, and only pasted onto a white page when it
+doesn't cover the whole page. Returns None if page isn't a single scan.
+"""
+def getEmbeddedImage(page, dpi=RASTER_DPI):
+    global EMBEDDED_COLORSPACES
+    global EMBEDDED_NEAREST_SCALE
+
+    found = findEmbeddedImage(page)
+    if found is None:
+        return None
+    image, (x, y, w, h) = found
+    filters = image['/Filter']
+    filters = filters[0] if isinstance(filters, list) else filters
+    try:
+        if filters == '/FlateDecode':
+            img = Image.frombytes(EMBEDDED_COLORSPACES[image['/ColorSpace']],
+                (image['/Width'], image['/Height']), image.getData())
+        else:
+            img = Image.open(io.BytesIO(image._data))
+            img.load()
+    except Exception:
+        return None
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    scale = dpi / 72
+    box = page.cropBox
+    width = math.ceil(float(box.getWidth()) * scale)
+    height = math.ceil(float(box.getHeight()) * scale)
+    left, top = round(x * scale), round(y * scale)
+    size = (round(w * scale), round(h * scale))
+    if abs(size[0] - img.size[0]) > 1 or abs(size[1] - img.size[1]) > 1:
+        close = abs(size[0] / img.size[0] - 1) <= EMBEDDED_NEAREST_SCALE and abs(size[1] / img.size[1] - 1) <= EMBEDDED_NEAREST_SCALE
+        img = img.resize(size, Image.NEAREST if close else Image.LANCZOS)
+    if left == 0 and top == 0 and abs(img.size[0] - width) <= 1 and abs(img.size[1] - height) <= 1:
+        return img
+    background = 255 if img.mode == 'L' else (255, 255, 255)
+    res = Image.new(img.mode, (width, height), background)
+    res.paste(img, (left, top))
+    img.close()
+    return res
+
+
+"""Returns a PIL Image object or None
+
+getEmbeddedImage for page (1 indexed) of the pdf at path, or None if that
+page isn't a single scan or EMBEDDED_IMAGES is off.
+"""
+def getEmbeddedPage(path, page=1, dpi=RASTER_DPI):
+    global EMBEDDED_IMAGES
+
+    if not EMBEDDED_IMAGES:
+        return None
+    with open(path, 'rb') as pdf_file:
+        reader = PdfFileReader(pdf_file)
+        if page > reader.getNumPages():
+            return None
+        return getEmbeddedImage(reader.getPage(page - 1), dpi)
+
+
+"""Returns a generator of file paths and PIL Image objects
+
+Goes through pages first_page to last_page (1 indexed, inclusive) of the pdf
+at path. Pages that are a single scan (with EMBEDDED_IMAGES on) come out as
+the image taken from the pdf by getEmbeddedImage, every run of other pages
+is rendered to output_folder by rasterizePages and comes out as file paths.
+"""
+def _iterPageSources(path, output_folder, first_page, last_page, dpi=RASTER_DPI, fmt='ppm'):
+    global EMBEDDED_IMAGES
+
+    first_page = max(first_page, 1)
+    if not EMBEDDED_IMAGES:
+        yield from rasterizePages(path, output_folder, first_page, last_page, dpi, fmt)
+        return
+
+    with open(path, 'rb') as pdf_file:
+        reader = PdfFileReader(pdf_file)
+        last_page = reader.getNumPages() if last_page is None else min(last_page, reader.getNumPages())
+        page = first_page
+        while page <= last_page:
+            img = getEmbeddedImage(reader.getPage(page - 1), dpi)
+            if img is not None:
+                yield img
+                page += 1
+                continue
+            # render everything up to the next scanned page in one go
+            end = page
+            while end < last_page and findEmbeddedImage(reader.getPage(end)) is None:
+                end += 1
+            pages = rasterizePages(path, output_folder, page, end, dpi, fmt)
+            try:
+                yield from pages
+            finally:
+                pages.close()
+            page = end + 1
+
+
 """Returns a temporary directory filled with processed images, PIL Image
 objects, and the original file name.
 
@@ -84,23 +446,172 @@ Takes in the path to the pdf to process and the page of the PDF to stop at
 to process, as well as the start. Not limit does NOT act like max_pages
 in other functions. If start > max_pages, the function returns an empty
 list.
+
+The whole range is rendered by one pdftoppm process (see rasterizePages) and
+the images are opened lazily from the temporary directory. Pages that are a
+single scan are taken straight out of the pdf instead (see getEmbeddedImage).
 """
 def getImagePages(path, limit=0, start=0):
-    global OUTPUT_PAGE_LIMIT
-
-    dir = tempfile.TemporaryDirectory(dir = os.getcwd())
+    dir = tempfile.TemporaryDirectory(dir = getScratchDir())
     res = []
-    pdf = PdfFileReader(open(path,'rb'))
-    max_pages = pdf.getNumPages() if limit <= 0 else limit
-    for page in range(start, max_pages, OUTPUT_PAGE_LIMIT):
-        res += convert_from_path(path,
-                                 dpi=300,
-                                 first_page = page,
-                                 last_page = min(page + OUTPUT_PAGE_LIMIT - 1, max_pages),
-                                 output_folder = dir.name)
+    max_pages = getPageCount(path) if limit <= 0 else limit
+    if max(start, 1) <= max_pages:
+        for page in _iterPageSources(path, dir.name, start, max_pages):
+            res.append(page if isinstance(page, Image.Image) else Image.open(page))
     return {'tempdir': dir, 'images': res, 'file': path}
 
 
+"""Returns a generator of PIL Image objects
+
+Yields the pages of the pdf at path one at a time instead of holding the
+whole document in memory like getImagePages. limit and start work the same
+way as in getImagePages. Every page is loaded into memory and its file is
+deleted before it is yielded, so only the pages the caller still holds on to
+(plus at most OUTPUT_PAGE_LIMIT pages waiting on disk) take up space.
+
+The temporary directory is removed when the generator is exhausted or
+closed, so wrap it in contextlib.closing to replace cleanupImageOutput:
+
+    with closing(iterImagePages(path)) as pages:
+        for page in pages:
+            ...
+"""
+def iterImagePages(path, limit=0, start=0, dpi=RASTER_DPI, fmt='ppm'):
+    max_pages = getPageCount(path) if limit <= 0 else limit
+    if max(start, 1) > max_pages:
+        return
+    with tempfile.TemporaryDirectory(dir = getScratchDir()) as dir:
+        pages = _iterPageSources(path, dir, start, max_pages, dpi, fmt)
+        try:
+            for page in pages:
+                if isinstance(page, Image.Image):
+                    yield page
+                    continue
+                img = Image.open(page)
+                img.load()
+                os.remove(page)
+                yield img
+        finally:
+            pages.close()
+
+
+"""Returns a PIL Image object
+
+Renders a single page of the pdf at path at dpi with one pdftoppm call. If
+box (x, y, w, h, in pixels at dpi) is given only that part of the page gets
+rendered, so a few small regions don't cost a whole page worth of pixels.
+"""
+def renderRegion(path, dpi=RASTER_DPI, box=None, page=1, fmt='ppm'):
+    global RASTER_FORMATS
+
+    flags, extension = RASTER_FORMATS[fmt]
+    args = ['pdftoppm', '-r', str(dpi), '-f', str(page), '-l', str(page), '-singlefile']
+    if box is not None:
+        x, y, w, h = box
+        args += ['-x', str(x), '-y', str(y), '-W', str(w), '-H', str(h)]
+    with tempfile.TemporaryDirectory(dir = getScratchDir()) as dir:
+        prefix = os.path.join(dir, 'region')
+        proc = subprocess.run(args + flags + [path, prefix], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError('pdftoppm failed on {}: {}'.format(path,
+                proc.stderr.decode('utf-8', 'replace').strip()))
+        img = Image.open(prefix + '.' + extension)
+        img.load()
+    return img
+
+
+"""Returns a list of (dpi, box, members) tuples
+
+Groups regions, (x, y, w, h, dpi) tuples with the box in RASTER_DPI pixels,
+into bands that can each be rendered with one renderRegion call. Regions of
+the same dpi share a band when the box around them costs fewer pixels than
+rendering them apart plus RASTER_BAND_CALL_PIXELS for the extra call, so a
+row of numbers is one band but crops at opposite ends of the page aren't.
+box is the band in pixels at dpi and members is a list of (index into
+regions, box of the region in pixels of the band image).
+"""
+def planRegionBands(regions):
+    global RASTER_DPI
+    global RASTER_BAND_CALL_PIXELS
+
+    by_dpi = {}
+    for i, region in enumerate(regions):
+        by_dpi.setdefault(region[4], []).append(i)
+
+    res = []
+    for dpi, indices in by_dpi.items():
+        scale = dpi / RASTER_DPI
+        # (left, top, right, bottom, members) in RASTER_DPI pixels
+        bands = [(regions[i][0], regions[i][1], regions[i][0] + regions[i][2], regions[i][1] + regions[i][3], [i]) for i in indices]
+        while len(bands) > 1:
+            best = None
+            for a in range(len(bands)):
+                for b in range(a + 1, len(bands)):
+                    around = (min(bands[a][0], bands[b][0]), min(bands[a][1], bands[b][1]),
+                              max(bands[a][2], bands[b][2]), max(bands[a][3], bands[b][3]))
+                    saved = _bandPixels(bands[a], scale) + _bandPixels(bands[b], scale) + \
+                        RASTER_BAND_CALL_PIXELS - _bandPixels(around, scale)
+                    if saved > 0 and (best is None or saved > best[0]):
+                        best = (saved, a, b, around)
+            if best is None:
+                break
+            saved, a, b, around = best
+            bands[a] = around + (bands[a][4] + bands[b][4],)
+            del bands[b]
+
+        for left, top, right, bottom, members in bands:
+            bx, by = int(left * scale), int(top * scale)
+            box = (bx, by, math.ceil(right * scale) - bx, math.ceil(bottom * scale) - by)
+            boxes = []
+            for i in sorted(members):
+                x, y, w, h = regions[i][0:4]
+                rx, ry = int(x * scale), int(y * scale)
+                boxes.append((i, (rx - bx, ry - by, math.ceil((x + w) * scale) - rx, math.ceil((y + h) * scale) - ry)))
+            res.append((dpi, box, boxes))
+    return res
+
+
+"""Returns an integer
+
+Pixels a (left, top, right, bottom, ...) box in RASTER_DPI pixels has once
+it's rendered at scale times RASTER_DPI.
+"""
+def _bandPixels(band, scale):
+    return (band[2] - band[0]) * (band[3] - band[1]) * scale * scale
+
+
+"""Returns a list of (PIL Image, members) tuples
+
+Renders only the bands planRegionBands finds for regions instead of the
+whole page. members is the same as in planRegionBands.
+"""
+def renderRegions(path, regions, page=1, fmt='ppm'):
+    res = []
+    for dpi, box, members in planRegionBands(regions):
+        res.append((renderRegion(path, dpi, box, page, fmt), members))
+    return res
+
+
+"""Returns a list of (PIL Image, members) tuples
+
+Same as renderRegions, but for a page that's already an image at
+RASTER_DPI (like a scan, see getEmbeddedPage): every region is cropped out
+and resized to its dpi on its own, since a scan has no more detail to give a
+band and resizing what's between the regions would be wasted.
+"""
+def cropRegions(image, regions):
+    global RASTER_DPI
+
+    res = []
+    for i, (x, y, w, h, dpi) in enumerate(regions):
+        crop = image.crop((x, y, x + w, y + h))
+        if dpi != RASTER_DPI:
+            size = (max(1, round(w * dpi / RASTER_DPI)), max(1, round(h * dpi / RASTER_DPI)))
+            crop = crop.resize(size, Image.LANCZOS)
+        res.append((crop, [(i, (0, 0) + crop.size)]))
+    return res
+
+
 """Returns None
 
 Takes an object created by getImagePages and closes
@@ -113,7 +624,8 @@ def cleanupImageOutput(images_obj):
 """Returns None
 
 Saves a list of images to 'images/namingX.JPEG' where X is the 0 indexed page
-number.
+number. pages_obj is either an object created by getImagePages or any
+iterable of images (like iterImagePages).
 """
 def dumpImagePages(pages_obj, naming='page', start=0, directory='images'):
     try:
@@ -121,8 +633,9 @@ def dumpImagePages(pages_obj, naming='page', start=0, directory='images'):
     except FileExistsError:
         # print('INFO: {}/ already exits. Continuing...'.format(directory))
         pass
-    for i in range(len(pages_obj['images'])):
-        pages_obj['images'][i].save('{}/'.format(directory) + naming + str(i + start) + '.JPEG', 'JPEG')
+    images = pages_obj['images'] if isinstance(pages_obj, dict) else pages_obj
+    for i, image in enumerate(images):
+        image.save('{}/'.format(directory) + naming + str(i + start) + '.JPEG', 'JPEG')
 
 
 """Returns None
@@ -144,21 +657,832 @@ def dumpTextPages(pages, start=0, naming='page', directory='plaintext', extensio
         writefile.close()
 
 
+"""Returns a string
+
+Builds the tesseract config string out of a page segmentation mode and a
+list of -c variables.
+"""
+def _tesseractConfig(psm, clist=''):
+    clist = '-c ' + clist if clist != '' else clist
+    return '--psm ' + str(psm) + ' ' + clist
+
+
+"""Returns a PIL Image object
+
+Accepts a PIL image, a numpy array or a raw encoded buffer (bytes, bytearray
+or memoryview of a JPEG/PNG/PPM/...) and returns it as an image.
+"""
+def toImage(obj):
+    if isinstance(obj, Image.Image):
+        return obj
+    if isinstance(obj, np.ndarray):
+        return Image.fromarray(obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(obj))
+    raise TypeError('Unsupported image object: {}'.format(type(obj)))
+
+
+"""Turns pages into compact images for tesseract before they get OCR'd.
+
+A preprocessor is called on a PIL image and returns the processed image:
+
+    mode: 'gray' (8 bit grayscale), 'binary' (1 bit, thresholded with
+          threshold or Otsu's method if threshold is None) or None to keep
+          the colors
+    contrast: ImageEnhance contrast factor, 1.0 leaves the image as is
+    deskew: rotate the page so its lines of text are horizontal, the angle
+            ends up in the processed image's info['skew']
+    scale: resize factor, any boxes on the original page have to go
+           through mapBox (or scaleBox if nothing was deskewed) to stay on
+           the same spot
+
+If cache_dir is given every result is kept there as a PNG under the hash of
+the input image and the settings, so a page is only processed once.
+"""
+class Preprocessor:
+    def __init__(self, mode='gray', threshold=None, contrast=1.0, deskew=False, scale=1.0, cache_dir=None):
+        if mode not in ('gray', 'binary', None):
+            raise ValueError('Unknown preprocessing mode: {}'.format(mode))
+        self.mode = mode
+        self.threshold = threshold
+        self.contrast = contrast
+        self.deskew = deskew
+        self.scale = scale
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # the settings, everything that changes the output (the PREPROCESS_*
+    # skew search too when deskewing)
+    def config(self):
+        global PREPROCESS_MAX_SKEW
+        global PREPROCESS_SKEW_STEP
+        global PREPROCESS_SKEW_WIDTH
+        global PREPROCESS_SKEW_MIN_SIZE
+
+        config = {'mode': self.mode, 'threshold': self.threshold, 'contrast': self.contrast,
+                  'deskew': self.deskew, 'scale': self.scale}
+        if self.deskew:
+            config['skew'] = {'max': PREPROCESS_MAX_SKEW, 'step': PREPROCESS_SKEW_STEP,
+                              'width': PREPROCESS_SKEW_WIDTH, 'min_size': PREPROCESS_SKEW_MIN_SIZE}
+        return config
+
+    def scaleBox(self, box):
+        return tuple([int(round(v * self.scale)) for v in box])
+
+    # box (x, y, w, h) on the original page moved to where it is on image,
+    # the page after preprocessing: turned with the page around its center
+    # by the skew deskew found, then scaled
+    def mapBox(self, box, image):
+        x, y, w, h = box
+        angle = math.radians(float(image.info.get('skew', 0)))
+        if angle != 0:
+            cx, cy = image.size[0] / self.scale / 2, image.size[1] / self.scale / 2
+            mx, my = x + w / 2 - cx, y + h / 2 - cy
+            x = cx + mx * math.cos(angle) + my * math.sin(angle) - w / 2
+            y = cy - mx * math.sin(angle) + my * math.cos(angle) - h / 2
+        return self.scaleBox((x, y, w, h))
+
+    # the same settings without deskew, for images that aren't a page
+    # (like a sheet of crops) and have no skew of their own to find
+    def withoutDeskew(self):
+        return Preprocessor(self.mode, self.threshold, self.contrast, False, self.scale, self.cache_dir)
+
+    def cachePath(self, image):
+        digest = hashlib.sha256(json.dumps(self.config(), sort_keys=True).encode('utf-8'))
+        digest.update('{}{}'.format(image.mode, image.size).encode('utf-8'))
+        digest.update(image.tobytes())
+        return os.path.join(self.cache_dir, digest.hexdigest() + '.png')
+
+    def __call__(self, image):
+        image = toImage(image)
+        path = self.cachePath(image) if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            cached = Image.open(path)
+            cached.load()
+            if 'skew' in cached.info:
+                cached.info['skew'] = float(cached.info['skew'])
+            return cached
+
+        res = self.process(image)
+        if path is not None:
+            # written under a unique temporary name so other workers (threads
+            # or processes sharing the cache) never read half a file
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                info = PngImagePlugin.PngInfo()
+                if 'skew' in res.info:
+                    info.add_text('skew', str(res.info['skew']))
+                with os.fdopen(fd, 'wb') as f:
+                    res.save(f, 'PNG', pnginfo=info)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        return res
+
+    def process(self, image):
+        global PREPROCESS_SKEW_MIN_SIZE
+
+        if self.mode is not None:
+            image = image.convert('L')
+        if self.contrast != 1.0:
+            image = ImageEnhance.Contrast(image).enhance(self.contrast)
+        angle = 0.0
+        if self.deskew and min(image.size) >= PREPROCESS_SKEW_MIN_SIZE:
+            angle = estimateSkew(image)
+            if angle != 0:
+                fill = 255 if image.mode == 'L' else (255,) * len(image.getbands())
+                image = image.rotate(angle, resample=Image.BILINEAR, fillcolor=fill)
+        if self.scale != 1.0:
+            size = (max(1, int(round(image.size[0] * self.scale))), max(1, int(round(image.size[1] * self.scale))))
+            image = image.resize(size, Image.BOX if self.scale < 1 else Image.BICUBIC)
+        if self.mode == 'binary':
+            pixels = np.asarray(image)
+            threshold = otsuThreshold(pixels) if self.threshold is None else self.threshold
+            image = Image.fromarray(pixels > threshold)
+        if angle != 0:
+            image.info['skew'] = angle
+        return image
+
+
+"""Returns an integer
+
+The gray level that best splits the pixels of a grayscale array into dark
+and light (Otsu's method), from a 256 bin histogram.
+"""
+def otsuThreshold(pixels):
+    hist = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(hist)
+    total = weight[-1]
+    mean = np.cumsum(hist * levels)
+    # between class variance for every threshold t (dark is <= t)
+    dark, light = weight, total - weight
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (mean[-1] * dark - mean * total) ** 2 / (dark * light)
+    variance[~np.isfinite(variance)] = 0
+    return int(np.argmax(variance))
+
+
+"""Returns a float
+
+The angle (degrees, counter-clockwise like Image.rotate) a grayscale page
+has to be rotated by so its lines of text run horizontally. Every angle in
+PREPROCESS_SKEW_STEP steps up to PREPROCESS_MAX_SKEW either way is tried by
+projecting the dark pixels of a scaled down copy onto the rows they'd land on
+(one bincount per angle, nothing gets rotated) and keeping the angle with the
+sharpest row profile. Whole degrees are tried first and only the degree
+around the best one is searched in finer steps.
+"""
+def estimateSkew(image):
+    global PREPROCESS_MAX_SKEW
+    global PREPROCESS_SKEW_STEP
+    global PREPROCESS_SKEW_WIDTH
+
+    factor = min(1.0, PREPROCESS_SKEW_WIDTH / image.size[0])
+    small = image.convert('L')
+    if factor < 1.0:
+        small = small.resize((int(image.size[0] * factor), int(image.size[1] * factor)), Image.BOX)
+    pixels = np.asarray(small)
+    ys, xs = np.nonzero(pixels <= otsuThreshold(pixels))
+    if len(ys) == 0:
+        return 0.0
+
+    xs = xs - pixels.shape[1] / 2
+
+    def score(angle):
+        rows = np.round(ys - xs * math.tan(math.radians(angle))).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        return np.sum(np.diff(profile).astype(np.float64) ** 2)
+
+    # whole degrees first, then PREPROCESS_SKEW_STEP around the best one
+    coarse = np.arange(-PREPROCESS_MAX_SKEW, PREPROCESS_MAX_SKEW + 0.5, 1.0)
+    best = max(coarse, key=score)
+    fine = np.arange(best - 1, best + 1 + PREPROCESS_SKEW_STEP / 2, PREPROCESS_SKEW_STEP)
+    best = max([a for a in fine if abs(a) <= PREPROCESS_MAX_SKEW], key=score)
+    return round(float(best), 2) if abs(best) > PREPROCESS_SKEW_STEP / 2 else 0.0
+
+
+"""Returns a list of (name, value) tuples
+
+Splits a clist ('tessedit_char_whitelist=0123456789 other_var=1') into the
+tesseract variables it sets.
+"""
+def _parseClist(clist):
+    res = []
+    for var in clist.split():
+        name, _, value = var.partition('=')
+        res.append((name, value))
+    return res
+
+
+"""OCR backend that shells out to the tesseract binary through pytesseract.
+
+Every call starts a new tesseract process that loads its traineddata from
+disk again. Always available, so it's the fallback for TesserocrBackend.
+"""
+class PytesseractBackend:
+    name = 'pytesseract'
+
+    def recognize(self, image, language='eng', psm=3, clist=''):
+        return str(pytesseract.image_to_string(toImage(image),
+            lang=language, config=_tesseractConfig(psm, clist)))
+
+    # pastes every box into one composite image and OCRs that once. A
+    # composite is a block of text (COMPOSITE_PSM), so boxes that want any
+    # other psm (like a single word) get OCR'd one at a time instead
+    def recognizeRegions(self, image, boxes, language='eng', psm=3, clist=''):
+        global COMPOSITE_PSM
+
+        image = toImage(image)
+        if psm != COMPOSITE_PSM:
+            return [self.recognize(image.crop((x, y, x + w, y + h)), language, psm, clist) for x, y, w, h in boxes]
+        composite, offsets = _compositeRegions(image, boxes)
+        data = pytesseract.image_to_data(composite, lang=language,
+            config=_tesseractConfig(COMPOSITE_PSM, clist), output_type=pytesseract.Output.DICT)
+        words = [[] for box in boxes]
+        for i in range(len(data['text'])):
+            text = data['text'][i].strip()
+            if text == '':
+                continue
+            center = data['top'][i] + data['height'][i] / 2
+            for j in range(len(boxes)):
+                if offsets[j] <= center < offsets[j] + boxes[j][3]:
+                    words[j].append(text)
+                    break
+        return [' '.join(w) for w in words]
+
+    # every word with its box (see LAYOUT_KEYS)
+    def data(self, image, language='eng', psm=3, clist=''):
+        global LAYOUT_KEYS
+
+        data = pytesseract.image_to_data(toImage(image), lang=language,
+            config=_tesseractConfig(psm, clist), output_type=pytesseract.Output.DICT)
+        res = dict([(key, []) for key in LAYOUT_KEYS])
+        for i in range(len(data['text'])):
+            if data['level'][i] != 5 or str(data['text'][i]).strip() == '':
+                continue
+            for key in LAYOUT_KEYS:
+                res[key].append(float(data[key][i]) if key == 'conf' else data[key][i])
+        res['text'] = [str(text).strip() for text in res['text']]
+        return res
+
+    def close(self):
+        pass
+
+
+"""The tesseract engines of one thread, ended when the thread exits (and
+its thread-local data with it) or when the backend is closed.
+"""
+class _EngineSet:
+    def __init__(self):
+        self.apis = {}
+
+    def end(self):
+        for api in self.apis.values():
+            api.End()
+        self.apis = {}
+
+    def __del__(self):
+        self.end()
+
+
+"""OCR backend that keeps warm tesseract engines in-process with tesserocr.
+
+One engine is created per (language, psm, clist) and reused for every image
+after that, so the traineddata is only loaded once instead of once per call.
+Tesseract engines aren't thread safe, so every thread gets its own set of
+engines. parallelMap keeps its threads between calls, so theirs stay warm,
+and the engines of any other thread are freed when it exits.
+"""
+class TesserocrBackend:
+    name = 'tesserocr'
+
+    def __init__(self, tessdata=None):
+        global tesserocr
+
+        if tesserocr is None:
+            if not TESSEROCR_INSTALLED:
+                raise ImportError('tesserocr is not installed')
+            tesserocr = importlib.import_module('tesserocr')
+        self.tessdata = tessdata
+        self.local = threading.local()
+        self.engines = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def getEngine(self, language='eng', psm=3, clist=''):
+        engines = getattr(self.local, 'engines', None)
+        if engines is None:
+            engines = self.local.engines = _EngineSet()
+            with self.lock:
+                self.engines.add(engines)
+        key = (language, psm, clist)
+        if key not in engines.apis:
+            kwargs = {'lang': language, 'psm': psm}
+            if self.tessdata is not None:
+                kwargs['path'] = self.tessdata
+            api = tesserocr.PyTessBaseAPI(**kwargs)
+            for name, value in _parseClist(clist):
+                api.SetVariable(name, value)
+            engines.apis[key] = api
+        return engines.apis[key]
+
+    def recognize(self, image, language='eng', psm=3, clist=''):
+        api = self.getEngine(language, psm, clist)
+        api.SetImage(toImage(image))
+        return api.GetUTF8Text()
+
+    # sets the page once and only recognizes the rectangle of every box
+    def recognizeRegions(self, image, boxes, language='eng', psm=3, clist=''):
+        api = self.getEngine(language, psm, clist)
+        api.SetImage(toImage(image))
+        res = []
+        for x, y, w, h in boxes:
+            api.SetRectangle(x, y, w, h)
+            res.append(api.GetUTF8Text())
+        return res
+
+    # every word with its box (see LAYOUT_KEYS), numbered like image_to_data
+    def data(self, image, language='eng', psm=3, clist=''):
+        global LAYOUT_KEYS
+
+        api = self.getEngine(language, psm, clist)
+        api.SetImage(toImage(image))
+        api.Recognize()
+        res = dict([(key, []) for key in LAYOUT_KEYS])
+        level = tesserocr.RIL.WORD
+        block = par = line = 0
+        for word in tesserocr.iterate_level(api.GetIterator(), level):
+            if word.IsAtBeginningOf(tesserocr.RIL.BLOCK):
+                block, par, line = block + 1, 0, 0
+            if word.IsAtBeginningOf(tesserocr.RIL.PARA):
+                par, line = par + 1, 0
+            if word.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                line += 1
+            text = word.GetUTF8Text(level)
+            box = word.BoundingBox(level)
+            if text is None or text.strip() == '' or box is None:
+                continue
+            x1, y1, x2, y2 = box
+            values = [text.strip(), x1, y1, x2 - x1, y2 - y1, word.Confidence(level), block, par, line]
+            for key, value in zip(LAYOUT_KEYS, values):
+                res[key].append(value)
+        return res
+
+    def close(self):
+        with self.lock:
+            for engines in list(self.engines):
+                engines.end()
+            self.engines = weakref.WeakSet()
+        self.local = threading.local()
+
+
+"""Returns a PIL Image object and a list of integers
+
+Stacks the (x, y, w, h) boxes of image on top of each other, separated by
+COMPOSITE_PADDING white pixels, and returns that image along with the y
+offset every box ended up at.
+"""
+def _compositeRegions(image, boxes):
+    global COMPOSITE_PADDING
+
+    width = max([box[2] for box in boxes]) + 2 * COMPOSITE_PADDING
+    height = sum([box[3] + COMPOSITE_PADDING for box in boxes]) + COMPOSITE_PADDING
+    background = 255 if image.mode in ('L', '1') else (255,) * len(image.getbands())
+    composite = Image.new(image.mode, (width, height), background)
+    offsets = []
+    y_offset = COMPOSITE_PADDING
+    for x, y, w, h in boxes:
+        composite.paste(image.crop((x, y, x + w, y + h)), (COMPOSITE_PADDING, y_offset))
+        offsets.append(y_offset)
+        y_offset += h + COMPOSITE_PADDING
+    return composite, offsets
+
+
+_OCR_BACKENDS = {}
+
+"""Returns an OCR backend
+
+backend can be a backend object (returned as is), a name ('tesserocr' or
+'pytesseract') or None, which means OCR_BACKEND or, if that isn't set,
+tesserocr when it is installed and pytesseract otherwise. Backends are
+shared, so the same warm engines get reused across calls.
+"""
+def getOCRBackend(backend=None):
+    global OCR_BACKEND
+
+    if backend is not None and not isinstance(backend, str):
+        return backend
+    name = backend if backend is not None else OCR_BACKEND
+    if name is None:
+        name = 'tesserocr' if TESSEROCR_INSTALLED else 'pytesseract'
+    if name not in _OCR_BACKENDS:
+        if name == 'tesserocr':
+            _OCR_BACKENDS[name] = TesserocrBackend()
+        elif name == 'pytesseract':
+            _OCR_BACKENDS[name] = PytesseractBackend()
+        else:
+            raise ValueError('Unknown OCR backend: {}'.format(name))
+    return _OCR_BACKENDS[name]
+
+
+"""Returns None
+
+Tesseract spreads every image over all cores with OpenMP, which fights with
+our own workers when several tesseracts run at once. Pins each tesseract to
+one thread when workers > 1, unless OMP_THREAD_LIMIT was set by the user.
+Has to run before the first TesserocrBackend is made (getOCRBackend), since
+OpenMP only reads the limit when tesserocr is loaded. Tesseract processes
+started by pytesseract pick it up either way.
+"""
+def setTesseractThreads(workers):
+    if workers > 1 and 'OMP_THREAD_LIMIT' not in os.environ:
+        os.environ['OMP_THREAD_LIMIT'] = '1'
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+"""Returns a ThreadPoolExecutor
+
+The pool of workers threads parallelMap uses. It's made once per process
+and kept, so the thread-local engines of TesserocrBackend stay warm from one
+call to the next. A forked worker process gets its own pools, since threads
+don't survive fork.
+"""
+def _getPool(workers):
+    key = (os.getpid(), workers)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ThreadPoolExecutor(max_workers=workers)
+        return _POOLS[key]
+
+
+"""Returns a generator
+
+Calls func on every item of items with a pool of worker threads and yields
+the results in the same order as items. items is consumed lazily and at
+most max_pending (OCR_QUEUE_FACTOR * workers by default) calls are queued
+or running at once, so a generator of pages never gets read far ahead.
+Threads are enough since the heavy lifting happens in tesseract/pdftoppm
+subprocesses. The threads are kept for the next call with the same number of
+workers (see _getPool). With workers <= 1 everything runs in the calling
+thread.
+"""
+def parallelMap(func, items, workers=OCR_WORKERS, max_pending=None):
+    global OCR_QUEUE_FACTOR
+
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    max_pending = OCR_QUEUE_FACTOR * workers if max_pending is None else max(max_pending, 1)
+    pending = deque()
+    pool = _getPool(workers)
+    try:
+        for item in items:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, item))
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        # whatever was already running still has to finish before we return
+        for future in pending:
+            if not future.cancelled():
+                try:
+                    future.result()
+                except Exception:
+                    pass
+
+
+"""Returns list of strings
+
+Same as extractPagesText, but works on images that are already in memory
+instead of files in a directory. images can hold PIL images, numpy arrays
+or raw encoded buffers (see toImage). Nothing is written back out as a JPEG
+along the way. Up to workers images are OCR'd at once (see parallelMap)
+with the OCR backend picked by getOCRBackend(backend). If preprocess (a
+Preprocessor or any function of an image) is given, every image goes
+through it first, on the same worker.
+"""
+def extractTextFromImages(images, language='eng', clist='', psm=3, workers=OCR_WORKERS, backend=None, preprocess=None):
+    setTesseractThreads(workers)
+    engine = getOCRBackend(backend)
+
+    def ocr(image):
+        if preprocess is not None:
+            image = preprocess(image)
+        return engine.recognize(image, language=language, psm=psm, clist=clist)
+
+    return list(parallelMap(ocr, images, workers))
+
+
+"""Returns a list of strings
+
+OCRs many regions of a single page without saving any crops. regions is a
+list of (x, y, w, h, language, psm, clist) tuples and the text of every
+region is returned in the same order. Regions that share language, psm and
+clist are handed to the backend together, so a page costs one engine call
+per distinct setting instead of one per region (tesserocr sets the page once
+and recognizes each rectangle, pytesseract reads one composite image when
+the psm is COMPOSITE_PSM and every crop on its own otherwise).
+The page goes through preprocess (see extractTextFromImages) once, and the
+boxes are moved along with it (see Preprocessor.mapBox) if it is a
+Preprocessor.
+"""
+def extractRegionsText(image, regions, backend=None, preprocess=None):
+    engine = getOCRBackend(backend)
+    image = toImage(image)
+    if preprocess is not None:
+        image = preprocess(image)
+        if isinstance(preprocess, Preprocessor):
+            regions = [preprocess.mapBox(region[0:4], image) + tuple(region[4:7]) for region in regions]
+
+    groups = {}
+    for i, (x, y, w, h, language, psm, clist) in enumerate(regions):
+        groups.setdefault((language, psm, clist), []).append(i)
+
+    res = [''] * len(regions)
+    for (language, psm, clist), indices in groups.items():
+        boxes = [tuple(regions[i][0:4]) for i in indices]
+        texts = engine.recognizeRegions(image, boxes, language=language, psm=psm, clist=clist)
+        for i, text in zip(indices, texts):
+            res[i] = text
+    return res
+
+
+"""Returns a PIL Image object and a list of integers
+
+Stacks images on top of each other on a white sheet and returns it along
+with the y offset every image ended up at.
+"""
+def _stackImages(images):
+    mode = 'L' if all([image.mode == 'L' for image in images]) else 'RGB'
+    width = max([image.size[0] for image in images])
+    height = sum([image.size[1] for image in images])
+    sheet = Image.new(mode, (width, height), 255 if mode == 'L' else (255, 255, 255))
+    offsets = []
+    y_offset = 0
+    for image in images:
+        sheet.paste(image if image.mode == mode else image.convert(mode), (0, y_offset))
+        offsets.append(y_offset)
+        y_offset += image.size[1]
+    return sheet, offsets
+
+
+"""Returns a list of strings
+
+Same as extractRegionsText, but straight from the pdf at path: regions are
+(x, y, w, h, language, psm, clist) tuples in RASTER_DPI pixels and dpis is
+the dpi each one gets rendered at (a list, or one dpi for all of them). Only
+the bands planRegionBands finds around the regions are rendered, and the
+bands are stacked into one image so the regions still cost one engine call
+per setting.
+
+If the page is a single scan (see getEmbeddedPage) the regions are cropped
+out of it instead, see extractRegionsTextAtDpi. Pass embedded=False if the
+caller already knows it isn't one.
+"""
+def extractRegionsTextFromPdf(path, regions, dpis=RASTER_DPI, page=1, backend=None, preprocess=None, embedded=True):
+    if len(regions) == 0:
+        return []
+    scan = getEmbeddedPage(path, page) if embedded else None
+    if scan is not None:
+        res = extractRegionsTextAtDpi(scan, regions, dpis, backend, preprocess)
+        scan.close()
+        return res
+
+    if isinstance(dpis, int):
+        dpis = [dpis] * len(regions)
+    bands = renderRegions(path, [tuple(region[0:4]) + (dpi,) for region, dpi in zip(regions, dpis)], page)
+    return _extractBandsText(bands, regions, backend, preprocess)
+
+
+"""Returns a list of strings
+
+Same as extractRegionsTextFromPdf, but for a page that's already an image at
+RASTER_DPI, like a scan: every region is cropped out and resized to its dpi
+(see cropRegions) before the crops are stacked and OCR'd.
+"""
+def extractRegionsTextAtDpi(image, regions, dpis=RASTER_DPI, backend=None, preprocess=None):
+    if len(regions) == 0:
+        return []
+    if isinstance(dpis, int):
+        dpis = [dpis] * len(regions)
+    bands = cropRegions(toImage(image), [tuple(region[0:4]) + (dpi,) for region, dpi in zip(regions, dpis)])
+    return _extractBandsText(bands, regions, backend, preprocess)
+
+
+"""Returns a list of strings
+
+Stacks bands (see renderRegions) into one image and OCRs regions off it,
+regions being the ones the bands were made for. The sheet is no page, so a
+Preprocessor never deskews it: the crops are cut from the page as stored.
+"""
+def _extractBandsText(bands, regions, backend=None, preprocess=None):
+    if isinstance(preprocess, Preprocessor):
+        preprocess = preprocess.withoutDeskew()
+    sheet, offsets = _stackImages([image for image, members in bands])
+    boxes = [None] * len(regions)
+    for (image, members), y_offset in zip(bands, offsets):
+        for i, (x, y, w, h) in members:
+            boxes[i] = (x, y + y_offset, w, h) + tuple(regions[i][4:7])
+        image.close()
+    res = extractRegionsText(sheet, boxes, backend, preprocess)
+    sheet.close()
+    return res
+
+
+"""Returns a dictionary of lists
+
+OCRs a whole page once and returns every word with its box instead of just
+the text: one list per key of LAYOUT_KEYS (text, left, top, width, height,
+conf, block_num, par_num, line_num) like pytesseract's image_to_data. See
+layoutText and layoutWordsInBox for using it.
+"""
+def extractLayout(image, language='eng', clist='', psm=3, backend=None, preprocess=None):
+    engine = getOCRBackend(backend)
+    image = toImage(image)
+    if preprocess is not None:
+        image = preprocess(image)
+    return engine.data(image, language=language, psm=psm, clist=clist)
+
+
+"""Returns a string
+
+Puts the words of a layout (see extractLayout) back together as text the way
+tesseract prints it: words of a line joined by spaces, lines by newlines and
+an empty line between paragraphs, so extractPage1 can read it.
+"""
+def layoutText(layout):
+    lines = []
+    last = None
+    for i in range(len(layout['text'])):
+        key = (layout['block_num'][i], layout['par_num'][i], layout['line_num'][i])
+        if last is not None and key[0:2] != last[0:2]:
+            lines.append('')
+        if key != last:
+            lines.append(layout['text'][i])
+        else:
+            lines[-1] += ' ' + layout['text'][i]
+        last = key
+    return '\n'.join(lines) + '\n' if len(lines) > 0 else ''
+
+
+"""Returns a string
+
+The words of a layout (see extractLayout) whose centers are inside the
+(x, y, w, h) box, grown by padding pixels on every side, in reading order.
+"""
+def layoutWordsInBox(layout, box, padding=0):
+    x, y, w, h = box
+    words = []
+    for i in range(len(layout['text'])):
+        cx = layout['left'][i] + layout['width'][i] / 2
+        cy = layout['top'][i] + layout['height'][i] / 2
+        if x - padding <= cx <= x + w + padding and y - padding <= cy <= y + h + padding:
+            words.append((layout['block_num'][i], layout['par_num'][i], layout['line_num'][i], layout['left'][i], layout['text'][i]))
+    return ' '.join([word[-1] for word in sorted(words)])
+
+
+"""Returns a string
+
+The words of a layout (see extractLayout) on the same line as, and right
+after, the first word that starts with label whose line is closest to
+near_y (the label closest to where the value is expected). Stops at the
+first gap wider than max_gap pixels. Returns '' if there's no such label or
+it's further than max_distance pixels from near_y.
+"""
+def layoutWordsAfterLabel(layout, label, near_y, max_distance, max_gap):
+    best = None
+    for i in range(len(layout['text'])):
+        if layout['text'][i].startswith(label):
+            distance = abs(layout['top'][i] + layout['height'][i] / 2 - near_y)
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, i)
+    if best is None:
+        return ''
+
+    i = best[1]
+    line = (layout['block_num'][i], layout['par_num'][i], layout['line_num'][i])
+    after = sorted([(layout['left'][j], j) for j in range(len(layout['text']))
+        if (layout['block_num'][j], layout['par_num'][j], layout['line_num'][j]) == line
+        and layout['left'][j] > layout['left'][i]])
+    words = []
+    right = layout['left'][i] + layout['width'][i]
+    for left, j in after:
+        if left - right > max_gap:
+            break
+        words.append(layout['text'][j])
+        right = left + layout['width'][j]
+    return ' '.join(words)
+
+
+"""Returns a list of lists
+
+Groups positions that are at most min_gap apart (after sorting) and returns
+the indices of every group, groups in ascending order.
+"""
+def _clusterPositions(positions, min_gap):
+    clusters = []
+    for i in sorted(range(len(positions)), key=lambda i: positions[i]):
+        if len(clusters) > 0 and positions[i] - positions[clusters[-1][-1]] <= min_gap:
+            clusters[-1].append(i)
+        else:
+            clusters.append([i])
+    return clusters
+
+
+"""Returns list of strings
+
+Splits a page of the voter table into its cells using a layout (see
+extractLayout) and returns the text of every cell, left to right and top to
+bottom, at least rows * columns of them ('' for empty cells).
+
+Every cell has one word that starts with anchor (the elector name label)
+followed by a word that starts with TABLE_ANCHOR_NEXT on the same line. The
+anchors are grouped into columns by their left edge and into rows by
+their top edge, and each cell reaches from its anchors (less TABLE_CELL_LEFT
+widths and TABLE_CELL_ABOVE heights) to the start of the next column or row.
+Every word goes to the cell its center is in, so a word tesseract misreads
+only ever spoils its own cell.
+"""
+def layoutTableCells(layout, anchor=TABLE_ANCHOR, columns=TABLE_COLUMNS, rows=TABLE_ROWS):
+    global TABLE_ANCHOR_NEXT
+    global TABLE_COLUMN_GAP
+    global TABLE_ROW_GAP
+    global TABLE_CELL_ABOVE
+    global TABLE_CELL_LEFT
+
+    def line(i):
+        return (layout['block_num'][i], layout['par_num'][i], layout['line_num'][i])
+
+    anchors = [i for i in range(len(layout['text']) - 1) if layout['text'][i].startswith(anchor)
+        and line(i + 1) == line(i) and layout['text'][i + 1].startswith(TABLE_ANCHOR_NEXT)]
+    if len(anchors) == 0:
+        return [''] * (rows * columns)
+
+    width = np.median([layout['width'][i] for i in anchors])
+    height = np.median([layout['height'][i] for i in anchors])
+    lefts = [layout['left'][i] for i in anchors]
+    tops = [layout['top'][i] for i in anchors]
+    column_starts = [min(lefts[j] for j in cluster) - TABLE_CELL_LEFT * width
+        for cluster in _clusterPositions(lefts, TABLE_COLUMN_GAP * width)][0:columns]
+    row_starts = [min(tops[j] for j in cluster) - TABLE_CELL_ABOVE * height
+        for cluster in _clusterPositions(tops, TABLE_ROW_GAP * height)]
+    # the last row is as tall as the others, so the page footer stays out
+    pitch = np.median(np.diff(row_starts)) if len(row_starts) > 1 else (TABLE_CELL_ABOVE + 4) * height
+    bottom = row_starts[-1] + pitch
+
+    cells = [{} for i in range(max(rows, len(row_starts)) * columns)]
+    for i in range(len(layout['text'])):
+        cx = layout['left'][i] + layout['width'][i] / 2
+        cy = layout['top'][i] + layout['height'][i] / 2
+        column = bisect.bisect_right(column_starts, cx) - 1
+        row = bisect.bisect_right(row_starts, cy) - 1
+        if column < 0 or row < 0 or cy >= bottom:
+            continue
+        cells[row * columns + column].setdefault(line(i), []).append((layout['left'][i], layout['top'][i], layout['text'][i]))
+
+    res = []
+    for cell in cells:
+        lines = sorted(cell.values(), key=lambda words: min(word[1] for word in words))
+        res.append('\n'.join([' '.join([word[2] for word in sorted(words)]) for words in lines]))
+    return res
+
+
+"""Returns list of dictionaries of lists
+
+OCRs every page of the voter table once for its words (see extractLayout),
+in TABLE_LANGUAGE so the hindi fields and the voter ids come out of the same
+pass. The pages are read workers at a time, like extractTextFromImages. See
+extractTable1Layout for turning the layouts into records.
+"""
+def extractTableLayouts(images, language=TABLE_LANGUAGE, clist=TABLE_CLIST, psm=TABLE_PSM, workers=OCR_WORKERS, backend=None, preprocess=None):
+    setTesseractThreads(workers)
+    engine = getOCRBackend(backend)
+
+    def layout(image):
+        return extractLayout(image, language=language, clist=clist, psm=psm, backend=engine, preprocess=preprocess)
+
+    return list(parallelMap(layout, images, workers))
+
+
 """Returns list of strings
 
 Takes a list of images and returns one string of text per page in a list.
 Looks for images in 'directory' named 'naming'X.'extension' until num_pages -1.
 """
-def extractPagesText(directory='images', naming='page', extension='JPEG', language='eng', num_pages=1, start=0, clist='', psm=3):
-    clist = '-c ' + clist if clist != '' else clist
+def extractPagesText(directory='images', naming='page', extension='JPEG', language='eng', num_pages=1, start=0, clist='', psm=3, workers=OCR_WORKERS, backend=None, preprocess=None):
     # ('Performing language {}'.format(language))
-    res = []
-    for i in range(start, start + num_pages):
-        filename = directory + '/' + naming + str(i) + '.' + extension
-        text = str(((pytesseract.image_to_string(Image.open(filename), 
-            lang=language, config='--psm ' + str(psm) + ' ' + clist))))
-        res.append(text)
-    return res
+    filenames = [directory + '/' + naming + str(i) + '.' + extension for i in range(start, start + num_pages)]
+    return extractTextFromImages((Image.open(filename) for filename in filenames),
+        language=language, clist=clist, psm=psm, workers=workers, backend=backend, preprocess=preprocess)
 
 """Returns a list of tokens found in the page text.
 
@@ -193,6 +1517,251 @@ def getHindiAlphabet():
     return string
 
 
+"""Compiles the regular expressions used to pull fields out of OCR'd
+electoral roll text.
+
+All the patterns (and the hindi character classes they're built from) are
+compiled once when the extractor is made, instead of on every call, so one
+extractor can be reused for every page. Compiled patterns pickle, so an
+extractor can be sent to worker processes too. extractPage1 and
+extractTable1 use the shared FIELD_EXTRACTOR.
+"""
+class FieldExtractor:
+    def __init__(self):
+        global SEARCH_AC
+        global SEARCH_PC
+        global SEARCH_PART
+        global SEARCH_SUBPART
+        global SEARCH_VILLAGE
+        global SEARCH_POLICE
+        global SEARCH_POST_OFFICE
+        global SEARCH_RAJASVA_HALKA
+        global SEARCH_PANCHAYAT
+        global SEARCH_ANCHAL
+        global SEARCH_PRAKHAND
+        global SEARCH_DISTRICT
+        global SEARCH_ZIP
+        global SEARCH_POLLING_BOOTH
+        global SEARCH_POLLING_ADDR
+        global SEARCH_FAMILY
+        global SEARCH_ELECTOR
+        global SEARCH_ID
+        global SEARCH_AGE
+        global SEARCH_HOUSE
+        global SEARCH_SEX
+
+        alpha = getHindiAlphabet()
+        alpha_ = alpha + ' '
+        alphanum = alpha_ + '0123456789'
+
+        # page 1: (result key, anchor, pattern, how to read the match)
+        #   anchor: the literal label every match of pattern starts with
+        #   'groups': every group as a list
+        #   'group': group 1
+        #   'line': group 1 without trailing newlines
+        self.page1_fields = [
+            ('Assembly Constituency', r'विधान सभा क्षेत्र की संख्या', SEARCH_AC + r'([' + alpha + ']+)' + r'\s*-\s*([' + alpha + ']+)', 'groups'),
+            ('Part', r'संख्या', SEARCH_PART, 'group'),
+            ('Parlimentary Constituency', r'लोक सभा क्षेत्र की संख्या', SEARCH_PC + r'([' + alpha + ']+)' + r'\s*-\s*([' + alpha + ']+)', 'groups'),
+            ('Subpart', r'\(\d\)', SEARCH_SUBPART + r'([' + alpha_ + r']+)', 'group'),
+            ('Village', r'मुख्य ग्राम', SEARCH_VILLAGE + r'([' + alpha_ + r']+)', 'group'),
+            ('Post Office', r'डाकघर', SEARCH_POST_OFFICE + r'([' + alpha_ + r']+)', 'line'),
+            ('Police Station', r'थाना|आताः|ता', SEARCH_POLICE + r'([' + alpha_ + r']+)', 'line'),
+            ('Rajasva Halka', r'राजस्व हलका', SEARCH_RAJASVA_HALKA, 'group'),
+            ('Panchayat', r'पंचायत', SEARCH_PANCHAYAT + r'([' + alpha_ + r']+)', 'group'),
+            ('Anchal', r'अंचल', SEARCH_ANCHAL + r'([' + alphanum + r']+)', 'group'),
+            ('Prakhand', r'प्रखंड', SEARCH_PRAKHAND + r'([' + alphanum + r']+)', 'group'),
+            ('District', r'जिला', SEARCH_DISTRICT + r'([' + alpha_ + r']+)', 'group'),
+            ('Zip Code', r'पिन कोड', SEARCH_ZIP, 'group'),
+            ('Polling Booth', r'मतदान केन्द्र की संख्या व नाम', SEARCH_POLLING_BOOTH + r'([' + alpha_ + r']+\s*(?:,|\.)?\s*[' + alpha_ + r']+)', 'line'),
+            ('Polling Address', r'मतदान केन्द्र का भवन व पता', SEARCH_POLLING_ADDR + r'([' + alpha_ + r']+\s*(?:,|\.)?\s*[' + alpha + r']+)', 'line')
+        ]
+        self.page1_fields = [(key, anchor, re.compile(pattern, re.UNICODE), kind)
+            for key, anchor, pattern, kind in self.page1_fields]
+
+        # one pattern that finds every anchor in a single pass (see scanPage1).
+        # It's a lookahead so anchors inside other anchors (the संख्या of the
+        # AC label) still get found, and the character class in front lets re
+        # skip over positions no anchor can start at. No two anchors can
+        # start at the same spot.
+        first_chars = set()
+        for field in self.page1_fields:
+            for alternative in field[1].split('|'):
+                first_chars.add(re.sub(r'\\(.)', r'\1', alternative)[0])
+        self.anchor_pattern = re.compile('(?=[' + re.escape(''.join(sorted(first_chars))) + '])(?=' + '|'.join(
+            [r'(?P<f{}>{})'.format(i, field[1]) for i, field in enumerate(self.page1_fields)]) + ')', re.UNICODE)
+
+        # table 1
+        SEARCH_NAME = r'([' + alpha + r']+ ' + r'[' + alpha + r']+)'
+        self.elector_name_pattern = re.compile(SEARCH_ELECTOR + SEARCH_NAME, re.UNICODE)
+        self.family_name_pattern = re.compile(SEARCH_FAMILY + SEARCH_NAME, re.UNICODE)
+        self.voterid_pattern = re.compile(SEARCH_ID, re.UNICODE)
+        self.age_pattern = re.compile(SEARCH_AGE, re.UNICODE)
+        self.house_pattern = re.compile(SEARCH_HOUSE, re.UNICODE)
+        self.sex_pattern = re.compile(SEARCH_SEX, re.UNICODE)
+
+    """Returns the value of one page 1 field out of a match (see page1_fields)"""
+    def readMatch(self, hit, kind):
+        try:
+            if kind == 'groups':
+                return list(hit.groups())
+            if kind == 'line':
+                return hit.group(1).rstrip('\n')
+            return hit.group(1)
+        except IndexError:
+            return None
+
+    """Returns a dictionary with every page 1 key set to None"""
+    def emptyPage1(self):
+        return {
+            'File Name': None,
+            'Assembly Constituency': None,
+            'Part': None,
+            'Parlimentary Constituency': None,
+            'Subpart': None,
+            'Village': None,
+            'Post Office': None,
+            'Police Station': None,
+            'Rajasva Halka': None,
+            'Panchayat': None,
+            'Anchal': None,
+            'Prakhand': None,
+            'District': None,
+            'Zip Code': None,
+            'Polling Booth': None,
+            'Polling Address': None,
+            'Sanity': None
+        }
+
+    """Returns a list with the positions of every anchor of each page 1 field"""
+    def findAnchors(self, text):
+        res = [[] for field in self.page1_fields]
+        for anchor in self.anchor_pattern.finditer(text):
+            res[int(anchor.lastgroup[1:])].append(anchor.start())
+        return res
+
+    """Same as extractPage1, but scans the text once for all the labels and
+    then only tries each field's pattern right where its label is. Every
+    match of a pattern starts with its anchor, so trying them in order finds
+    the same match re.search would.
+
+    The result is identical. Off by default (see PAGE1_SINGLE_SCAN), since
+    re finds a single literal label with a fast substring search while the
+    combined anchor pattern has to be tried at every position;
+    benchmark.py fields times both on a corpus of covers.
+    """
+    def scanPage1(self, page_one_text):
+        res = self.emptyPage1()
+        anchors = self.findAnchors(page_one_text)
+        for i, (key, anchor, pattern, kind) in enumerate(self.page1_fields):
+            for position in anchors[i]:
+                hit = pattern.match(page_one_text, position)
+                if hit is not None:
+                    res[key] = self.readMatch(hit, kind)
+                    break
+        return res
+
+    """See extractPage1"""
+    def extractPage1(self, page_one_text):
+        res = self.emptyPage1()
+        for key, anchor, pattern, kind in self.page1_fields:
+            hit = pattern.search(page_one_text)
+            if hit is not None:
+                res[key] = self.readMatch(hit, kind)
+        return res
+
+    """See extractTable1"""
+    def extractTable1(self, hindi_text, english_text, start_index = 0, end_index = 0):
+        global COLUMN_NAMES1
+
+        start = start_index
+        end = end_index + 1 if end_index != 0 else len(hindi_text)
+        res = []
+
+        for i in range(start, end):
+            thispage_entries = []
+
+            thisenglish = english_text[i]
+            thishindi = hindi_text[i]
+
+            # these are in the 'correct' order (left to right)
+            # these all need to be the same size so we can make the dataframe
+            elector_match_list = self.elector_name_pattern.findall(thishindi)
+            elector_match_list = fillListTo(elector_match_list, 30, '')
+
+            family_match_list = self.family_name_pattern.findall(thishindi)
+            family_match_list = fillListTo(family_match_list, 30, '')
+
+            # age we auto-convert to a number because we can
+            age_match_list = self.age_pattern.findall(thishindi)
+            age_match_list = fillListTo(age_match_list, 30, '')
+            age_match_list = [int(age) for age in age_match_list]
+
+            house_match_list = self.house_pattern.findall(thishindi)
+            house_match_list = fillListTo(house_match_list, 30, '')
+
+            sex_match_list = self.sex_pattern.findall(thishindi)
+            sex_match_list = fillListTo(sex_match_list, 30, '')
+
+            _voterid_match_list = self.voterid_pattern.findall(thisenglish)
+            _voterid_match_list = fillListTo(_voterid_match_list, 30, '')
+
+            # these come column first and are therefore wrong and bad
+            # but we can fix that :)
+            voterid_match_list = []
+            for j in range(10):
+                voterid_match_list.append(_voterid_match_list[j])
+                voterid_match_list.append(_voterid_match_list[j + 10])
+                voterid_match_list.append(_voterid_match_list[j + 10 * 2])
+
+            for j in range(30):
+                entry = {
+                    'VoterID': voterid_match_list[j],
+                    'Name': elector_match_list[j],
+                    'Age': age_match_list[j],
+                    'Sex': sex_match_list[j],
+                    'HouseNum': house_match_list[j],
+                    'Family': family_match_list[j]
+                }
+                thispage_entries.append(entry)
+
+            thispage = pd.DataFrame(columns = COLUMN_NAMES1, data = thispage_entries)
+            res.append(thispage)
+
+        return res
+
+    """Returns one record with every field found in the text of a single cell"""
+    def readCell(self, text):
+        def first(pattern):
+            hit = pattern.search(text)
+            return hit.group(1) if hit is not None else ''
+
+        age = first(self.age_pattern)
+        return {
+            'VoterID': first(self.voterid_pattern),
+            'Name': first(self.elector_name_pattern),
+            'Age': int(age) if age != '' else '',
+            'Sex': first(self.sex_pattern),
+            'HouseNum': first(self.house_pattern),
+            'Family': first(self.family_name_pattern)
+        }
+
+    """See extractTable1Layout"""
+    def extractTable1Layout(self, layouts, start_index = 0, end_index = 0):
+        global COLUMN_NAMES1
+
+        start = start_index
+        end = end_index + 1 if end_index != 0 else len(layouts)
+        res = []
+        for i in range(start, end):
+            entries = [self.readCell(text) for text in layoutTableCells(layouts[i])]
+            res.append(pd.DataFrame(columns = COLUMN_NAMES1, data = entries))
+        return res
+
+
+FIELD_EXTRACTOR = FieldExtractor()
+
+
 """Returns a list of lists of Pandas Dataframes
 
 Between the specified start and end pages, this function looks for the variables:
@@ -213,78 +1782,22 @@ Skips the whole token idea. One list per page between start_index and
 end_index.
 """
 def extractTable1(hindi_text, english_text, start_index = 0, end_index = 0):
-    global SEARCH_FAMILY
-    global SEARCH_ELECTOR
-    global SEARCH_ID
-    global SEARCH_AGE
-    global SEARCH_HOUSE
-    global SEARCH_SEX
-    global COLUMN_NAMES1
-
-    SEARCH_NAME = r'([' + getHindiAlphabet() + r']+ ' + r'[' + getHindiAlphabet() + r']+)'
-
-    elector_name_pattern = re.compile(SEARCH_ELECTOR + SEARCH_NAME, re.UNICODE)
-    family_name_pattern = re.compile(SEARCH_FAMILY + SEARCH_NAME, re.UNICODE)
-    voterid_pattern = re.compile(SEARCH_ID, re.UNICODE)
-    age_pattern = re.compile(SEARCH_AGE, re.UNICODE)
-    house_pattern = re.compile(SEARCH_HOUSE, re.UNICODE)
-    sex_pattern = re.compile(SEARCH_SEX, re.UNICODE)
-
-    start = start_index
-    end = end_index + 1 if end_index != 0 else len(hindi_text)
-    res = []
+    global FIELD_EXTRACTOR
+    return FIELD_EXTRACTOR.extractTable1(hindi_text, english_text, start_index, end_index)
 
-    for i in range(start, end):
-        thispage_entries = []
-        
-        thisenglish = english_text[i]
-        thishindi = hindi_text[i]
-
-        # these are in the 'correct' order (left to right)
-        # these all need to be the same size so we can make the dataframe
-        elector_match_list = re.findall(elector_name_pattern, thishindi)
-        elector_match_list = fillListTo(elector_match_list, 30, '')
-
-        family_match_list = re.findall(family_name_pattern, thishindi)
-        family_match_list = fillListTo(family_match_list, 30, '')
-
-        # age we auto-convert to a number because we can
-        age_match_list = re.findall(age_pattern, thishindi)
-        age_match_list = fillListTo(age_match_list, 30, '')
-        age_match_list = [int(age) for age in age_match_list]
-
-        house_match_list = re.findall(house_pattern, thishindi)
-        house_match_list = fillListTo(house_match_list, 30, '')
-
-        sex_match_list = re.findall(sex_pattern, thishindi)
-        sex_match_list = fillListTo(sex_match_list, 30, '')
-
-        _voterid_match_list = re.findall(voterid_pattern, thisenglish)
-        _voterid_match_list = fillListTo(_voterid_match_list, 30, '')
-
-        # these come column first and are therefore wrong and bad
-        # but we can fix that :)
-        voterid_match_list = []
-        for j in range(10):
-            voterid_match_list.append(_voterid_match_list[j])
-            voterid_match_list.append(_voterid_match_list[j + 10])
-            voterid_match_list.append(_voterid_match_list[j + 10 * 2])
-
-        for j in range(30):
-            entry = {
-                'VoterID': voterid_match_list[j],
-                'Name': elector_match_list[j],
-                'Age': age_match_list[j],
-                'Sex': sex_match_list[j],
-                'HouseNum': house_match_list[j],
-                'Family': family_match_list[j]
-            }
-            thispage_entries.append(entry)
-        
-        thispage = pd.DataFrame(columns = COLUMN_NAMES1, data = thispage_entries) 
-        res.append(thispage)
-    
-    return res
+
+"""Returns a list of Pandas Dataframes
+
+Same as extractTable1, but reads the records off one layout per page (see
+extractTableLayouts) instead of a hindi and an english text. The page is
+split into its voter cells first (see layoutTableCells) and every field is
+looked for inside its own cell, so a field that isn't found leaves that one
+record blank instead of shifting every record after it. Records read left
+to right, top to bottom, at least 30 per page.
+"""
+def extractTable1Layout(layouts, start_index = 0, end_index = 0):
+    global FIELD_EXTRACTOR
+    return FIELD_EXTRACTOR.extractTable1Layout(layouts, start_index, end_index)
 
 
 """Returns a dictionary
@@ -309,190 +1822,110 @@ It expects a string of the hindi-parsed data. Dictionary contains
  - Polling address
 """
 def extractPage1(page_one_text):
-    global SEARCH_AC
-    global SEARCH_PC
-    global SEARCH_PART
-    global SEARCH_SUBPART
-    global SEARCH_VILLAGE
-    global SEARCH_POLICE
-    global SEARCH_POST_OFFICE
-    global SEARCH_PRAKHAND
-    global SEARCH_ANUMANDAL
-    global SEARCH_DISTRICT
-    global SEARCH_POLLING_BOOTH
-    global SEARCH_POLLING_ADDR
-
-    alpha = getHindiAlphabet()
-    alpha_ = alpha + ' '
-    alphanum = alpha_ + '0123456789'
-
-    # build regex strings
-    SEARCH_AC_STR = SEARCH_AC + r'([' + alpha + ']+)' + r'\s*-\s*([' + alpha + ']+)'
-    SEARCH_PC_STR = SEARCH_PC + r'([' + alpha + ']+)' + r'\s*-\s*([' + alpha + ']+)'
-    SEARCH_SUBPART_STR = SEARCH_SUBPART + r'([' + alpha_ + r']+)'
-    SEARCH_VILLAGE_STR = SEARCH_VILLAGE + r'([' + alpha_ + r']+)'
-    SEARCH_POST_OFFICE_STR = SEARCH_POST_OFFICE + r'([' + alpha_ + r']+)'
-    SEARCH_POLICE_STR = SEARCH_POLICE + r'([' + alpha_ + r']+)'
-    SEARCH_PANCHAYAT_STR = SEARCH_PANCHAYAT + r'([' + alpha_ + r']+)'
-    SEARCH_ANCHAL_STR = SEARCH_ANCHAL + r'([' + alphanum + r']+)'
-    SEARCH_PRAKHAND_STR = SEARCH_PRAKHAND + r'([' + alphanum + r']+)'
-    SEARCH_ANUMANDAL_STR = SEARCH_ANUMANDAL + r'([' + alpha_ + r']+)'
-    SEARCH_DISTRICT_STR = SEARCH_DISTRICT + r'([' + alpha_ + r']+)'
-    SEARCH_POLLING_BOOTH_STR = SEARCH_POLLING_BOOTH + r'([' + alpha_ + r']+\s*(?:,|\.)?\s*[' + alpha_ + r']+)'
-    SEARCH_POLLING_ADDR_STR = SEARCH_POLLING_ADDR + r'([' + alpha_ + r']+\s*(?:,|\.)?\s*[' + alpha + r']+)'
-
-    # these ones don't change
-    SEARCH_ZIP_STR = SEARCH_ZIP
-    SEARCH_RAJASVA_HALKA_STR = SEARCH_RAJASVA_HALKA
-    SEARCH_PART_STR = SEARCH_PART
-
-    # okay time to search
-    ac_pattern = re.compile(SEARCH_AC_STR, re.UNICODE)
-    part_pattern = re.compile(SEARCH_PART_STR, re.UNICODE)
-    pc_pattern = re.compile(SEARCH_PC_STR, re.UNICODE)
-    village_pattern = re.compile(SEARCH_VILLAGE_STR, re.UNICODE)
-    post_office_pattern = re.compile(SEARCH_POST_OFFICE_STR, re.UNICODE)
-    police_pattern = re.compile(SEARCH_POLICE_STR, re.UNICODE)
-    rajasva_halka_pattern = re.compile(SEARCH_RAJASVA_HALKA_STR, re.UNICODE)
-    panchayat_pattern = re.compile(SEARCH_PANCHAYAT_STR, re.UNICODE)
-    prakhand_pattern = re.compile(SEARCH_PRAKHAND_STR, re.UNICODE)
-    district_pattern = re.compile(SEARCH_DISTRICT_STR, re.UNICODE)
-    anchal_pattern = re.compile(SEARCH_ANCHAL_STR, re.UNICODE)
-    zip_pattern = re.compile(SEARCH_ZIP_STR, re.UNICODE)
-    polling_pattern = re.compile(SEARCH_POLLING_BOOTH_STR, re.UNICODE)
-    subpart_pattern = re.compile(SEARCH_SUBPART_STR, re.UNICODE)
-    address_pattern = re.compile(SEARCH_POLLING_ADDR_STR, re.UNICODE)
-
-    # make the result
-    res = {
-        'File Name': None,
-        'Assembly Constituency': None,
-        'Part': None,
-        'Parlimentary Constituency': None,
-        'Subpart': None,
-        'Village': None,
-        'Post Office': None,
-        'Police Station': None,
-        'Rajasva Halka': None,
-        'Panchayat': None,
-        'Anchal': None,
-        'Prakhand': None,
-        'District': None,
-        'Zip Code': None,
-        'Polling Booth': None,
-        'Polling Address': None,
-        'Sanity': None
-    }
-
-    # run the searches
-    try:
-        ac_hit = re.search(ac_pattern, page_one_text)
-        if ac_hit is not None:
-            res['Assembly Constituency'] = list(ac_hit.groups())
-    except IndexError:
-        pass
-
-    try:
-        part_hit = re.search(part_pattern, page_one_text)
-        if part_hit is not None:
-            res['Part'] = part_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        pc_hit = re.search(pc_pattern, page_one_text)
-        if pc_hit is not None:
-            res['Parlimentary Constituency'] = list(pc_hit.groups())
-    except IndexError:
-        pass
-
-    try:
-        subpart_hit = re.search(subpart_pattern, page_one_text)
-        if subpart_hit is not None:
-            res['Subpart'] = subpart_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        village_hit = re.search(village_pattern, page_one_text)
-        if village_hit is not None:
-            res['Village'] = village_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        post_office_hit = re.search(post_office_pattern, page_one_text)
-        if post_office_hit is not None:
-            res['Post Office'] = post_office_hit.group(1).rstrip('\n')
-    except IndexError:
-        pass
-
-    try:
-        police_station_hit = re.search(police_pattern, page_one_text)
-        if police_station_hit is not None:
-            res['Police Station'] = police_station_hit.group(1).rstrip('\n')
-    except IndexError:
-        pass
-
-    try:
-        rajasva_halka_hit = re.search(rajasva_halka_pattern, page_one_text)
-        if rajasva_halka_hit is not None:
-            res['Rajasva Halka'] = rajasva_halka_hit.group(1)
-    except IndexError:
-        pass
+    global FIELD_EXTRACTOR
+    global PAGE1_SINGLE_SCAN
 
-    try:
-        panchayat_hit = re.search(panchayat_pattern, page_one_text)
-        if panchayat_hit is not None:
-            res['Panchayat'] = panchayat_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        anchal_hit = re.search(anchal_pattern, page_one_text)
-        if anchal_hit is not None:
-            res['Anchal'] = anchal_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        prakhand_hit = re.search(prakhand_pattern, page_one_text)
-        if prakhand_hit is not None:
-            res['Prakhand'] = prakhand_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        district_hit = re.search(district_pattern, page_one_text)
-        if district_hit is not None:
-            res['District'] = district_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        zip_hit = re.search(zip_pattern, page_one_text)
-        if zip_hit is not None:
-            res['Zip Code'] = zip_hit.group(1)
-    except IndexError:
-        pass
-
-    try:
-        polling_hit = re.search(polling_pattern, page_one_text)
-        if polling_hit is not None:
-            res['Polling Booth'] = polling_hit.group(1).rstrip('\n')
-    except IndexError:
-        pass
+    if PAGE1_SINGLE_SCAN:
+        return FIELD_EXTRACTOR.scanPage1(page_one_text)
+    return FIELD_EXTRACTOR.extractPage1(page_one_text)
+  
 
-    try:
-        address_hit = re.search(address_pattern, page_one_text)
-        if address_hit is not None:
-            res['Polling Address'] = address_hit.group(1).rstrip('\n')
-    except IndexError:
-        pass
+"""Finds where a page sits compared to a template page, so boxes drawn on
+the template (like COVER_CROP_BOXES) can be moved onto pages that were
+scanned shifted or slightly scaled.
 
+Both pages are scaled down to REGISTER_WIDTH and reduced to how much ink
+every row and every column holds. For every scale in REGISTER_SCALES the
+page's profile is resampled and cross-correlated with the template's
+(np.correlate, a few hundred values each), and the scale and shift with the
+best normalized correlation wins, separately for x and y. Pages of another
+resolution are compared as if they had the template's width.
+"""
+class PageRegistration:
+    def __init__(self, template):
+        global REGISTER_WIDTH
+
+        template = toImage(template)
+        self.size = template.size
+        self.factor = REGISTER_WIDTH / template.size[0]
+        self.columns, self.rows = self.profiles(template)
+
+    # how the ink changes from column to column and row to row of image,
+    # scaled down to template units. Width and height get scaled on their
+    # own, so a page rendered at another dpi (or a scan with another aspect
+    # ratio) lines up with the template. The ink itself is too smooth to
+    # correlate on: a slightly wrong scale with a different shift matches
+    # about as well as the right one, which puts boxes several pixels off.
+    # Its changes (the edges of the text) only match at the right one
+    def profiles(self, image):
+        size = (max(1, round(self.size[0] * self.factor)), max(1, round(self.size[1] * self.factor)))
+        ink = 255.0 - np.asarray(image.convert('L').resize(size, Image.BOX), dtype=np.float64)
+        return np.diff(ink.sum(axis=0)), np.diff(ink.sum(axis=1))
+
+    # best (scale, shift, score) to map the reference profile onto profile,
+    # i.e. profile[scale * t + shift] ~ reference[t]
+    def align(self, reference, profile):
+        global REGISTER_SCALES
+        global REGISTER_MAX_SHIFT
+
+        reference = reference - reference.mean()
+        max_lag = max(1, int(len(reference) * REGISTER_MAX_SHIFT))
+        best = (1.0, 0.0, -1.0)
+        for scale in REGISTER_SCALES:
+            # profile as if it had been scanned at the template's scale
+            resampled = np.interp(np.arange(0, len(profile) / scale) * scale, np.arange(len(profile)), profile)
+            resampled = resampled - resampled.mean()
+            norm = np.linalg.norm(reference) * np.linalg.norm(resampled)
+            if norm == 0:
+                continue
+            corr = np.correlate(resampled, reference, 'full') / norm
+            # corr[i] is the lag i - (len(reference) - 1)
+            lags = np.arange(len(corr)) - (len(reference) - 1)
+            window = np.abs(lags) <= max_lag
+            i = np.argmax(np.where(window, corr, -np.inf))
+            if corr[i] > best[2]:
+                # fit a parabola through the peak for a fraction of a (scaled down) pixel
+                lag = float(lags[i])
+                if 0 < i < len(corr) - 1:
+                    curve = corr[i - 1] - 2 * corr[i] + corr[i + 1]
+                    if curve < 0:
+                        lag += 0.5 * (corr[i - 1] - corr[i + 1]) / curve
+                best = (scale, float(lag * scale), float(corr[i]))
+        return best
+
+    """Returns a tuple of (x scale, x shift, y scale, y shift)
+
+    A point (x, y) of the template is at (x * x scale + x shift, y * y scale
+    + y shift) on image, in pixels of image. When either direction doesn't
+    correlate well enough (REGISTER_MIN_SCORE) it's left as it is.
+    """
+    def transform(self, image):
+        global REGISTER_MIN_SCORE
+
+        image = toImage(image)
+        columns, rows = self.profiles(image)
+        res = []
+        for reference, profile, ratio in [(self.columns, columns, image.size[0] / self.size[0]),
+                                          (self.rows, rows, image.size[1] / self.size[1])]:
+            scale, shift, score = self.align(reference, profile)
+            if score < REGISTER_MIN_SCORE:
+                scale, shift = 1.0, 0.0
+            res += [scale * ratio, shift / self.factor * ratio]
+        return tuple(res)
+
+    """Returns a dictionary of 'x', 'y', 'w' and 'h' lists
+
+    boxes (drawn on the template) moved onto image.
+    """
+    def boxes(self, image, boxes):
+        sx, dx, sy, dy = self.transform(image)
+        return {
+            'x': [int(round(x * sx + dx)) for x in boxes['x']],
+            'y': [int(round(y * sy + dy)) for y in boxes['y']],
+            'w': [int(round(w * sx)) for w in boxes['w']],
+            'h': [int(round(h * sy)) for h in boxes['h']]
+        }
 
-    return res
-  
 
 """Returns None
 
@@ -504,6 +1937,34 @@ def generateCropped(img, i, x, y, w, h, directory='images'):
     cropped.save('{0}/cropped{1}.JPEG'.format(directory, i))
 
 
+"""Returns a list of PIL Image objects
+
+In-memory version of generateCropped. boxes is a dictionary of 'x', 'y', 'w'
+and 'h' lists (one entry per crop) and every box is cropped out of img.
+"""
+def cropImages(img, boxes):
+    res = []
+    for i in range(len(boxes['x'])):
+        x, y = boxes['x'][i], boxes['y'][i]
+        res.append(img.crop((x, y, x + boxes['w'][i], y + boxes['h'][i])))
+    return res
+
+
+"""Returns a list
+
+Converts the OCR'd text of cropped boxes into values: numbers where the
+text is a number, the raw text otherwise.
+"""
+def parseCropped(texts):
+    res = []
+    for text in texts:
+        try:
+            res.append(int(text))
+        except ValueError:
+            res.append(text)
+    return res
+
+
 """Returns a list
 
 Tries to look for [num_pages] filed named plaintext/cropped[i].txt
@@ -514,11 +1975,7 @@ def retreiveCropped(num_pages, start=0, directory='plaintext'):
     for i in range(start, start + num_pages):
         try:
             f = open('{0}/cropped{1}.txt'.format(directory, i))
-            fstr = f.read()
-            try:
-                res.append(int(fstr))
-            except ValueError:
-                res.append(fstr)
+            res += parseCropped([f.read()])
             f.close()
         except Exception as err:
             print('Unknown error: {}'.format(err))
@@ -572,12 +2029,7 @@ if __name__ == '__main__':
         clist='tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ:/')
 
     # generating cropped values
-    vals = {
-        'x': [246, 656, 1022, 1384, 1713, 2090, 2242, 1812, 1800, 1804],
-        'y': [3048, 3048, 3097, 3097, 3097, 3097, 238, 2158, 1602, 2092],
-        'w': [60, 104, 80, 80, 109, 109, 96, 186, 280, 330],
-        'h': [60, 48, 37, 37, 39, 39, 96, 78, 74, 72]
-    }
+    vals = COVER_CROP_BOXES
     copy = hindi_pages['images'][0].copy()
     for i in range(10):        
         generateCropped(copy, i, 
@@ -625,3 +2077,5 @@ if __name__ == '__main__':
     #print('Converting to dataframe...')
     #dataframes = extractTable1(hin_text_pages, en_text_text_pages, 2)
     #print(dataframes[0].head())
+    #dataframes = extractTable1Layout(extractTableLayouts(hindi_pages['images']), 2)
+    #print(dataframes[0].head())
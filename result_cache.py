@@ -0,0 +1,81 @@
+# A small content-addressed store for pipeline results, so a crashed or
+# interrupted run can pick up where it left off instead of starting over.
+# Results are keyed by the hash of the input file plus the configuration
+# of the pipeline that produced them, and saved as one JSON file each.
+
+import tempfile
+import hashlib
+import json
+import os
+
+HASH_BLOCK_SIZE = 1 << 20 # read files 1MB at a time while hashing
+
+
+"""Returns a string
+
+The sha256 hex digest of the file at path.
+"""
+def hashFile(path):
+    global HASH_BLOCK_SIZE
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        block = f.read(HASH_BLOCK_SIZE)
+        while len(block) > 0:
+            digest.update(block)
+            block = f.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+"""Returns a string
+
+The sha256 hex digest of a JSON-serializable configuration. Key order
+doesn't matter.
+"""
+def hashConfig(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+"""A directory of cached results.
+
+Every result is stored at [directory]/xx/[key].json where key combines the
+hash of the input file with the hash of config, so changing the pipeline
+(crop boxes, OCR settings, ...) never returns stale results. Writes are
+atomic, so a crash mid-write can't leave a half-written entry behind.
+"""
+class ResultCache:
+    def __init__(self, directory, config=None):
+        self.directory = directory
+        self.config_hash = hashConfig(config)
+        self.keys = {} # (path, size, mtime) -> key, so files only get hashed once
+
+    def key(self, path):
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if file_id not in self.keys:
+            self.keys[file_id] = hashlib.sha256((hashFile(path) + self.config_hash).encode('ascii')).hexdigest()
+        return self.keys[file_id]
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, key[0:2], key + '.json')
+
+    """Returns the cached result for the file at path or None"""
+    def get(self, path):
+        try:
+            with open(self.entryPath(self.key(path)), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    """Saves result as the cached result for the file at path"""
+    def put(self, path, result):
+        entry = self.entryPath(self.key(path))
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.remove(tmp)
+            raise
@@ -0,0 +1,83 @@
+# Checks that boxes follow a page through Preprocessor: a made up cover is
+# turned by a small angle (the way a scan comes out skewed), deskewed, and
+# the marks the boxes were drawn around have to still be inside them.
+# Runs with python -m unittest test_preprocess (or pytest).
+
+from PIL import Image, ImageDraw
+import numpy as np
+import tempfile
+import pypdf_ocr
+import unittest
+
+PAGE_SIZE = (1240, 1754) # a cover at 150 dpi
+MARKS = [(120, 1500), (600, 1500), (1000, 1500), (1050, 120), (900, 900)]
+MARK_SIZE = 30
+
+
+# lines of "text" for deskew to find and a square mark at every MARKS spot,
+# turned by angle degrees
+def skewed_page(angle):
+    page = Image.new('L', PAGE_SIZE, 255)
+    draw = ImageDraw.Draw(page)
+    for y in range(200, 1400, 40):
+        draw.rectangle((100, y, 800, y + 12), fill=0)
+    for x, y in MARKS:
+        draw.rectangle((x, y, x + MARK_SIZE, y + MARK_SIZE), fill=0)
+    return page.rotate(angle, resample=Image.BILINEAR, fillcolor=255)
+
+
+# middle of the dark pixels of image inside box, padded by a bit
+def ink_center(image, box, padding=15):
+    x, y, w, h = box
+    pixels = np.asarray(image.convert('L'))[y - padding:y + h + padding, x - padding:x + w + padding]
+    ys, xs = np.nonzero(pixels < 128)
+    return x - padding + xs.mean(), y - padding + ys.mean()
+
+
+# the boxes of MARKS on a page turned by angle, found from the ink
+def mark_boxes(page):
+    res = []
+    for x, y in MARKS:
+        cx, cy = ink_center(page, (x, y, MARK_SIZE, MARK_SIZE), 40)
+        res.append((int(round(cx - MARK_SIZE / 2)), int(round(cy - MARK_SIZE / 2)), MARK_SIZE, MARK_SIZE))
+    return res
+
+
+class TestPreprocessorBoxes(unittest.TestCase):
+    def assertBoxesOnMarks(self, preprocess, angle):
+        page = skewed_page(angle)
+        boxes = mark_boxes(page)
+        processed = preprocess(page)
+        self.assertAlmostEqual(processed.info.get('skew', 0), -angle, delta=0.15)
+        for box in boxes:
+            x, y, w, h = preprocess.mapBox(box, processed)
+            cx, cy = ink_center(processed, (x, y, w, h))
+            self.assertAlmostEqual(cx, x + w / 2, delta=2)
+            self.assertAlmostEqual(cy, y + h / 2, delta=2)
+
+    def test_deskew(self):
+        self.assertBoxesOnMarks(pypdf_ocr.Preprocessor('gray', deskew=True), 0.8)
+
+    def test_deskew_other_way(self):
+        self.assertBoxesOnMarks(pypdf_ocr.Preprocessor('gray', deskew=True), -1.5)
+
+    def test_deskew_and_scale(self):
+        self.assertBoxesOnMarks(pypdf_ocr.Preprocessor('binary', deskew=True, scale=0.75), 1.2)
+
+    def test_cached_page_keeps_skew(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            preprocess = pypdf_ocr.Preprocessor('gray', deskew=True, cache_dir=cache_dir)
+            page = skewed_page(1.0)
+            first = preprocess(page)
+            cached = preprocess(page)
+            self.assertEqual(cached.info.get('skew'), first.info.get('skew'))
+            self.assertEqual(preprocess.mapBox((600, 1500, 30, 30), cached), preprocess.mapBox((600, 1500, 30, 30), first))
+
+    def test_straight_page(self):
+        preprocess = pypdf_ocr.Preprocessor('gray', deskew=True)
+        processed = preprocess(skewed_page(0))
+        self.assertEqual(preprocess.mapBox((600, 1500, 30, 30), processed), (600, 1500, 30, 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# Checks planRegionBands / cropRegions: every region has to come back where
+# it was, at its own dpi, and regions far apart can't cost a band covering
+# most of the page between them.
+# Runs with python -m unittest test_region_bands (or pytest).
+
+import pypdf_ocr
+import unittest
+
+CROP_DPI = [400] * 8 + [300] * 2
+
+
+def cover_regions(dpis=CROP_DPI):
+    boxes = pypdf_ocr.COVER_CROP_BOXES
+    return [(boxes['x'][i], boxes['y'][i], boxes['w'][i], boxes['h'][i], dpis[i]) for i in range(len(dpis))]
+
+
+class TestPlanRegionBands(unittest.TestCase):
+    def test_every_region_once(self):
+        regions = cover_regions()
+        bands = pypdf_ocr.planRegionBands(regions)
+        members = sorted([i for dpi, box, boxes in bands for i, member in boxes])
+        self.assertEqual(members, list(range(len(regions))))
+
+    def test_members_land_on_regions(self):
+        regions = cover_regions()
+        for dpi, (bx, by, bw, bh), boxes in pypdf_ocr.planRegionBands(regions):
+            scale = dpi / pypdf_ocr.RASTER_DPI
+            for i, (x, y, w, h) in boxes:
+                self.assertEqual(regions[i][4], dpi)
+                self.assertAlmostEqual((bx + x) / scale, regions[i][0], delta=1)
+                self.assertAlmostEqual((by + y) / scale, regions[i][1], delta=1)
+                self.assertGreaterEqual(w, regions[i][2] * scale)
+                self.assertGreaterEqual(h, regions[i][3] * scale)
+                self.assertLessEqual(x + w, bw)
+                self.assertLessEqual(y + h, bh)
+
+    def test_cover_renders_fewer_pixels_than_a_page(self):
+        # a 300 dpi A4 page is about 8.7 MP
+        bands = pypdf_ocr.planRegionBands(cover_regions())
+        pixels = sum([box[2] * box[3] for dpi, box, boxes in bands])
+        self.assertLess(pixels, 1000000)
+
+    def test_row_is_one_band(self):
+        # the numbers at the bottom of a cover are one row
+        bands = pypdf_ocr.planRegionBands(cover_regions()[0:6])
+        self.assertEqual(len(bands), 1)
+
+    def test_far_apart_regions_split(self):
+        regions = [(100, 100, 50, 50, 400), (2200, 3200, 50, 50, 400)]
+        self.assertEqual(len(pypdf_ocr.planRegionBands(regions)), 2)
+
+
+class TestCropRegions(unittest.TestCase):
+    def test_crops_at_dpi(self):
+        page = pypdf_ocr.Image.new('L', (2480, 3508), 255)
+        regions = cover_regions()
+        crops = pypdf_ocr.cropRegions(page, regions)
+        self.assertEqual(len(crops), len(regions))
+        for (image, members), region in zip(crops, regions):
+            scale = region[4] / pypdf_ocr.RASTER_DPI
+            self.assertEqual(image.size, (round(region[2] * scale), round(region[3] * scale)))
+            self.assertEqual(members[0][1], (0, 0) + image.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# Checks PageRegistration on a made up cover: the page gets shifted and
+# rendered at another size than the template, and the boxes drawn on the
+# template have to land where that content ended up.
+# Runs with python -m unittest test_registration (or pytest).
+
+from PIL import Image, ImageDraw
+import pypdf_ocr
+import unittest
+import random
+
+TEMPLATE_SIZE = (1275, 1650) # a cover at 150 dpi
+
+
+# a white page with black bars where a cover has text, and the boxes of
+# some of those bars (the way COVER_CROP_BOXES boxes text)
+def cover_template(bars=60, seed=0):
+    rng = random.Random(seed)
+    page = Image.new('L', TEMPLATE_SIZE, 255)
+    draw = ImageDraw.Draw(page)
+    boxes = {'x': [], 'y': [], 'w': [], 'h': []}
+    for i in range(bars):
+        x, y = rng.randrange(50, TEMPLATE_SIZE[0] - 300), rng.randrange(50, TEMPLATE_SIZE[1] - 60)
+        w, h = rng.randrange(40, 250), rng.randrange(8, 40)
+        draw.rectangle((x, y, x + w, y + h), fill=0)
+        if i % 6 == 0:
+            for key, value in zip(['x', 'y', 'w', 'h'], [x, y, w, h]):
+                boxes[key].append(value)
+    return page, boxes
+
+
+# template shifted by (dx, dy) template pixels, then rendered at size
+def scanned(template, dx, dy, size):
+    page = Image.new('L', template.size, 255)
+    page.paste(template, (dx, dy))
+    return page.resize(size, Image.BILINEAR)
+
+
+class TestPageRegistration(unittest.TestCase):
+    def assertBoxesMoved(self, dx, dy, size, tolerance=2):
+        template, boxes = cover_template()
+        registration = pypdf_ocr.PageRegistration(template)
+        moved = registration.boxes(scanned(template, dx, dy, size), boxes)
+        rx, ry = size[0] / template.size[0], size[1] / template.size[1]
+        for i in range(len(boxes['x'])):
+            self.assertAlmostEqual(moved['x'][i], (boxes['x'][i] + dx) * rx, delta=tolerance)
+            self.assertAlmostEqual(moved['y'][i], (boxes['y'][i] + dy) * ry, delta=tolerance)
+            self.assertAlmostEqual(moved['w'][i], boxes['w'][i] * rx, delta=tolerance)
+            self.assertAlmostEqual(moved['h'][i], boxes['h'][i] * ry, delta=tolerance)
+
+    def test_same_dpi(self):
+        self.assertBoxesMoved(10, 10, TEMPLATE_SIZE)
+
+    def test_lower_dpi(self):
+        # 100 dpi against the 150 dpi template
+        self.assertBoxesMoved(10, 10, (850, 1100))
+
+    def test_higher_dpi(self):
+        # 200 dpi
+        self.assertBoxesMoved(-8, 12, (1700, 2200))
+
+    def test_other_aspect_ratio(self):
+        # a scan that's been squeezed more in one direction than the other
+        self.assertBoxesMoved(6, -10, (850, 1200))
+
+    def test_shift_only(self):
+        template, boxes = cover_template()
+        sx, dx, sy, dy = pypdf_ocr.PageRegistration(template).transform(scanned(template, 0, 10, (850, 1100)))
+        self.assertAlmostEqual(sy, 2 / 3, delta=0.005)
+        self.assertAlmostEqual(dy, 10 * 2 / 3, delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
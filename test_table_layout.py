@@ -0,0 +1,98 @@
+# Checks layoutTableCells / extractTable1Layout on made up word layouts of a
+# voter table page, so the cell geometry can't drift without anyone noticing.
+# Runs with python -m unittest test_table_layout (or pytest).
+
+import pypdf_ocr
+import unittest
+import random
+
+
+# a layout (see pypdf_ocr.extractLayout) with one entry per added word
+class LayoutBuilder:
+    def __init__(self):
+        self.layout = dict([(key, []) for key in pypdf_ocr.LAYOUT_KEYS])
+        self.block = 0
+
+    def line(self, words, x, y, height=40):
+        self.block += 1
+        for text in words:
+            width = 20 * len(text)
+            values = [text, x, y, width, height, 90.0, self.block, 1, 1]
+            for key, value in zip(pypdf_ocr.LAYOUT_KEYS, values):
+                self.layout[key].append(value)
+            x += width + 15
+
+    # one voter cell the way the roll prints it, slot n of the page
+    def cell(self, n, x, y, label=True, family=True):
+        self.line([str(n + 1)], x, y - 80)
+        self.line(['ABC{:07d}'.format(n)], x + 400, y - 80)
+        if label:
+            self.line(['निर्वाचक', 'का', 'नाम', 'राम', 'सिंह'], x, y)
+        if family:
+            self.line(['पिता', 'का', 'नाम', ':', 'श्याम', 'सिंह'], x, y + 60)
+        self.line(['गृह', 'संख्या', ':', str(10 + n)], x, y + 120)
+        self.line(['उम्र', ':', str(20 + n), 'लिंग', ':', 'महिला'], x, y + 180)
+
+
+def roll_page(cells=30, missing_label=(), missing_family=(), jitter=5, seed=0):
+    rng = random.Random(seed)
+    page = LayoutBuilder()
+    for n in range(cells):
+        row, column = divmod(n, 3)
+        page.cell(n, 150 + 800 * column + rng.randint(-jitter, jitter), 400 + 320 * row + rng.randint(-jitter, jitter),
+            label=n not in missing_label, family=n not in missing_family)
+    return page
+
+
+class TestTableLayout(unittest.TestCase):
+    def records(self, page):
+        return pypdf_ocr.extractTable1Layout([page.layout])[0].to_dict('records')
+
+    def test_full_page(self):
+        records = self.records(roll_page())
+        self.assertEqual(len(records), 30)
+        for n, record in enumerate(records):
+            self.assertEqual(record['VoterID'], 'ABC{:07d}'.format(n))
+            self.assertEqual(record['Name'], 'राम सिंह')
+            self.assertEqual(record['Family'], 'श्याम सिंह')
+            self.assertEqual(record['HouseNum'], str(10 + n))
+            self.assertEqual(record['Age'], 20 + n)
+            self.assertEqual(record['Sex'], 'महिला')
+
+    def test_missing_label_only_blanks_its_cell(self):
+        records = self.records(roll_page(missing_label=[7]))
+        self.assertEqual(records[7]['Name'], '')
+        self.assertEqual(records[7]['VoterID'], 'ABC0000007')
+        self.assertEqual(records[7]['Age'], 27)
+        for n in [6, 8, 10, 29]:
+            self.assertEqual(records[n]['VoterID'], 'ABC{:07d}'.format(n))
+            self.assertEqual(records[n]['Age'], 20 + n)
+
+    def test_missing_field_only_blanks_its_cell(self):
+        records = self.records(roll_page(missing_family=[4]))
+        self.assertEqual(records[4]['Family'], '')
+        self.assertEqual(records[5]['Family'], 'श्याम सिंह')
+        self.assertEqual([record['Age'] for record in records], [20 + n for n in range(30)])
+
+    def test_stray_anchor_words_outside_the_grid(self):
+        page = roll_page()
+        page.line(['निर्वाचक', 'नामावली', '2019'], 900, 60)
+        page.line(['निर्वाचक', 'नामावली', 'भाग', 'संख्या', '45'], 900, 3700)
+        records = self.records(page)
+        self.assertEqual(len(records), 30)
+        self.assertEqual([record['VoterID'] for record in records], ['ABC{:07d}'.format(n) for n in range(30)])
+
+    def test_partial_last_page(self):
+        records = self.records(roll_page(cells=7))
+        self.assertEqual(len(records), 30)
+        self.assertEqual([record['Age'] for record in records[0:7]], [20 + n for n in range(7)])
+        self.assertTrue(all([record['VoterID'] == '' for record in records[7:]]))
+
+    def test_no_anchors(self):
+        page = LayoutBuilder()
+        page.line(['निर्वाचक', 'नामावली'], 900, 60)
+        self.assertEqual(pypdf_ocr.layoutTableCells(page.layout), [''] * 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,57 +1,109 @@
 from polyglot.transliteration import Transliterator
-from pypdf_ocr import getHindiAlphabet
+from functools import lru_cache
+from collections import deque
+import multiprocessing
 import argparse
+import re
+
+# one run of hindi (devanagari, the same range as pypdf_ocr.getHindiAlphabet)
+HINDI_WORD = re.compile('[\u0900-\u097F]+')
+WORD_CACHE_SIZE = 1 << 16 # distinct words kept transliterated in memory
+CHUNK_LINES = 10000 # lines per write (and per task with workers)
+TRANSLITERATOR = None
+
+
+"""Returns a Transliterator
+
+The hindi to english transliterator, made once per process.
+"""
+def getTransliterator():
+    global TRANSLITERATOR
+
+    if TRANSLITERATOR is None:
+        TRANSLITERATOR = Transliterator(source_lang="hi", target_lang="en")
+    return TRANSLITERATOR
+
+
+"""Returns a string
+
+Transliterates a single hindi word. Names repeat a lot in the census, so
+every word only goes through the transliterator once.
+"""
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def transliterate_word(word):
+    return getTransliterator().transliterate(word)
+
+
+"""Returns a string
+
+Transliterates every hindi word in line and leaves everything else as it is.
+"""
+def transliterate_line(line):
+    return HINDI_WORD.sub(lambda match: transliterate_word(match.group(0)), line)
+
+
+"""Returns a string
+
+Transliterates a list of lines (without line endings) and joins them back
+into a block of text ready to be written.
+"""
+def transliterate_lines(lines):
+    return ''.join(["{}\n".format(transliterate_line(line)) for line in lines])
+
+
+"""Returns a generator
+
+Yields lists of at most size lines from in_file, without their line endings.
+"""
+def readChunks(in_file, size=CHUNK_LINES):
+    chunk = []
+    for line in in_file:
+        chunk.append(line.rstrip("\r\n"))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
 
 """Returns None
 
-Takes a path to a file as its first parameter and saves the transliterated 
-version to a new file (second paramter if given)
+Takes a path to a file as its first parameter and saves the transliterated
+version to a new file (second paramter if given). The header line is copied
+as is. The file is streamed a chunk of lines at a time, so memory use
+doesn't grow with the file. With workers > 1 chunks get transliterated by
+that many processes, and are still written in order.
 """
-def transliterate_csv(path_in, path_out):
-    res = []
-    transliterator = Transliterator(source_lang="hi", target_lang="en")
-    alpha = getHindiAlphabet()
-
-    with open(path_in, "r", encoding='utf-8') as in_file:
-        lines = in_file.read().splitlines()
-        res.append(lines[0])
-        for i in range(1, len(lines)):
-            k = 0
-            j = k
-            res_line = ""
-            while j < len(lines[i]):
-                # if this is a hindi character, start trying to find the 
-                # whole word
-                if lines[i][k] in alpha:
-                    # skip to the end of the hindi characters
-                    while k + 1 < len(lines[i]) and lines[i][k+1] in alpha:
-                        k += 1
-                    # use this next variable to get where the last hindi character was
-                    m = j
-                    while m >= 1 and lines[i][m - 1] not in alpha:
-                        m -= 1
-                    res_line += lines[i][m:j]
-                    hindi_str = lines[i][j:k+1]
-                    en_str = transliterator.transliterate(hindi_str)
-                    res_line += en_str
-                k += 1
-                j = k
-            # start at the end and add in the last bit of non-hindi
-            m = len(lines[i])
-            while m >= 1 and lines[i][m - 1] not in alpha:
-                m -= 1
-            res_line += lines[i][m:len(lines[i])]
-            res.append(res_line)
-
-    with open(path_out, "w+") as out_file:
-        for line in res:
-            out_file.write("{}\n".format(line))
+def transliterate_csv(path_in, path_out, workers=1, chunk_lines=CHUNK_LINES):
+    with open(path_in, "r", encoding='utf-8') as in_file, open(path_out, "w+", encoding='utf-8') as out_file:
+        header = in_file.readline()
+        if header == '':
+            return
+        out_file.write("{}\n".format(header.rstrip("\r\n")))
+
+        chunks = readChunks(in_file, chunk_lines)
+        if workers <= 1:
+            for chunk in chunks:
+                out_file.write(transliterate_lines(chunk))
+            return
+
+        with multiprocessing.Pool(workers) as pool:
+            # only a few chunks are ever read ahead of the writer
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(transliterate_lines, (chunk,)))
+                if len(pending) >= 2 * workers:
+                    out_file.write(pending.popleft().get())
+            while len(pending) > 0:
+                out_file.write(pending.popleft().get())
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Simple tool to transliterate a hindi csv to English")
     parser.add_argument("--infile", help="the file to transliterate", required=True)
     parser.add_argument("--outfile", help="the path to save to", required=True)
+    parser.add_argument("--workers", type=int, default=1, help="how many processes to transliterate with")
+    parser.add_argument("--chunk", type=int, default=CHUNK_LINES, help="lines per chunk")
 
     args = parser.parse_args()
-    transliterate_csv(args.infile, args.outfile)
+    transliterate_csv(args.infile, args.outfile, args.workers, args.chunk)